@@ -6,19 +6,58 @@ Enhanced version with multiple effects and optimized performance.
 """
 
 import argparse
+import importlib
 import os
 import sys
-import random
-import tempfile
-import subprocess
-import textwrap
 import shutil
 import re
-from pathlib import Path
-from PIL import Image, ImageDraw, ImageFilter, ImageEnhance, ImageOps, ImageFont, ImageColor
 import math
 import io
 import time
+import threading
+import contextlib
+import itertools
+from collections import OrderedDict
+
+
+class _LazyModule:
+    """Stand-in for a module that is only imported on first use
+    
+    Keeps PIL and the other imports a run may never need out of the start-up
+    of metadata commands such as --version, --list-patterns or -f list.
+    """
+    
+    def __init__(self, name):
+        self._name = name
+    
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        # Replace the stand-in so later uses go straight to the module
+        for key, value in list(globals().items()):
+            if value is self:
+                globals()[key] = module
+        return getattr(module, attr)
+
+
+random = _LazyModule('random')
+tempfile = _LazyModule('tempfile')
+subprocess = _LazyModule('subprocess')
+textwrap = _LazyModule('textwrap')
+queue = _LazyModule('queue')
+selectors = _LazyModule('selectors')
+hashlib = _LazyModule('hashlib')
+json = _LazyModule('json')
+glob = _LazyModule('glob')
+Image = _LazyModule('PIL.Image')
+ImageDraw = _LazyModule('PIL.ImageDraw')
+ImageFilter = _LazyModule('PIL.ImageFilter')
+ImageEnhance = _LazyModule('PIL.ImageEnhance')
+ImageOps = _LazyModule('PIL.ImageOps')
+ImageFont = _LazyModule('PIL.ImageFont')
+ImageColor = _LazyModule('PIL.ImageColor')
+ImageChops = _LazyModule('PIL.ImageChops')
+ImageStat = _LazyModule('PIL.ImageStat')
+
 
 class PostScriptSimple:
     """Python version of PostScript::Simple"""
@@ -30,12 +69,9 @@ class PostScriptSimple:
         "Symbol", "Times-Bold", "Times-BoldItalic", "Times-Italic", "Times-Roman"
     ]
     
-    # Load extended fonts list
-    try:
-        with open('/usr/local/share/BIDeT/fontlist.txt', 'r') as f:
-            extfonts = [line.strip() for line in f]
-    except FileNotFoundError:
-        extfonts = []
+    # Extended fonts list, read on first use by ext_fonts()
+    fontlist_file = '/usr/local/share/BIDeT/fontlist.txt'
+    _extfonts = None
     
     # Color definitions (dictionary mapping color names to RGB values)
     pscolours = {
@@ -75,8 +111,21 @@ class PostScriptSimple:
         "A9": [105, 148],
     }
     
-    def __init__(self, papersize="A4", colour=True, eps=False, units="in", reencode="ISOLatin1Encoding"):
+    @classmethod
+    def ext_fonts(cls):
+        """Return the extended fonts list, loading it on first use"""
+        if cls._extfonts is None:
+            try:
+                with open(cls.fontlist_file, 'r') as f:
+                    cls._extfonts = [line.strip() for line in f]
+            except FileNotFoundError:
+                cls._extfonts = []
+        return cls._extfonts
+    
+    def __init__(self, papersize="A4", colour=True, eps=False, units="in", reencode="ISOLatin1Encoding",
+                 xsize=None, ysize=None, out=None, languagelevel=1):
         self.papersize = papersize
+        self.languagelevel = languagelevel
         self.colour = colour
         self.eps = eps
         self.units = units
@@ -88,11 +137,33 @@ class PostScriptSimple:
         self.page_count = 0
         self.current_page = []
         
-        # Get paper dimensions
-        if papersize in self.pspaper:
+        # Get paper dimensions - an explicit size (in points) wins over papersize
+        if xsize and ysize:
+            self.papersize = None
+            self.width, self.height = math.ceil(xsize), math.ceil(ysize)
+        elif papersize in self.pspaper:
             self.width, self.height = self.pspaper[papersize]
         else:
             self.width, self.height = 595, 842  # Default A4 size
+        
+        # Streaming: write the document to out as it is built instead of
+        # keeping it in memory (finish() ends it, page_body() is unavailable)
+        self.out = out
+        if out is not None:
+            self._add_ps_header()
+            self._write(self.content)
+            self.content = []
+    
+    def _write(self, lines):
+        """Write lines to the output stream"""
+        self.out.write("".join(f"{line}\n" for line in lines).encode('latin1'))
+    
+    def _emit(self, line):
+        """Add a line to the current page (or write it when streaming)"""
+        if self.out is None:
+            self.current_page.append(line)
+        else:
+            self.out.write(f"{line}\n".encode('latin1'))
     
     def _add_ps_header(self):
         """Add the basic PostScript header"""
@@ -103,13 +174,15 @@ class PostScriptSimple:
         
         # Add document metadata
         self.content.append("%%Title: (Python PostScript::Simple)")
-        self.content.append("%%LanguageLevel: 1")
+        self.content.append(f"%%LanguageLevel: {self.languagelevel}")
         self.content.append("%%Creator: Python PostScript::Simple")
         self.content.append(f"%%BoundingBox: 0 0 {self.width} {self.height}")
         
         # Add paper size info
         if self.papersize in self.pspaper:
             self.content.append(f"%%DocumentMedia: {self.papersize} {self.width} {self.height} 0 ( ) ( )")
+        elif not self.eps:
+            self.content.append(f"%%DocumentMedia: Custom {self.width} {self.height} 0 ( ) ( )")
         
         self.content.append("%%EndComments")
         
@@ -118,22 +191,48 @@ class PostScriptSimple:
         self.content.append("/ll 1 def systemdict /languagelevel known {")
         self.content.append("/ll languagelevel def } if")
         
-        # Add basic definitions
-        self._add_basic_definitions()
-        
-        # Font encoding if needed
-        if self.reencode:
-            self._add_font_encoding()
+        # Add basic definitions and font encoding
+        self.content.extend(self._prolog_lines())
             
         self.content.append("%%EndProlog")
         
-        # Setup section
+        # Setup section - request the page size so the interpreter does not
+        # fall back to its default paper
         self.content.append("%%BeginSetup")
+        if not self.eps:
+            self.content.append("%%BeginFeature: *PageSize")
+            self.content.append(f"<< /PageSize [{self.width} {self.height}] >> setpagedevice")
+            self.content.append("%%EndFeature")
         self.content.append("%%EndSetup")
     
-    def _add_basic_definitions(self):
+    def _prolog_lines(self):
+        """Return the prolog lines (procedures and font encoding)"""
+        lines = []
+        self._add_basic_definitions(lines)
+        
+        # Font encoding if needed
+        if self.reencode:
+            self._add_font_encoding(lines)
+        return lines
+    
+    def prolog(self):
+        """Return the prolog as a string, e.g. to preload into an interpreter"""
+        return "\n".join(self._prolog_lines()) + "\n"
+    
+    def page_body(self):
+        """Return the drawing commands of the current page as a string
+        
+        The body excludes the document header and the final showpage so that
+        it can be run inside an interpreter that already has the prolog loaded.
+        """
+        lines = list(self.current_page)
+        if lines and not self.eps:
+            lines.append("pagelevel restore")
+        return "\n".join(lines) + "\n"
+    
+    def _add_basic_definitions(self, lines):
         """Add basic PostScript definitions"""
-        self.content.append("""
+        lines.append("""
 /box {
   newpath 3 copy pop exch 4 copy pop pop
   8 copy pop pop pop pop exch pop exch
@@ -142,11 +241,25 @@ class PostScriptSimple:
 } bind def
 
 /circle {newpath 0 360 arc closepath} bind def
+
+/textlines { % [strings] x y dy - one left aligned line per string
+  4 dict begin
+  /dy exch def /y exch def /x exch def
+  { newpath x y moveto show /y y dy sub def } forall
+  end
+} bind def
+
+/textpaths { % [strings] x y dy - like textlines, adds the outlines to the path
+  4 dict begin
+  /dy exch def /y exch def /x exch def
+  { x y moveto false charpath /y y dy sub def } forall
+  end
+} bind def
 """)
     
-    def _add_font_encoding(self):
+    def _add_font_encoding(self, lines):
         """Add font encoding setup to the document"""
-        self.content.append("""
+        lines.append("""
 /STARTDIFFENC { mark } bind def
 /ENDDIFFENC { 
     counttomark 2 add -1 roll 256 array copy
@@ -218,7 +331,7 @@ class PostScriptSimple:
 """)
         # Re-encode the ISO fonts
         for font in self.isofonts:
-            self.content.append(f"/{font}-iso {self.reencode} /{font} REENCODEFONT")
+            lines.append(f"/{font}-iso {self.reencode} /{font} REENCODEFONT")
     
     def newpage(self):
         """Create a new page in the document"""
@@ -227,7 +340,9 @@ class PostScriptSimple:
             return
             
         # Close previous page if exists
-        if self.current_page:
+        if self.out is not None and self.page_count:
+            self._write(["pagelevel restore", "showpage"])
+        elif self.current_page:
             self.content.extend(self.current_page)
             self.content.append("showpage")
         
@@ -236,10 +351,10 @@ class PostScriptSimple:
         
         # Start new page
         self.current_page = []
-        self.current_page.append(f"%%Page: {self.page_count} {self.page_count}")
-        self.current_page.append("%%BeginPageSetup")
-        self.current_page.append("/pagelevel save def")
-        self.current_page.append("%%EndPageSetup")
+        self._emit(f"%%Page: {self.page_count} {self.page_count}")
+        self._emit("%%BeginPageSetup")
+        self._emit("/pagelevel save def")
+        self._emit("%%EndPageSetup")
     
     def setcolour(self, *args):
         """Set the drawing color
@@ -268,11 +383,11 @@ class PostScriptSimple:
         b = round(b / 255, 5)
         
         if self.colour:
-            self.current_page.append(f"{r} {g} {b} setrgbcolor")
+            self._emit(f"{r} {g} {b} setrgbcolor")
         else:
             # Convert to grayscale (better conversion than average)
             gray = round(0.3*r + 0.59*g + 0.11*b, 5)
-            self.current_page.append(f"{gray} setgray")
+            self._emit(f"{gray} setgray")
     
     def setfont(self, font_name, size):
         """Set the current font and size
@@ -281,7 +396,7 @@ class PostScriptSimple:
             font_name: Name of the PostScript font
             size: Font size in points
         """
-        self.current_page.append(f"/{font_name} findfont {size} scalefont setfont")
+        self._emit(f"/{font_name} findfont {size} scalefont setfont")
         self.current_fontsize = size
     
     def text(self, x, y, text_string, align="left", rotate=0):
@@ -294,33 +409,141 @@ class PostScriptSimple:
             rotate: Rotation angle in degrees
         """
         # Escape special characters in PostScript
-        text_string = text_string.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+        text_string = self._escape(text_string)
         
         # Start a new path and move to position
-        self.current_page.append("newpath")
-        self.current_page.append(f"{x} {y} moveto")
+        self._emit("newpath")
+        self._emit(f"{x} {y} moveto")
         
         # Handle rotation
         if rotate != 0:
-            self.current_page.append(f"{rotate} rotate")
+            self._emit(f"{rotate} rotate")
         
         # Handle alignment
         if align == "left":
-            self.current_page.append(f"({text_string}) show")
+            self._emit(f"({text_string}) show")
         elif align == "center" or align == "centre":
-            self.current_page.append(f"({text_string}) dup stringwidth pop 2 div neg 0 rmoveto show")
+            self._emit(f"({text_string}) dup stringwidth pop 2 div neg 0 rmoveto show")
         elif align == "right":
-            self.current_page.append(f"({text_string}) dup stringwidth pop neg 0 rmoveto show")
+            self._emit(f"({text_string}) dup stringwidth pop neg 0 rmoveto show")
             
         # Restore rotation if needed
         if rotate != 0:
-            self.current_page.append(f"{-rotate} rotate")
+            self._emit(f"{-rotate} rotate")
+    
+    @staticmethod
+    def _escape(text_string):
+        """Escape the special characters of a PostScript string"""
+        return text_string.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+    
+    def text_block(self, x, y, lines, spacing, chunk=200, path=False):
+        """Add left aligned lines of text with one procedure call per chunk
+        
+        Much smaller than calling text() for every line: each line is just
+        a string in an array that the textlines procedure walks through.
+        Lines may be any iterable and are consumed as they are written.
+        
+        Args:
+            x, y: Coordinates of the first line
+            lines: Lines of text
+            spacing: Distance between lines (downwards)
+            chunk: Lines per array, keeps the operand stack small
+            path: Add the outlines of the text to a new path instead of
+                painting it, e.g. to clip() to
+            
+        Returns:
+            Number of lines added
+        """
+        procedure = "textpaths" if path else "textlines"
+        if path:
+            self._emit("newpath")
+        count = 0
+        batch = []
+        for line in lines:
+            batch.append(f"({self._escape(line)})")
+            count += 1
+            if len(batch) == chunk:
+                self._emit_block(x, y - (count - len(batch)) * spacing, batch, spacing, procedure)
+                batch = []
+        if batch:
+            self._emit_block(x, y - (count - len(batch)) * spacing, batch, spacing, procedure)
+        return count
+    
+    def _emit_block(self, x, y, strings, spacing, procedure="textlines"):
+        """Add one textlines (or textpaths) call"""
+        self._emit("[" + "\n".join(strings))
+        self._emit(f"] {round(x, 3)} {round(y, 3)} {round(spacing, 3)} {procedure}")
+    
+    def gsave(self):
+        """Save the graphics state (transformation, colour, font, clip)"""
+        self._emit("gsave")
+    
+    def grestore(self):
+        """Restore the graphics state saved by the matching gsave()"""
+        self._emit("grestore")
+    
+    def translate(self, x, y):
+        """Move the origin of the coordinate system to x, y"""
+        self._emit(f"{round(x, 3)} {round(y, 3)} translate")
+    
+    def concat(self, matrix):
+        """Transform the coordinate system by a [a b c d tx ty] matrix"""
+        self._emit("[" + " ".join(str(round(v, 3)) for v in matrix) + "] concat")
+    
+    def pushmatrix(self):
+        """Push the current transformation onto the operand stack"""
+        self._emit("matrix currentmatrix")
+    
+    def popmatrix(self):
+        """Go back to the transformation pushed by pushmatrix()"""
+        self._emit("setmatrix")
+    
+    def clip(self):
+        """Clip to the current path, e.g. text added with text_block(path=True)"""
+        self._emit("clip newpath")
+    
+    def axial_shade(self, x0, y0, x1, y1, colours):
+        """Fill the clip region with a linear gradient (needs LanguageLevel 3)
+        
+        The colours are evenly spaced from x0, y0 to x1, y1 and extend
+        beyond both ends.
+        
+        Args:
+            x0, y0, x1, y1: Start and end of the gradient
+            colours: Two or more r,g,b tuples (0-255)
+        """
+        def rgb(c):
+            return "[" + " ".join(str(round(v / 255, 5)) for v in c) + "]"
+        
+        # One interpolating function per pair of stops, stitched together
+        functions = [f"<< /FunctionType 2 /Domain [0 1] /C0 {rgb(a)} /C1 {rgb(b)} /N 1 >>"
+                     for a, b in zip(colours, colours[1:])]
+        if len(functions) == 1:
+            function = functions[0]
+        else:
+            segments = len(functions)
+            bounds = " ".join(str(round(i / segments, 5)) for i in range(1, segments))
+            function = (f"<< /FunctionType 3 /Domain [0 1] /Functions [{' '.join(functions)}] "
+                        f"/Bounds [{bounds}] /Encode [{' '.join(['0 1'] * segments)}] >>")
+        coords = " ".join(str(round(v, 3)) for v in (x0, y0, x1, y1))
+        self._emit(f"<< /ShadingType 2 /ColorSpace /DeviceRGB /Coords [{coords}] "
+                   f"/Extend [true true] /Function {function} >> shfill")
+    
+    def finish(self):
+        """End a streamed document: close the page and write the trailer"""
+        lines = []
+        if self.page_count and not self.eps:
+            lines.extend(["pagelevel restore", "showpage"])
+        lines.extend(["%%Trailer", "%%EOF"])
+        self._write(lines)
+        self.out.flush()
     
     def output(self, filename):
         """Write the PostScript content to a file
         
         Args:
-            filename: Output filename
+            filename: Output filename, or a binary file-like object such as
+                the stdin pipe of a Ghostscript process
         """
         # Add header if not done already
         if not self.content or not self.content[0].startswith("%!PS"):
@@ -337,651 +560,3177 @@ class PostScriptSimple:
         self.content.append("%%Trailer")
         self.content.append("%%EOF")
         
+        if hasattr(filename, 'write'):
+            for line in self.content:
+                filename.write(f"{line}\n".encode('latin1'))
+            return
+        
         with open(filename, 'w', encoding='latin1') as f:
             for line in self.content:
                 f.write(f"{line}\n")
 
 
-class EffectsProcessor:
-    """Process image effects with Pillow - optimized for performance"""
+class FontMetrics:
+    """String widths and font extents from Adobe Font Metrics (AFM) files
     
-    # Available patterns for backgrounds
-    patterns = [
-        "checkerboard", "dots", "grid", "stripes", "waves", 
-        "zigzag", "crosshatch", "bricks", "diamonds", "bubbles"
+    Used to size the page to the text before rendering. AFM files are looked
+    up in the usual Ghostscript font directories and font aliases (such as
+    Helvetica -> NimbusSans-Regular) are read from Ghostscript's Fontmap
+    files. When no metrics are found a conservative estimate is used so the
+    text is never clipped.
+    """
+    
+    afm_dirs = [
+        "/usr/share/fonts/type1/gsfonts",
+        "/usr/share/fonts/type1/urw-base35",
+        "/usr/share/fonts/urw-base35",
+        "/usr/share/ghostscript/fonts",
+        "/usr/local/share/ghostscript/fonts",
+        "/opt/local/share/ghostscript/fonts",
+        "/opt/homebrew/share/ghostscript/fonts",
     ]
     
-    def __init__(self, debug=False):
-        self.debug = debug
+    fontmap_globs = [
+        "/usr/share/ghostscript/*/Resource/Init/Fontmap.GS",
+        "/usr/local/share/ghostscript/*/Resource/Init/Fontmap.GS",
+        "/opt/local/share/ghostscript/*/Resource/Init/Fontmap.GS",
+        "/opt/homebrew/share/ghostscript/*/Resource/Init/Fontmap.GS",
+    ]
     
-    def _create_pattern_image(self, pattern_name, size, color1, color2, scale=20):
-        """Create a pattern image - optimized for speed
+    # Fallback metrics in em units: wider and taller than any base font
+    default_width = 1.0
+    default_ascent = 1.2
+    default_descent = 0.35
+    
+    _afm_files = None  # FontName -> AFM path
+    _aliases = None    # font alias -> FontName
+    _fonts = {}        # FontName -> metrics dict (or None if unavailable)
+    
+    @classmethod
+    def _scan(cls):
+        """Index the AFM files and Fontmap aliases (once per process)"""
+        cls._afm_files = {}
+        cls._aliases = {}
         
-        Args:
-            pattern_name: Name of the pattern
-            size: (width, height) tuple
-            color1, color2: Colors for the pattern
-            scale: Pattern scale factor
+        dirs = list(cls.afm_dirs)
+        for var in ('GS_FONTPATH', 'GS_LIB'):
+            dirs.extend(p for p in os.environ.get(var, '').split(os.pathsep) if p)
+        
+        for d in dirs:
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for name in names:
+                if not name.lower().endswith('.afm'):
+                    continue
+                path = os.path.join(d, name)
+                try:
+                    with open(path, 'r', encoding='latin1') as f:
+                        for line in f:
+                            if line.startswith('FontName'):
+                                cls._afm_files.setdefault(line.split()[1], path)
+                                break
+                            if line.startswith('StartCharMetrics'):
+                                break
+                except (OSError, IndexError):
+                    continue
+        
+        for pattern in cls.fontmap_globs:
+            for path in glob.glob(pattern):
+                try:
+                    with open(path, 'r', encoding='latin1') as f:
+                        for line in f:
+                            match = re.match(r'\s*/(\S+)\s+/(\S+)\s*;', line)
+                            if match:
+                                cls._aliases.setdefault(match.group(1), match.group(2))
+                except OSError:
+                    continue
+    
+    @classmethod
+    def _load(cls, font):
+        """Return the parsed metrics for a font, or None"""
+        if cls._afm_files is None:
+            cls._scan()
+        
+        # Our re-encoded fonts share the metrics of the base font
+        if font.endswith('-iso'):
+            font = font[:-4]
+        
+        # Follow aliases (a few levels at most)
+        for _ in range(5):
+            if font in cls._afm_files or font not in cls._aliases:
+                break
+            font = cls._aliases[font]
+        
+        if font in cls._fonts:
+            return cls._fonts[font]
+        
+        metrics = None
+        path = cls._afm_files.get(font)
+        if path:
+            widths = {}
+            bbox = None
+            try:
+                with open(path, 'r', encoding='latin1') as f:
+                    for line in f:
+                        if line.startswith('FontBBox'):
+                            bbox = [float(v) for v in line.split()[1:5]]
+                        elif line.startswith('C '):
+                            fields = dict(
+                                item.strip().split(None, 1)
+                                for item in line.split(';') if item.strip()
+                            )
+                            code = int(fields['C'])
+                            if code >= 0:
+                                widths[code] = float(fields['WX']) / 1000
+            except (OSError, ValueError, KeyError):
+                widths = {}
             
-        Returns:
-            PIL Image with the pattern
+            if widths:
+                metrics = {
+                    'widths': widths,
+                    'max_width': max(widths.values()),
+                    'ascent': bbox[3] / 1000 if bbox else cls.default_ascent,
+                    'descent': -bbox[1] / 1000 if bbox else cls.default_descent,
+                }
+        
+        cls._fonts[font] = metrics
+        return metrics
+    
+    @classmethod
+    def string_width(cls, font, text, size):
+        """Width of a string in points
+        
+        Args:
+            font: PostScript font name
+            text: The string
+            size: Font size in points
         """
-        width, height = size
-        img = Image.new('RGBA', size, color1)
-        draw = ImageDraw.Draw(img)
+        metrics = cls._load(font)
+        if metrics is None:
+            return len(text) * cls.default_width * size
         
-        # Adjust scale based on image size for better performance
-        if width > 1000 or height > 1000:
-            scale = max(scale, 30)  # Use larger pattern elements for large images
+        # Characters outside StandardEncoding (e.g. Latin1) get the widest glyph
+        widths = metrics['widths']
+        max_width = metrics['max_width']
+        return sum(widths.get(ord(c), max_width) if ord(c) < 128 else max_width
+                   for c in text) * size
+    
+    @classmethod
+    def extent(cls, font, size):
+        """Return (ascent, descent) of a font in points, both positive"""
+        metrics = cls._load(font)
+        if metrics is None:
+            return cls.default_ascent * size, cls.default_descent * size
+        return metrics['ascent'] * size, metrics['descent'] * size
+
+
+class FontFiles:
+    """Map PostScript font names to font files for the Pillow engine
+    
+    The standard PostScript fonts are mapped to their metric-compatible
+    URW, Liberation or DejaVu substitutes. Other names are matched against
+    the file names of the installed fonts and finally asked of fontconfig.
+    """
+    
+    font_dirs = [
+        "/usr/share/fonts",
+        "/usr/local/share/fonts",
+        "/usr/share/ghostscript/fonts",
+        "/opt/local/share/fonts",
+        "/opt/homebrew/share/fonts",
+        "~/.fonts",
+        "~/.local/share/fonts",
+        "/Library/Fonts",
+        "/System/Library/Fonts",
+        "C:/Windows/Fonts",
+    ]
+    
+    font_suffixes = ('.ttf', '.otf', '.ttc', '.pfb', '.t1')
+    
+    # Substitutes for the standard PostScript fonts, best first (file stems)
+    substitutes = {
+        "Courier": ["NimbusMonoPS-Regular", "n022003l", "LiberationMono-Regular", "DejaVuSansMono"],
+        "Courier-Bold": ["NimbusMonoPS-Bold", "n022004l", "LiberationMono-Bold", "DejaVuSansMono-Bold"],
+        "Courier-Oblique": ["NimbusMonoPS-Italic", "n022023l", "LiberationMono-Italic",
+                            "DejaVuSansMono-Oblique"],
+        "Courier-BoldOblique": ["NimbusMonoPS-BoldItalic", "n022024l", "LiberationMono-BoldItalic",
+                                "DejaVuSansMono-BoldOblique"],
+        "Helvetica": ["NimbusSans-Regular", "n019003l", "LiberationSans-Regular", "DejaVuSans"],
+        "Helvetica-Bold": ["NimbusSans-Bold", "n019004l", "LiberationSans-Bold", "DejaVuSans-Bold"],
+        "Helvetica-Oblique": ["NimbusSans-Italic", "n019023l", "LiberationSans-Italic",
+                              "DejaVuSans-Oblique"],
+        "Helvetica-BoldOblique": ["NimbusSans-BoldItalic", "n019024l", "LiberationSans-BoldItalic",
+                                  "DejaVuSans-BoldOblique"],
+        "Symbol": ["StandardSymbolsPS", "s050000l"],
+        "Times-Roman": ["NimbusRoman-Regular", "n021003l", "LiberationSerif-Regular", "DejaVuSerif"],
+        "Times-Bold": ["NimbusRoman-Bold", "n021004l", "LiberationSerif-Bold", "DejaVuSerif-Bold"],
+        "Times-Italic": ["NimbusRoman-Italic", "n021023l", "LiberationSerif-Italic",
+                         "DejaVuSerif-Italic"],
+        "Times-BoldItalic": ["NimbusRoman-BoldItalic", "n021024l", "LiberationSerif-BoldItalic",
+                             "DejaVuSerif-BoldItalic"],
+    }
+    
+    # Last resort before Pillow's built-in font
+    fallback = ["DejaVuSans", "LiberationSans-Regular", "NimbusSans-Regular", "Arial"]
+    
+    _files = None  # normalised file stem -> path
+    _found = {}    # PostScript name -> path (or None)
+    
+    @staticmethod
+    def _normalise(name):
+        return re.sub(r'[^a-z0-9]', '', name.lower())
+    
+    @classmethod
+    def _scan(cls):
+        """Index the installed font files by name (once per process)"""
+        cls._files = {}
+        for d in cls.font_dirs:
+            for root, _, names in os.walk(os.path.expanduser(d)):
+                for name in names:
+                    stem, ext = os.path.splitext(name)
+                    if ext.lower() in cls.font_suffixes:
+                        cls._files.setdefault(cls._normalise(stem), os.path.join(root, name))
+    
+    @classmethod
+    def _fc_match(cls, font):
+        """Ask fontconfig for a font with exactly this PostScript name"""
+        if not shutil.which("fc-match"):
+            return None
+        try:
+            proc = subprocess.run(["fc-match", "-f", "%{file}\\n%{postscriptname}", f":postscriptname={font}"],
+                                  capture_output=True, text=True, timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        lines = proc.stdout.split('\n')
+        if len(lines) == 2 and lines[1] == font and os.path.exists(lines[0]):
+            return lines[0]
+        return None
+    
+    @classmethod
+    def find(cls, font):
+        """Return the path of a font file for a PostScript font name, or None"""
+        if font.endswith('-iso'):
+            font = font[:-4]
+        if font in cls._found:
+            return cls._found[font]
+        if cls._files is None:
+            cls._scan()
         
-        if pattern_name == "checkerboard":
-            # Checkerboard pattern - optimized by drawing larger rectangles
-            for y in range(0, height, scale*2):
-                for x in range(0, width, scale*2):
-                    draw.rectangle([x, y, x + scale - 1, y + scale - 1], fill=color2)
-                    draw.rectangle([x + scale, y + scale, x + scale*2 - 1, y + scale*2 - 1], fill=color2)
+        path = None
+        for candidate in cls.substitutes.get(font, []) + [font]:
+            path = cls._files.get(cls._normalise(candidate))
+            if path:
+                break
+        if not path:
+            path = cls._fc_match(font)
+        if not path:
+            for candidate in cls.fallback:
+                path = cls._files.get(cls._normalise(candidate))
+                if path:
+                    break
         
-        elif pattern_name == "dots":
-            # Dots pattern - reduced dot count for speed
-            dot_radius = scale // 2
-            dot_spacing = scale * 2
-            for y in range(dot_radius, height, dot_spacing):
-                for x in range(dot_radius, width, dot_spacing):
-                    draw.ellipse([x - dot_radius, y - dot_radius, 
-                                  x + dot_radius, y + dot_radius], fill=color2)
+        cls._found[font] = path
+        return path
+    
+    @classmethod
+    def load(cls, font, size):
+        """Load a font for Pillow at a pixel size"""
+        path = cls.find(font)
+        if path:
+            try:
+                return ImageFont.truetype(path, size)
+            except OSError:
+                pass
+        return ImageFont.load_default(size)
+
+
+class FontIndex:
+    """Index of the font names for lookup, listing and random choice
+    
+    Built from fontlist.txt, fontsuffixlist.txt and the ISO fonts: the base
+    name of every font (style suffixes such as -Bold removed) with its
+    variants, and a case-insensitive name table. The index is saved as JSON
+    next to fontlist.txt, or in the cache directory when that is read-only,
+    and rebuilt when either list changes.
+    """
+    
+    # Bump when the layout of the saved index changes
+    version = 1
+    
+    suffix_file = '/usr/local/share/BIDeT/fontsuffixlist.txt'
+    
+    _loaded = None  # index of this process
+    
+    def __init__(self, data):
+        self.suffixes = data['suffixes']
+        self.fonts = data['fonts']
+        self.isofonts = data['isofonts']
+        self.bases = data['bases']
+        self.iso_bases = data['iso_bases']
+        self.lower = data['lower']
+        self.font_set = set(self.fonts)
+        self.iso_set = set(self.isofonts)
+    
+    @classmethod
+    def index_files(cls):
+        """Candidate locations of the saved index, preferred first"""
+        return [os.path.join(os.path.dirname(PostScriptSimple.fontlist_file), 'fontindex.json'),
+                os.path.join(RenderCache.default_dir(), 'fontindex.json')]
+    
+    @classmethod
+    def sources(cls):
+        """Identify the versions of the lists the index is built from"""
+        sources = {'version': cls.version, 'isofonts': PostScriptSimple.isofonts}
+        for name, path in (('fontlist', PostScriptSimple.fontlist_file), ('suffixes', cls.suffix_file)):
+            try:
+                st = os.stat(path)
+                sources[name] = [path, st.st_mtime_ns, st.st_size]
+            except OSError:
+                sources[name] = None
+        return sources
+    
+    @staticmethod
+    def base_name(font, suffixes):
+        """Remove the longest matching style suffix from a font name"""
+        for suffix in suffixes:
+            if font.endswith(suffix) or font.endswith('-' + suffix):
+                font = font[:-len(suffix)]
+                if font.endswith('-'):
+                    font = font[:-1]
+                break
+        return font
+    
+    @classmethod
+    def build(cls):
+        """Build the index data from the font and suffix lists"""
+        try:
+            with open(cls.suffix_file, 'r') as f:
+                suffixes = [line.strip() for line in f if line.strip()]
+        except FileNotFoundError:
+            suffixes = []
+        suffixes.sort(key=len, reverse=True)
         
-        elif pattern_name == "grid":
-            # Grid pattern - draw fewer lines for speed
-            for y in range(0, height, scale*2):
-                draw.line([(0, y), (width, y)], fill=color2, width=1)
-            for x in range(0, width, scale*2):
-                draw.line([(x, 0), (x, height)], fill=color2, width=1)
+        fonts = PostScriptSimple.ext_fonts()
+        isofonts = PostScriptSimple.isofonts
         
-        elif pattern_name == "stripes":
-            # Stripes pattern - use rectangles for better performance
-            for y in range(0, height, scale*2):
-                draw.rectangle([0, y, width, y + scale - 1], fill=color2)
+        data = {'suffixes': suffixes, 'fonts': fonts, 'isofonts': isofonts,
+                'bases': {}, 'iso_bases': {}, 'lower': {}}
+        for key, names in (('bases', fonts), ('iso_bases', isofonts)):
+            for font in names:
+                data[key].setdefault(cls.base_name(font, suffixes), []).append(font)
+        for font in fonts + isofonts:
+            data['lower'].setdefault(font.lower(), font)
+        return data
+    
+    @classmethod
+    def load(cls, debug=False):
+        """Return the font index, loading or rebuilding the saved one once per process"""
+        if cls._loaded is not None:
+            return cls._loaded
         
-        elif pattern_name == "waves":
-            # Waves pattern - simplified with fewer points
-            for y in range(0, height, scale*2):
-                points = []
-                step = max(1, scale//1)  # Larger step for better performance
-                for x in range(0, width + scale, step):
-                    points.append((x, y + int(math.sin(x * 0.05) * scale/2)))
-                if len(points) > 1:
-                    draw.line(points, fill=color2, width=2)
+        sources = cls.sources()
+        for path in cls.index_files():
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if saved.get('sources') == sources:
+                cls._loaded = cls(saved['data'])
+                return cls._loaded
         
-        elif pattern_name == "zigzag":
-            # Zigzag pattern - simplified
-            for y_offset in range(0, height, scale*2):
-                points = []
-                for x in range(0, width + scale, scale):
-                    y = y_offset + (scale if x % (scale*2) == 0 else 0)
-                    points.append((x, y))
-                if len(points) > 1:
-                    draw.line(points, fill=color2, width=2)
+        data = cls.build()
+        cls._loaded = cls(data)
+        cls._save({'sources': sources, 'data': data}, debug)
+        return cls._loaded
+    
+    @classmethod
+    def _save(cls, saved, debug=False):
+        """Write the index to the first writable location"""
+        for path in cls.index_files():
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                        json.dump(saved, f)
+                    os.replace(temp_path, path)
+                finally:
+                    # Gone after the rename, left behind by a failed write
+                    if os.path.exists(temp_path):
+                        os.unlink(temp_path)
+                if debug:
+                    print(f"Font index saved to {path}", file=sys.stderr)
+                return
+            except OSError:
+                continue
+    
+    def find(self, font, iso=False):
+        """Return the font for a name, a base name or a different case, or None
         
-        elif pattern_name == "crosshatch":
-            # Crosshatch pattern - draw fewer lines
-            step = scale * 2
-            for y in range(-height, height*2, step):
-                draw.line([(0, y), (width, y + width)], fill=color2, width=1)
-                draw.line([(0, y + width), (width, y)], fill=color2, width=1)
+        For a base name the variant with the shortest suffix is picked, as
+        the Perl version does.
+        """
+        def known(name):
+            return name in self.iso_set if iso else (name in self.font_set or name in self.iso_set)
         
-        elif pattern_name == "bricks":
-            # Bricks pattern - simplified
-            brick_height = scale
-            brick_width = scale * 2
-            for y in range(0, height, brick_height*2):
-                # Just draw outlines for speed
-                draw.rectangle([0, y, width, y + brick_height - 1], outline=color2, width=1)
-                draw.rectangle([brick_width//2, y + brick_height, width, y + brick_height*2 - 1], outline=color2, width=1)
+        if known(font):
+            return font
         
-        elif pattern_name == "diamonds":
-            # Diamonds pattern - draw fewer diamonds
-            for y in range(0, height, scale*2):
-                for x in range(0, width, scale*2):
-                    draw.polygon([(x + scale/2, y), (x + scale, y + scale/2), 
-                                   (x + scale/2, y + scale), (x, y + scale/2)], 
-                                 fill=color2)
+        exact = self.lower.get(font.lower())
+        if exact and known(exact):
+            return exact
         
-        elif pattern_name == "bubbles":
-            # Random bubbles pattern - fewer bubbles for speed
-            import random
-            random.seed(0)  # Make it reproducible
-            bubble_count = max(20, width * height // (scale * scale * 10))
-            for _ in range(bubble_count):
-                x = random.randint(0, width)
-                y = random.randint(0, height)
-                radius = random.randint(scale//4, scale//2)
-                draw.ellipse([x - radius, y - radius, x + radius, y + radius], 
-                             fill=color2, outline=color1)
+        variants = [name for name in self.iso_bases.get(font, []) + self.bases.get(font, [])
+                    if known(name)]
+        return min(variants, key=len) if variants else None
+    
+    def nearest(self, font, iso=False):
+        """Return the closest known base or font name to a misspelt one, or None"""
+        import difflib
         
-        return img
+        candidates = list(self.iso_bases) + self.isofonts
+        if not iso:
+            candidates += list(self.bases) + self.fonts
+        matches = difflib.get_close_matches(font, candidates, n=1, cutoff=0.6)
+        return matches[0] if matches else None
     
-    def _get_rgb_color(self, color_name):
-        """Convert color name to RGB tuple - optimized
+    def random(self, iso=False):
+        """Return a random font"""
+        return random.choice(self.isofonts if iso or not self.fonts else self.fonts)
+
+
+class Tracer:
+    """Span-based timing of the rendering pipeline
+    
+    Every stage is a span with its wall time, the peak RSS of the process
+    when it ended and optional attributes such as image dimensions. Spans
+    around subprocesses also record the peak RSS of the children. A
+    disabled tracer costs one attribute check per span.
+    """
+    
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.spans = []
+        self.stack = []
+        self.origin = time.perf_counter()
+    
+    @staticmethod
+    def peak_rss(children=False):
+        """Peak resident set size in KB (0 where unavailable)"""
+        try:
+            import resource
+        except ImportError:
+            return 0
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+        # ru_maxrss is in bytes on macOS and in KB elsewhere
+        return usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+    
+    def begin(self, name, **attrs):
+        """Start a span (nested in the current one)
         
-        Args:
-            color_name: Color name or hex value
-            
         Returns:
-            RGB tuple
+            The span dictionary, or None when disabled
         """
-        # Create a cache for colors if it doesn't exist
-        if not hasattr(self, '_color_cache'):
-            self._color_cache = {}
+        if not self.enabled:
+            return None
+        span = {'name': name, 'depth': len(self.stack)}
+        span.update(attrs)
+        span['start'] = time.perf_counter()
+        self.spans.append(span)
+        self.stack.append(span)
+        return span
+    
+    def end(self, span, img=None, **attrs):
+        """Finish a span
         
-        # Check if color is in cache
-        if color_name in self._color_cache:
-            return self._color_cache[color_name]
+        Args:
+            span: Span returned by begin
+            img: Optional PIL Image whose dimensions are recorded
+            attrs: Further attributes to record
+        """
+        if span is None:
+            return
+        span['ms'] = round((time.perf_counter() - span['start']) * 1000, 3)
+        span['start_ms'] = round((span.pop('start') - self.origin) * 1000, 3)
+        if img is not None:
+            span['width'], span['height'] = img.size
+            span['mode'] = img.mode
+        span.update(attrs)
+        span['peak_rss_kb'] = self.peak_rss()
+        if span.get('subprocess'):
+            span['child_peak_rss_kb'] = self.peak_rss(children=True)
+        while self.stack and self.stack.pop() is not span:
+            pass
+    
+    def record(self, **attrs):
+        """Return one JSON-serialisable record of the run"""
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'pid': os.getpid()}
+        record.update(attrs)
+        record['total_ms'] = round((time.perf_counter() - self.origin) * 1000, 3)
+        record['peak_rss_kb'] = self.peak_rss()
+        record['spans'] = [span for span in self.spans if 'ms' in span]
+        return record
+    
+    def summary(self):
+        """Return the spans as an indented text table"""
+        lines = []
+        for span in self.spans:
+            if 'ms' not in span:
+                continue
+            label = '  ' * span['depth'] + span['name']
+            extra = [f"{k}={v}" for k, v in span.items()
+                     if k not in ('name', 'depth', 'ms', 'start_ms', 'peak_rss_kb', 'child_peak_rss_kb',
+                                  'subprocess')]
+            if 'width' in span:
+                extra = [e for e in extra if not e.startswith(('width=', 'height=', 'mode='))]
+                extra.insert(0, f"{span['width']}x{span['height']} {span['mode']}")
+            if 'child_peak_rss_kb' in span:
+                extra.append(f"child rss {span['child_peak_rss_kb'] // 1024} MB")
+            lines.append(f"{label:<28} {span['ms']:9.2f} ms  rss {span['peak_rss_kb'] // 1024:4d} MB  "
+                         + " ".join(extra))
+        total = (time.perf_counter() - self.origin) * 1000
+        lines.append(f"{'total':<28} {total:9.2f} ms  rss {self.peak_rss() // 1024:4d} MB")
+        return "\n".join(lines)
+
+
+class GhostscriptWorker:
+    """A long-lived Ghostscript interpreter that renders pages fed over a pipe
+    
+    The prolog is loaded once when the interpreter starts. Each job is then
+    sent on stdin wrapped in save/restore, the PNG comes back on stdout and a
+    status line is printed on stderr (gs is started with -sstdout=%stderr so
+    PostScript output never mixes with the image data).
+    """
+    
+    def __init__(self, prolog, max_jobs=100, timeout=30, debug=False):
+        self.prolog = prolog
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self.debug = debug
+        self.proc = None
+        self.jobs = 0
+        self.restarts = 0
+    
+    @property
+    def alive(self):
+        """True if the interpreter process is running"""
+        return self.proc is not None and self.proc.poll() is None
+    
+    def start(self):
+        """Start (or restart) the interpreter and load the prolog"""
+        if self.proc is not None:
+            self.close()
+            self.restarts += 1
         
-        if color_name in PostScriptSimple.pscolours:
-            rgb = tuple(PostScriptSimple.pscolours[color_name])
-            self._color_cache[color_name] = rgb
-            return rgb
+        gs_cmd = ["gs", "-q", "-sstdout=%stderr"] + EffectsProcessor.gs_options + [
+            f"-r{EffectsProcessor.resolution}",
+            "-sOutputFile=%stdout",
+            "-"
+        ]
         
+        if self.debug:
+            print(f"Starting: {' '.join(gs_cmd)}", file=sys.stderr)
+        
+        self.proc = subprocess.Popen(gs_cmd, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     bufsize=0)
+        self.jobs = 0
+        
+        # Load the prolog and wait until the interpreter has digested it
+        self._send(self.prolog + "(\\nBIDeT-READY\\n) print flush\n")
+        status, _ = self._read_reply(lambda line: line == "BIDeT-READY", expect_png=False)
+        if status is None:
+            self.close()
+            raise RuntimeError("Ghostscript worker failed to start")
+    
+    def close(self):
+        """Stop the interpreter"""
+        if self.proc is None:
+            return
         try:
-            # Try to parse as hex color
-            rgb = ImageColor.getrgb(color_name)
-            self._color_cache[color_name] = rgb
-            return rgb
-        except:
-            print(f"Warning: Unknown color '{color_name}', using black", file=sys.stderr)
-            self._color_cache[color_name] = (0, 0, 0)
-            return (0, 0, 0)
+            self.proc.stdin.close()
+            self.proc.wait(timeout=2)
+        except Exception:
+            self.proc.kill()
+            self.proc.wait()
+        for pipe in (self.proc.stdout, self.proc.stderr):
+            pipe.close()
+        self.proc = None
     
-    def _make_transparent_background(self, img):
-        """Make the white background transparent - optimized for speed
+    def render(self, width, height, body, resolution=None):
+        """Render one page
         
         Args:
-            img: PIL Image
+            width, height: Page size in points
+            body: PostScript drawing commands for the page (no prolog)
+            resolution: Resolution in dots per inch (default: EffectsProcessor.resolution)
             
         Returns:
-            PIL Image with transparent background
+            PNG data as bytes
         """
-        # Only convert if needed
-        if img.mode != "RGBA":
-            img = img.convert("RGBA")
-            
-        # Process only if image is large
-        if img.width > 500 or img.height > 500:
-            # Use numpy for faster processing if available
-            try:
-                import numpy as np
-                data = np.array(img)
-                # Create an alpha mask where white pixels are transparent
-                mask = ((data[:,:,0] > 240) & 
-                        (data[:,:,1] > 240) & 
-                        (data[:,:,2] > 240))
-                data[mask, 3] = 0
-                return Image.fromarray(data)
-            except ImportError:
-                pass
+        resolution = resolution or EffectsProcessor.resolution
+        # Recycle the interpreter after max_jobs or if it has died
+        if not self.alive or self.jobs >= self.max_jobs:
+            self.start()
         
-        # Fallback to the standard method
-        datas = img.getdata()
-        new_data = []
-        for item in datas:
-            # Change all white (or nearly white) pixels to transparent
-            if item[0] > 240 and item[1] > 240 and item[2] > 240:
-                new_data.append((255, 255, 255, 0))
+        self.jobs += 1
+        job_id = self.jobs
+        
+        # setpagedevice also erases the page and resets the graphics state,
+        # so nothing left over from a failed job can leak into this one
+        job = (
+            f"<< /PageSize [{width} {height}] /HWResolution [{resolution} {resolution}] >> setpagedevice\n"
+            "/bidet_job save def\n"
+            "{\n"
+            f"{body}"
+            "showpage\n"
+            "} stopped\n"
+            "{ clear cleardictstack bidet_job restore "
+            f"(\\nBIDeT-DONE {job_id} ERR ) print $error /errorname get =only (\\n) print }}\n"
+            f"{{ bidet_job restore (\\nBIDeT-DONE {job_id} OK\\n) print }} ifelse flush\n"
+        )
+        
+        try:
+            self._send(job)
+        except OSError:
+            self.close()
+            raise RuntimeError("Ghostscript worker died")
+        
+        prefix = f"BIDeT-DONE {job_id} "
+        status, png = self._read_reply(lambda line: line.startswith(prefix))
+        if status is None:
+            self.close()
+            raise RuntimeError("Ghostscript worker died")
+        
+        status = status[len(prefix):]
+        if status != "OK":
+            raise RuntimeError(f"Ghostscript error: {status}")
+        return png
+    
+    def _send(self, data):
+        """Write PostScript to the interpreter"""
+        self.proc.stdin.write(data.encode('latin1'))
+    
+    def _read_reply(self, is_status, expect_png=True):
+        """Collect stdout and stderr until the status line (and PNG) arrive
+        
+        Both pipes are read together so a large PNG can never block the
+        interpreter while we wait for the status line.
+        
+        Returns:
+            (status line, PNG bytes) or (None, None) on EOF or timeout
+        """
+        out = bytearray()
+        err = bytearray()
+        status = None
+        deadline = time.time() + self.timeout
+        
+        with selectors.DefaultSelector() as sel:
+            sel.register(self.proc.stdout, selectors.EVENT_READ, out)
+            sel.register(self.proc.stderr, selectors.EVENT_READ, err)
+            
+            while True:
+                if status is not None:
+                    if not expect_png or not status.endswith(" OK"):
+                        return status, None
+                    png_len = _png_length(out)
+                    if png_len:
+                        return status, bytes(out[:png_len])
+                
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None, None
+                
+                for key, _ in sel.select(remaining):
+                    chunk = os.read(key.fileobj.fileno(), 65536)
+                    if not chunk:
+                        return None, None
+                    key.data.extend(chunk)
+                
+                # Scan complete stderr lines for the status line
+                while status is None and b"\n" in err:
+                    line, _, rest = err.partition(b"\n")
+                    err[:] = rest
+                    line = line.decode('latin1').strip()
+                    if is_status(line):
+                        status = line
+                    elif line and self.debug:
+                        print(f"gs: {line}", file=sys.stderr)
+
+
+def _png_length(data):
+    """Return the length of the complete PNG at the start of data, or 0"""
+    pos = 8
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        chunk_type = bytes(data[pos + 4:pos + 8])
+        pos += 12 + length
+        if pos > len(data):
+            return 0
+        if chunk_type == b"IEND":
+            return pos
+    return 0
+
+
+class GhostscriptPool:
+    """Pool of long-lived Ghostscript interpreters
+    
+    Avoids paying interpreter startup and prolog/font loading for every
+    render. Workers are started lazily, recycled after max_jobs renders and
+    restarted transparently if they crash.
+    """
+    
+    def __init__(self, size=2, max_jobs=100, reencode="ISOLatin1Encoding", debug=False):
+        self.size = size
+        self.max_jobs = max_jobs
+        self.debug = debug
+        self.prolog = PostScriptSimple(reencode=reencode).prolog()
+        self.idle = queue.Queue()
+        self.workers = []
+        self.lock = threading.Lock()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def _acquire(self):
+        """Get an idle worker, starting a new one if the pool is not full"""
+        with self.lock:
+            if self.idle.empty() and len(self.workers) < self.size:
+                worker = GhostscriptWorker(self.prolog, self.max_jobs, debug=self.debug)
+                self.workers.append(worker)
+                return worker
+        return self.idle.get()
+    
+    def render(self, ps, resolution=None):
+        """Render the current page of a PostScriptSimple document
+        
+        Args:
+            ps: PostScriptSimple document
+            resolution: Resolution in dots per inch (default: EffectsProcessor.resolution)
+            
+        Returns:
+            PIL Image as produced by Ghostscript
+        """
+        worker = self._acquire()
+        try:
+            try:
+                png = worker.render(ps.width, ps.height, ps.page_body(), resolution)
+            except RuntimeError as e:
+                # Retry once on a fresh interpreter if the worker crashed
+                if worker.alive:
+                    raise
+                if self.debug:
+                    print(f"Restarting Ghostscript worker: {e}", file=sys.stderr)
+                png = worker.render(ps.width, ps.height, ps.page_body(), resolution)
+        finally:
+            self.idle.put(worker)
+        
+        img = Image.open(io.BytesIO(png))
+        img.load()
+        return img
+    
+    def close(self):
+        """Stop all workers"""
+        with self.lock:
+            for worker in self.workers:
+                worker.close()
+            self.workers = []
+            self.idle = queue.Queue()
+
+
+class EffectsProcessor:
+    """Process image effects with Pillow - optimized for performance"""
+    
+    # Available patterns for backgrounds
+    patterns = [
+        "checkerboard", "dots", "grid", "stripes", "waves", 
+        "zigzag", "crosshatch", "bricks", "diamonds", "bubbles"
+    ]
+    
+    # Output resolution in dots per inch (both engines). This is the upper
+    # limit, renders for a narrower output use less (see BIDeT.output_resolution)
+    resolution = 150
+    
+    # Lowest resolution picked for a narrow output
+    min_resolution = 18
+    
+    # Ghostscript rendering options shared by one-shot and pooled renders
+    # (the resolution is passed separately with -r)
+    gs_options = [
+        "-dSAFER",
+        "-dBATCH",
+        "-dNOPAUSE",
+        "-dGraphicsAlphaBits=4",  # Reduce antialiasing for speed
+        "-dTextAlphaBits=4",      # Reduce antialiasing for speed
+        "-sDEVICE=pngalpha",
+    ]
+    
+    # Device for coverage renders (black text on white, inverted on decode)
+    coverage_device = "-sDEVICE=pnggray"
+    
+    # Length of one wave of the "waves" pattern in pixels
+    wave_length = 126
+    
+    # Pattern tiles shared by all instances, keyed by (pattern, scale, color1, color2)
+    tile_cache_size = 32
+    _tile_cache = OrderedDict()
+    _tile_lock = threading.Lock()
+    
+    def __init__(self, debug=False, gs_pool=None, sixel_encoder='native',
+                 ansi_encoder='native', ansi_colors='auto', white_key=False, tracer=None):
+        self.debug = debug
+        self.tracer = tracer or Tracer()
+        self.white_key = white_key
+        self.gs_pool = gs_pool
+        self.sixel_encoder = sixel_encoder
+        self.ansi_encoder = ansi_encoder
+        self.ansi_colors = ansi_colors
+    
+    @property
+    def native_sixel(self):
+        """True if Sixel output is encoded in-process"""
+        return self.sixel_encoder == 'native' and SixelEncoder.available()
+    
+    @property
+    def native_ansi(self):
+        """True if ANSI output is rendered in-process"""
+        return self.ansi_encoder == 'native' and AnsiRenderer.available()
+    
+    def _create_pattern_image(self, pattern_name, size, color1, color2, scale=20):
+        """Create a pattern image by repeating one period of the pattern
+        
+        Args:
+            pattern_name: Name of the pattern
+            size: (width, height) tuple
+            color1, color2: Colors for the pattern
+            scale: Pattern scale factor
+            
+        Returns:
+            PIL Image with the pattern
+        """
+        scale = max(1, scale)
+        width, height = size
+        
+        # A tile is drawn on 3x3 periods; when that is more than the canvas
+        # (a large scale on a small banner) draw on the canvas directly
+        period_w, period_h = self._pattern_period(pattern_name, scale)
+        if period_w * period_h * 9 > width * height:
+            return self._draw_pattern(pattern_name, size, color1, color2, scale)
+        
+        tile = self._pattern_tile(pattern_name, color1, color2, scale)
+        
+        # Fill one row, then the whole canvas, doubling the copied area each
+        # time so the number of paste calls is logarithmic in the canvas size
+        row = Image.new('RGBA', (width, tile.height))
+        row.paste(tile, (0, 0))
+        filled = tile.width
+        while filled < width:
+            row.paste(row.crop((0, 0, filled, tile.height)), (filled, 0))
+            filled *= 2
+        
+        img = Image.new('RGBA', size)
+        img.paste(row, (0, 0))
+        filled = tile.height
+        while filled < height:
+            img.paste(img.crop((0, 0, width, filled)), (0, filled))
+            filled *= 2
+        return img
+    
+    def _pattern_period(self, pattern_name, scale):
+        """Return the (width, height) of one period of a pattern"""
+        if pattern_name == "waves":
+            return self.wave_length, scale * 2
+        if pattern_name == "bubbles":
+            # Not periodic: use a tile large enough that the repeat is not obvious
+            side = min(max(scale * 16, 128), 512)
+            return side, side
+        return scale * 2, scale * 2
+    
+    def _pattern_tile(self, pattern_name, color1, color2, scale):
+        """Return one seamless period of a pattern, cached
+        
+        The pattern is drawn on a 3x3 block of periods and the centre period
+        is cut out, so elements that cross a tile edge wrap around correctly.
+        """
+        key = (pattern_name, scale, color1, color2)
+        with self._tile_lock:
+            tile = self._tile_cache.get(key)
+            if tile is not None:
+                self._tile_cache.move_to_end(key)
+                return tile
+        
+        period_w, period_h = self._pattern_period(pattern_name, scale)
+        block = self._draw_pattern(pattern_name, (period_w * 3, period_h * 3), color1, color2, scale)
+        tile = block.crop((period_w, period_h, period_w * 2, period_h * 2))
+        
+        with self._tile_lock:
+            self._tile_cache[key] = tile
+            while len(self._tile_cache) > self.tile_cache_size:
+                self._tile_cache.popitem(last=False)
+        return tile
+    
+    def _draw_pattern(self, pattern_name, size, color1, color2, scale):
+        """Draw a pattern element by element onto a canvas
+        
+        Only used on a small block to build a tile. Every pattern repeats
+        with the period given by _pattern_period.
+        
+        Args:
+            pattern_name: Name of the pattern
+            size: (width, height) tuple
+            color1, color2: Colors for the pattern
+            scale: Pattern scale factor
+            
+        Returns:
+            PIL Image with the pattern
+        """
+        width, height = size
+        img = Image.new('RGBA', size, color1)
+        draw = ImageDraw.Draw(img)
+        
+        if pattern_name == "checkerboard":
+            # Checkerboard pattern
+            for y in range(0, height, scale*2):
+                for x in range(0, width, scale*2):
+                    draw.rectangle([x, y, x + scale - 1, y + scale - 1], fill=color2)
+                    draw.rectangle([x + scale, y + scale, x + scale*2 - 1, y + scale*2 - 1], fill=color2)
+        
+        elif pattern_name == "dots":
+            # Dots pattern
+            dot_radius = scale // 2
+            dot_spacing = scale * 2
+            for y in range(dot_radius, height, dot_spacing):
+                for x in range(dot_radius, width, dot_spacing):
+                    draw.ellipse([x - dot_radius, y - dot_radius, 
+                                  x + dot_radius, y + dot_radius], fill=color2)
+        
+        elif pattern_name == "grid":
+            # Grid pattern
+            for y in range(0, height, scale*2):
+                draw.line([(0, y), (width, y)], fill=color2, width=1)
+            for x in range(0, width, scale*2):
+                draw.line([(x, 0), (x, height)], fill=color2, width=1)
+        
+        elif pattern_name == "stripes":
+            # Stripes pattern
+            for y in range(0, height, scale*2):
+                draw.rectangle([0, y, width, y + scale - 1], fill=color2)
+        
+        elif pattern_name == "waves":
+            # Waves pattern - one whole sine period every wave_length pixels
+            for y in range(0, height, scale*2):
+                points = []
+                for x in range(0, width + 2, 2):
+                    offset = math.sin(2 * math.pi * x / self.wave_length) * scale / 2
+                    points.append((x, y + int(offset)))
+                draw.line(points, fill=color2, width=2)
+        
+        elif pattern_name == "zigzag":
+            # Zigzag pattern
+            for y_offset in range(0, height, scale*2):
+                points = []
+                for x in range(0, width + scale, scale):
+                    y = y_offset + (scale if x % (scale*2) == 0 else 0)
+                    points.append((x, y))
+                if len(points) > 1:
+                    draw.line(points, fill=color2, width=2)
+        
+        elif pattern_name == "crosshatch":
+            # Crosshatch pattern
+            step = scale * 2
+            for y in range(-height, height*2, step):
+                draw.line([(0, y), (width, y + width)], fill=color2, width=1)
+                draw.line([(0, y + width), (width, y)], fill=color2, width=1)
+        
+        elif pattern_name == "bricks":
+            # Bricks pattern - every other row is offset by half a brick
+            brick_height = scale
+            brick_width = scale * 2
+            for y in range(0, height, brick_height*2):
+                for row, shift in ((y, 0), (y + brick_height, brick_width // 2)):
+                    for x in range(-shift, width, brick_width):
+                        draw.rectangle([x, row, x + brick_width - 1, row + brick_height - 1],
+                                       outline=color2, width=1)
+        
+        elif pattern_name == "diamonds":
+            # Diamonds pattern
+            for y in range(0, height, scale*2):
+                for x in range(0, width, scale*2):
+                    draw.polygon([(x + scale/2, y), (x + scale, y + scale/2), 
+                                   (x + scale/2, y + scale), (x, y + scale/2)], 
+                                 fill=color2)
+        
+        elif pattern_name == "bubbles":
+            # Random bubbles, repeated in every period of the block so the
+            # centre tile wraps seamlessly; the cost is bounded by the tile size
+            rng = random.Random(0)  # Make it reproducible
+            period_w, period_h = self._pattern_period(pattern_name, scale)
+            bubble_count = max(20, period_w * period_h // (scale * scale * 10))
+            for _ in range(bubble_count):
+                x = rng.randrange(period_w)
+                y = rng.randrange(period_h)
+                radius = rng.randint(scale//4, max(scale//4, scale//2))
+                for oy in range(0, height, period_h):
+                    for ox in range(0, width, period_w):
+                        draw.ellipse([ox + x - radius, oy + y - radius,
+                                      ox + x + radius, oy + y + radius],
+                                     fill=color2, outline=color1)
+        
+        return img
+    
+    def _get_rgb_color(self, color_name):
+        """Convert color name to RGB tuple - optimized
+        
+        Args:
+            color_name: Color name or hex value
+            
+        Returns:
+            RGB tuple
+        """
+        # Create a cache for colors if it doesn't exist
+        if not hasattr(self, '_color_cache'):
+            self._color_cache = {}
+        
+        # Check if color is in cache
+        if color_name in self._color_cache:
+            return self._color_cache[color_name]
+        
+        if color_name in PostScriptSimple.pscolours:
+            rgb = tuple(PostScriptSimple.pscolours[color_name])
+            self._color_cache[color_name] = rgb
+            return rgb
+        
+        if color_name.startswith('#') and len(color_name) == 13:
+            # 48-bit hex as reported by the terminal, e.g. #ffff0000ffff
+            rgb = tuple(int(color_name[i:i + 4], 16) // 257 for i in (1, 5, 9))
+            self._color_cache[color_name] = rgb
+            return rgb
+        
+        try:
+            # Try to parse as hex color
+            rgb = ImageColor.getrgb(color_name)
+            self._color_cache[color_name] = rgb
+            return rgb
+        except:
+            print(f"Warning: Unknown color '{color_name}', using black", file=sys.stderr)
+            self._color_cache[color_name] = (0, 0, 0)
+            return (0, 0, 0)
+    
+    def _make_transparent_background(self, img):
+        """Make the white background transparent (white-keying)
+        
+        Only needed when the renderer gives no usable alpha channel, or when
+        explicitly asked for. Works on whole bands, never pixel by pixel.
+        
+        Args:
+            img: PIL Image
+            
+        Returns:
+            PIL Image with transparent background
+        """
+        # Only convert if needed
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+        
+        # Use numpy for faster processing if available
+        try:
+            import numpy as np
+            data = np.array(img)
+            # Create an alpha mask where white pixels are transparent
+            mask = ((data[:,:,0] > 240) & 
+                    (data[:,:,1] > 240) & 
+                    (data[:,:,2] > 240))
+            data[mask, 3] = 0
+            return Image.fromarray(data)
+        except ImportError:
+            pass
+        
+        # Fallback to band operations: 255 where a channel is nearly white
+        r, g, b, a = img.split()
+        near_white = [band.point(lambda v: 255 if v > 240 else 0) for band in (r, g, b)]
+        mask = ImageChops.multiply(ImageChops.multiply(near_white[0], near_white[1]), near_white[2])
+        a = ImageChops.subtract(a, mask)
+        return Image.merge('RGBA', (r, g, b, a))
+    
+    def _gs_device_options(self, coverage=False):
+        """The Ghostscript options, with the gray device for coverage renders"""
+        if not coverage:
+            return self.gs_options
+        return [self.coverage_device if o.startswith("-sDEVICE=") else o for o in self.gs_options]
+    
+    def render_ps_to_image(self, ps_file, resolution=None, coverage=False):
+        """Render PostScript to PNG using Ghostscript - optimized for speed
+        
+        Args:
+            ps_file: PostScript file
+            resolution: Resolution in dots per inch (default: self.resolution)
+            coverage: Return the text coverage as an 'L' mask (the text
+                must be drawn in black)
+            
+        Returns:
+            PIL Image
+        """
+        # Create a temporary file for the output
+        temp_png = f"{ps_file}.png"
+        
+        # Use Ghostscript to render the PS to PNG with optimized settings
+        gs_cmd = ["gs"] + self._gs_device_options(coverage) + [f"-r{resolution or self.resolution}",
+                                             f"-sOutputFile={temp_png}", ps_file]
+        
+        if self.debug:
+            print(f"Running: {' '.join(gs_cmd)}", file=sys.stderr)
+        
+        span = self.tracer.begin('gs', subprocess=True)
+        proc = subprocess.run(gs_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.tracer.end(span)
+        
+        if proc.returncode != 0:
+            print(f"Error: Failed to render PostScript: {proc.stderr.decode()}", file=sys.stderr)
+            sys.exit(1)
+            
+        # Load the PNG data into PIL
+        try:
+            span = self.tracer.begin('decode')
+            img = Image.open(temp_png)
+            img.load()
+            self.tracer.end(span, img)
+            img = self._finish_render(img, coverage)
+            
+            # Clean up the temporary PNG file unless in debug mode
+            if not self.debug and os.path.exists(temp_png):
+                os.unlink(temp_png)
+                
+            return img
+            
+        except Exception as e:
+            print(f"Error: Failed to process image: {e}", file=sys.stderr)
+            sys.exit(1)
+    
+    def render_ps_stream(self, write, resolution=None, coverage=False):
+        """Render PostScript through pipes only
+        
+        The PostScript is written straight into the stdin of gs while the
+        PNG is read back from its stdout, so no files are created and the
+        document never has to be held in memory as a whole.
+        
+        Args:
+            write: Function called with the binary stdin of gs to write the
+                document, e.g. a streaming build_document(); a finished
+                PostScriptSimple document is also accepted
+            resolution: Resolution in dots per inch (default: self.resolution)
+            coverage: Return the text coverage as an 'L' mask
+            
+        Returns:
+            PIL Image
+        """
+        gs_cmd = ["gs", "-q", "-sstdout=%stderr"] + self._gs_device_options(coverage) + [
+            f"-r{resolution or self.resolution}", "-sOutputFile=%stdout", "-"]
+        
+        if self.debug:
+            print(f"Running: {' '.join(gs_cmd)}", file=sys.stderr)
+        
+        if isinstance(write, PostScriptSimple):
+            write = write.output
+        
+        span = self.tracer.begin('gs', subprocess=True)
+        proc = subprocess.Popen(gs_cmd, stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Drain both outputs while writing so gs can never block on a full pipe
+        output = {}
+        readers = [threading.Thread(target=lambda name, f: output.__setitem__(name, f.read()),
+                                    args=(name, f), daemon=True)
+                   for name, f in (('stdout', proc.stdout), ('stderr', proc.stderr))]
+        for reader in readers:
+            reader.start()
+        try:
+            write(proc.stdin)
+        except BrokenPipeError:
+            pass  # gs gave up early, its stderr says why
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        for reader in readers:
+            reader.join()
+        proc.stdout.close()
+        proc.stderr.close()
+        proc.wait()
+        png = output.get('stdout', b'')
+        self.tracer.end(span, png_bytes=len(png))
+        
+        if proc.returncode != 0 or not png:
+            print(f"Error: Failed to render PostScript: {output.get('stderr', b'').decode()}",
+                  file=sys.stderr)
+            sys.exit(1)
+        
+        try:
+            span = self.tracer.begin('decode')
+            img = Image.open(io.BytesIO(png))
+            img.load()
+            self.tracer.end(span, img)
+            return self._finish_render(img, coverage)
+        except Exception as e:
+            print(f"Error: Failed to process image: {e}", file=sys.stderr)
+            sys.exit(1)
+    
+    def render_ps_document(self, ps, resolution=None, coverage=False):
+        """Render a PostScriptSimple document using the Ghostscript pool
+        
+        Args:
+            ps: PostScriptSimple document
+            resolution: Resolution in dots per inch (default: self.resolution)
+            coverage: Return the text coverage as an 'L' mask (the pool
+                renders RGBA, its alpha channel is kept)
+            
+        Returns:
+            PIL Image
+        """
+        span = self.tracer.begin('gs', pool=True)
+        try:
+            img = self.gs_pool.render(ps, resolution or self.resolution)
+            self.tracer.end(span, img)
+        except RuntimeError as e:
+            print(f"Error: Failed to render PostScript: {e}", file=sys.stderr)
+            sys.exit(1)
+        return self._finish_render(img, coverage)
+    
+    def _finish_render(self, img, coverage=False):
+        """Crop a Ghostscript render to the text and add padding
+        
+        Args:
+            img: PIL Image as produced by Ghostscript
+            coverage: Turn the render into an 'L' coverage mask first
+            
+        Returns:
+            PIL Image
+        """
+        if coverage:
+            # Alpha of a pngalpha render, or black on white from pnggray
+            span = self.tracer.begin('coverage')
+            if img.mode == 'RGBA':
+                img = img.getchannel('A')
+            else:
+                img = ImageOps.invert(img.convert('L'))
+            self.tracer.end(span, img)
+        
+        # pngalpha already gives a transparent background - key out white
+        # only when asked to or when there is no alpha channel
+        elif self.white_key or img.mode != 'RGBA':
+            span = self.tracer.begin('white_key')
+            img = self._make_transparent_background(img)
+            self.tracer.end(span, img)
+        
+        span = self.tracer.begin('crop')
+        img = self._crop_and_pad(img)
+        self.tracer.end(span, img)
+        return img
+    
+    def _crop_and_pad(self, img):
+        """Crop to the non-transparent pixels and add padding
+        
+        Args:
+            img: PIL Image, RGBA or an 'L' coverage mask (kept as one)
+            
+        Returns:
+            PIL Image
+        """
+        # Auto-crop the image to the bounding box of the alpha channel
+        if img.mode in ('RGBA', 'L'):
+            bbox = (img.getchannel('A') if img.mode == 'RGBA' else img).getbbox()
+            if bbox:
+                img = img.crop(bbox)
+        else:
+            img = img.convert('RGBA')
+        
+        # Add a small padding - a plain copy, the canvas is transparent anyway
+        padding = 10
+        padded_size = (img.width + padding*2, img.height + padding*2)
+        padded_img = Image.new(img.mode, padded_size, 0 if img.mode == 'L' else (255, 255, 255, 0))
+        padded_img.paste(img, (padding, padding))
+        return padded_img
+    
+    def render_text_pillow(self, text_lines, font, size, line, colour, resolution=None, coverage=False):
+        """Render text straight into an RGBA image with Pillow/FreeType
+        
+        Lays the lines out like the PostScript engine does, at the same
+        resolution, without running Ghostscript.
+        
+        Args:
+            text_lines: Lines of text
+            font: PostScript font name
+            size: Font size in points
+            line: Line spacing factor
+            colour: Text colour name or hex value
+            resolution: Resolution in dots per inch (default: self.resolution)
+            coverage: Draw an 'L' coverage mask instead (colour is ignored)
+            
+        Returns:
+            PIL Image
+        """
+        scale = (resolution or self.resolution) / 72
+        pil_font = FontFiles.load(font, max(1, round(size * scale)))
+        
+        if self.debug:
+            print(f"Pillow engine font: {FontFiles.find(font) or 'built-in'}", file=sys.stderr)
+        
+        line_spacing = size * line * scale
+        margin = round(10 * scale)
+        ascent, descent = pil_font.getmetrics()
+        width = max((pil_font.getlength(text) for text in text_lines), default=0)
+        size_px = (
+            math.ceil(width + ascent / 4) + margin * 2,
+            math.ceil((len(text_lines) - 1) * line_spacing + ascent + descent) + margin * 2
+        )
+        
+        if coverage:
+            img = Image.new('L', size_px, 0)
+            fill = 255
+        else:
+            img = Image.new('RGBA', size_px, (255, 255, 255, 0))
+            fill = self._get_rgb_color(colour) + (255,)
+        draw = ImageDraw.Draw(img)
+        
+        y_position = margin + ascent
+        for text in text_lines:
+            draw.text((margin, y_position), text, font=pil_font, fill=fill, anchor='ls')
+            y_position += line_spacing
+        
+        # The background is already transparent, no white-keying needed
+        return self._crop_and_pad(img)
+    
+    def _extrude(self, mask, offset, color):
+        """Create a 3D extrusion shadow with one layer per pixel of offset
+        
+        Layer i is the mask moved by (i, i) with i/offset of the shadow
+        alpha, nearer layers on top. A pixel therefore shows the nearest
+        layer covering it, which is its distance back along the diagonal
+        to the text. That distance comes from one running maximum over the
+        whole image, so the cost does not depend on the offset.
+        
+        Args:
+            mask: Alpha mask of the text ('L' image)
+            offset: Depth of the extrusion in pixels
+            color: RGBA colour of the farthest layer
+            
+        Returns:
+            RGBA PIL Image, offset pixels larger than the mask both ways
+        """
+        size = (mask.width + offset, mask.height + offset)
+        
+        try:
+            import numpy as np
+            covered = np.zeros((size[1], size[0]), dtype=bool)
+            covered[:mask.height, :mask.width] = np.asarray(mask) > 127
+            
+            # Distance to the nearest covered pixel up and to the left along
+            # the diagonal (offset + 1 where there is none within reach).
+            # In rows of width + 1 of the flattened image every diagonal
+            # step is one row up in the same column, so the last covered
+            # step is a running maximum down the columns. A diagonal that
+            # wraps around the left edge continues in the offset empty
+            # columns on the right, which ends it before it reaches text.
+            limit = offset + 1
+            n = covered.size
+            step = size[0] + 1
+            steps = -(-n // step)
+            flat = np.zeros(steps * step, dtype=bool)
+            flat[:n] = covered.reshape(-1)
+            index = np.arange(steps, dtype=np.int32)[:, None]
+            last = np.where(flat.reshape(steps, step), index, -limit)
+            np.maximum.accumulate(last, axis=0, out=last)
+            distance = np.full((steps, step), limit, dtype=np.int32)
+            np.minimum(index[1:] - last[:-1], limit, out=distance[1:])
+            distance = distance.reshape(-1)[:n].reshape(covered.shape)
+            
+            alpha = np.where(distance <= offset,
+                             distance * color[3] // max(1, offset), 0).astype(np.uint8)
+            shadow = Image.new('RGBA', size, color[:3] + (0,))
+            shadow.putalpha(Image.fromarray(alpha))
+            return shadow
+        except ImportError:
+            pass
+        
+        # Fallback: paste the layers into the alpha channel from back to front
+        mask = mask.point(lambda v: 255 if v > 127 else 0)
+        alpha = Image.new('L', size, 0)
+        for i in range(offset, 0, -1):
+            alpha.paste(color[3] * i // offset, (i, i, i + mask.width, i + mask.height), mask)
+        shadow = Image.new('RGBA', size, color[:3] + (0,))
+        shadow.putalpha(alpha)
+        return shadow
+    
+    def _soft_shadow(self, mask, offset, blur, color):
+        """Create a blurred drop shadow
+        
+        The mask is shrunk before blurring and the blur scaled back up, so
+        the blur runs with a small radius on a small image however large
+        the requested radius is.
+        
+        Args:
+            mask: Alpha mask of the text ('L' image)
+            offset: Shadow offset in pixels
+            blur: Blur radius in pixels
+            color: RGBA colour of the shadow
+            
+        Returns:
+            (RGBA PIL Image, position to paste the text at)
+        """
+        # Room for the blur on every side, less where the offset gives it
+        margin = max(0, blur - offset)
+        origin = (margin, margin)
+        size = (mask.width + margin + offset + blur, mask.height + margin + offset + blur)
+        
+        alpha = Image.new('L', size, 0)
+        alpha.paste(mask.point(lambda v: v * color[3] // 255), (margin + offset, margin + offset))
+        
+        if blur:
+            factor = max(1, blur // 4)
+            small = alpha.reduce(factor) if factor > 1 else alpha
+            small = small.filter(ImageFilter.GaussianBlur(blur / factor / 2))
+            alpha = small.resize(size, Image.BILINEAR) if factor > 1 else small
+        
+        shadow = Image.new('RGBA', size, color[:3] + (0,))
+        shadow.putalpha(alpha)
+        return shadow, origin
+    
+    def _gradient_ramp(self, size, direction='vertical'):
+        """Position along a gradient as an 'L' image, 0 at the start and
+        255 at the end (shared by the image and array colorspill steps)"""
+        ramp = Image.linear_gradient('L')  # 256x256, black at the top
+        if direction == 'horizontal':
+            ramp = ramp.transpose(Image.Transpose.ROTATE_90)
+            return ramp.resize(size, Image.BILINEAR)
+        elif direction == 'diagonal':
+            horizontal = ramp.transpose(Image.Transpose.ROTATE_90)
+            return ImageChops.add(horizontal.resize(size, Image.BILINEAR),
+                                  ramp.resize(size, Image.BILINEAR), scale=2.0)
+        return ramp.resize(size, Image.BILINEAR)
+    
+    def _gradient_image(self, size, colors, direction='vertical', alpha=255):
+        """Create a multi-stop linear gradient in one pass
+        
+        A 0-255 ramp is built from Image.linear_gradient and mapped through
+        per-channel lookup tables, so the number of Python operations does
+        not depend on the image size.
+        
+        Args:
+            size: (width, height) tuple
+            colors: Two or more RGB tuples, evenly spaced along the gradient
+            direction: 'vertical', 'horizontal' or 'diagonal'
+            alpha: Alpha value of the whole gradient
+            
+        Returns:
+            RGBA PIL Image
+        """
+        ramp = self._gradient_ramp(size, direction)
+        
+        # Lookup tables: ramp value -> colour, interpolating between stops
+        segments = len(colors) - 1
+        luts = ([], [], [])
+        for i in range(256):
+            pos = i / 255 * segments
+            k = min(int(pos), segments - 1)
+            f = pos - k
+            for ch in range(3):
+                luts[ch].append(round(colors[k][ch] * (1 - f) + colors[k + 1][ch] * f))
+        
+        bands = [ramp.point(lut) for lut in luts]
+        bands.append(Image.new('L', size, alpha))
+        return Image.merge('RGBA', bands)
+    
+    # Effects that plans are compiled from: name -> (order, image step, array step)
+    effect_registry = {}
+    
+    # Effects whose image step also works on an 'L' coverage mask
+    coverage_effects = set()
+    
+    @classmethod
+    def register_effect(cls, name, order, image=None, array=None, coverage=False):
+        """Make an effect available to every plan
+        
+        An effect runs when effects[name] is set, in ascending order. An
+        image step is called as image(processor, img, effects) and returns a
+        new PIL Image (it must not modify img); effects ordered after tile
+        get the full frame as a PIL Image too. An array step is called as
+        array(processor, data, effects) with a uint8 (height, width, 4) RGBA
+        buffer and returns the buffer, modified in place or as a view.
+        Effects without an image step run on one buffer together with the
+        array steps of the effects next to them when NumPy is installed.
+        
+        Args:
+            name: Effect name, the key that enables it
+            order: Position in the plan (flip 10, colorspill 20, fade 30,
+                pattern 40, shadow 50, tile 60)
+            image: Image step, required unless NumPy is always available
+            array: Optional array step
+            coverage: The image step keeps an 'L' coverage mask of
+                monochrome text as one (geometry only, no colour)
+        """
+        if image is None and array is None:
+            raise ValueError(f'effect "{name}" has no step')
+        cls.effect_registry[name] = (order, image, array)
+        if coverage:
+            cls.coverage_effects.add(name)
+        else:
+            cls.coverage_effects.discard(name)
+    
+    def plan(self, effects):
+        """Compile the effects into an EffectPlan"""
+        return EffectPlan(self, effects)
+    
+    def apply_effects(self, img, effects):
+        """Apply various effects to the image - optimized for speed
+        
+        Args:
+            img: PIL Image
+            effects: Dictionary of effects to apply
+            
+        Returns:
+            PIL Image with effects applied
+        """
+        plan = self.plan(effects)
+        result = plan.run(img)
+        if self.debug:
+            print(f"Effect plan: {plan.report()}", file=sys.stderr)
+        return result
+    
+    def _flip_image(self, img, effects):
+        """Flip effect, image step"""
+        flip_type = effects['flip']
+        if flip_type == 'horizontal':
+            return ImageOps.mirror(img)
+        elif flip_type == 'vertical':
+            return ImageOps.flip(img)
+        elif flip_type == 'both':
+            return ImageOps.flip(ImageOps.mirror(img))
+        return img
+    
+    def _flip_array(self, data, effects):
+        """Flip effect, array step (a view, nothing is copied)"""
+        flip_type = effects['flip']
+        if flip_type in ('horizontal', 'both'):
+            data = data[:, ::-1]
+        if flip_type in ('vertical', 'both'):
+            data = data[::-1]
+        return data
+    
+    def _spill_colors(self, effects):
+        """Colour stops of the colorspill effect, None if fewer than two"""
+        spill_colors = [self._get_rgb_color(c.strip()) for c in effects['colorspill'].split(',')]
+        return spill_colors if len(spill_colors) >= 2 else None
+    
+    def _colorspill_image(self, img, effects):
+        """Color spill (gradient) effect, image step"""
+        spill_colors = self._spill_colors(effects)
+        if not spill_colors or img.mode != 'RGBA':
+            return img
+        direction = effects.get('colorspill_direction', 'vertical')
+        gradient_img = self._gradient_image(img.size, spill_colors, direction, 128)
+        return Image.alpha_composite(img, gradient_img)
+    
+    def _colorspill_array(self, data, effects):
+        """Color spill effect, array step: the gradient composited at half opacity"""
+        import numpy as np
+        
+        spill_colors = self._spill_colors(effects)
+        if not spill_colors:
+            return data
+        height, width, _ = data.shape
+        direction = effects.get('colorspill_direction', 'vertical')
+        
+        # The ramp of _gradient_image, broadcast from one column and one row
+        # (its resized gradients are constant along the other axis)
+        column = np.asarray(self._gradient_ramp((1, height)), dtype=np.uint16)
+        row = np.asarray(self._gradient_ramp((width, 1), 'horizontal'), dtype=np.uint16)
+        
+        # Source-over with a constant source alpha of 128: every channel
+        # becomes a weighted sum of its value and the gradient. This is
+        # the fixed-point arithmetic of Image.alpha_composite (7 extra
+        # bits, divisions by 255 as shifts), so the result is the same. The
+        # weights only depend on the alpha and are looked up.
+        def div255(value):
+            value += value >> 8
+            value >>= 8
+            return value
+        
+        src_alpha = 128
+        out_alpha = np.arange(256, dtype=np.uint32) * (255 - src_alpha) + src_alpha * 255
+        spill_lut = (src_alpha * 255 * 255 << 7) // out_alpha
+        alpha_lut = (div255(out_alpha + 0x80)).astype(np.uint8)
+        stops = np.linspace(0, 255, len(spill_colors))
+        gradient_luts = [np.interp(np.arange(256), stops, [c[ch] for c in spill_colors]).round()
+                         .astype(np.uint32) for ch in range(3)]
+        
+        # A band of rows at a time, so the 32-bit temporaries stay small
+        rows = max(1, 65536 // width)
+        for top in range(0, height, rows):
+            band = data[top:top + rows]
+            ramp = row if direction == 'horizontal' else column[top:top + rows]
+            if direction == 'diagonal':
+                ramp = (row + ramp) // 2
+            spill = spill_lut[band[..., 3]]
+            keep = (255 << 7) - spill
+            for ch in range(3):
+                value = band[..., ch] * keep
+                value += gradient_luts[ch][ramp] * spill
+                value += 0x80 << 7
+                band[..., ch] = div255(value) >> 7
+            band[..., 3] = alpha_lut[band[..., 3]]
+        return data
+    
+    def _fade_image(self, img, effects):
+        """Fade effect, image step (simple fades are fast)"""
+        fade_type = effects['fade']
+        fade_amount = float(effects.get('fade_amount', '0.5'))
+        
+        if fade_type == 'transparent' and img.mode == 'RGBA':
+            # Simple alpha adjustment
+            r, g, b, a = img.split()
+            a = ImageEnhance.Brightness(a).enhance(1.0 - fade_amount)
+            return Image.merge('RGBA', (r, g, b, a))
+        
+        elif fade_type == 'white':
+            # Simple brightness/contrast adjustment
+            img = ImageEnhance.Contrast(img).enhance(1.0 - fade_amount)
+            if img.mode == 'RGBA':
+                img = ImageEnhance.Brightness(img).enhance(1.0 + fade_amount)
+            return img
+        
+        elif fade_type == 'black':
+            # Simple brightness adjustment
+            return ImageEnhance.Brightness(img).enhance(1.0 - fade_amount)
+        return img
+    
+    def _fade_array(self, data, effects):
+        """Fade effect, array step, the same arithmetic as ImageEnhance
+        (which keeps the alpha of RGBA images)
+        
+        ImageEnhance blends towards a flat image in single precision and
+        truncates every blend to 8 bits. Each blend is therefore a function
+        of one 8-bit value: it is worked out for all 256 and looked up in
+        the buffer, so the fused and unfused plans give the same pixels.
+        """
+        import numpy as np
+        
+        fade_type = effects['fade']
+        fade_amount = float(effects.get('fade_amount', '0.5'))
+        
+        def blend(lut, base, factor):
+            # Image.blend(base, value, factor) for every value, truncated
+            lut -= base
+            lut *= np.float32(factor)
+            lut += base
+            np.trunc(lut, out=lut)
+            return lut.clip(0, 255, out=lut)
+        
+        lut = np.arange(256, dtype=np.float32)
+        if fade_type == 'transparent':
+            channels = slice(3, 4)
+            blend(lut, 0, 1.0 - fade_amount)
+        elif fade_type in ('white', 'black'):
+            channels = slice(0, 3)
+        else:
+            return data
+        
+        if fade_type == 'white':
+            # Contrast blends towards the mean of the image in mode 'L',
+            # brightness then scales up. The mean does not depend on the
+            # order of the pixels, so flipped views are read unflipped.
+            pixels = data[::-1] if data.strides[0] < 0 else data
+            pixels = pixels[:, ::-1] if pixels.strides[1] < 0 else pixels
+            grey = Image.fromarray(np.ascontiguousarray(pixels), 'RGBA').convert('L')
+            blend(lut, int(ImageStat.Stat(grey).mean[0] + 0.5), 1.0 - fade_amount)
+            blend(lut, 0, 1.0 + fade_amount)
+        elif fade_type == 'black':
+            blend(lut, 0, 1.0 - fade_amount)
+        
+        data[..., channels] = lut.astype(np.uint8)[data[..., channels]]
+        return data
+    
+    def _pattern_image(self, img, effects):
+        """Pattern background effect, image step"""
+        pattern_name = effects['pattern']
+        if pattern_name not in self.patterns or img.mode != 'RGBA':
+            return img
+        
+        # Get pattern colors
+        pattern_colors = effects.get('pattern_colors', 'white,black').split(',')
+        color1 = self._get_rgb_color(pattern_colors[0])
+        color2 = self._get_rgb_color(pattern_colors[1] if len(pattern_colors) > 1 else 'black')
+        
+        pattern_scale = int(effects.get('pattern_scale', '20'))
+        
+        # Composite the image onto the pattern, which is a fresh image
+        # (the cached tile is only read)
+        result = self._create_pattern_image(
+            pattern_name, img.size, color1 + (255,), color2 + (255,), pattern_scale)
+        result.alpha_composite(img)
+        return result
+    
+    def _shadow_image(self, img, effects):
+        """Shadow effect, image step (this is an expensive operation)"""
+        shadow_type = effects['shadow']
+        shadow_offset = int(effects.get('shadow_offset', '5'))
+        shadow_color = self._get_rgb_color(effects.get('shadow_color', 'black')) + (128,)  # Add alpha
+        shadow_mask = img.getchannel('A') if img.mode == 'RGBA' else Image.new('L', img.size, 0)
+        origin = (0, 0)
+        
+        if shadow_type == 'drop':
+            # Create a new canvas large enough for image and shadow, then
+            # paste the shadow colour through the offset mask
+            new_size = (img.width + shadow_offset, img.height + shadow_offset)
+            result = Image.new('RGBA', new_size, (0, 0, 0, 0))
+            result.paste(shadow_color, (shadow_offset, shadow_offset,
+                                        shadow_offset + img.width, shadow_offset + img.height), shadow_mask)
+        
+        elif shadow_type == '3d':
+            # One extrusion layer per pixel of offset, built in one pass
+            result = self._extrude(shadow_mask, shadow_offset, shadow_color)
+        
+        elif shadow_type == 'soft':
+            # Blurred drop shadow, the blur spreads to all sides
+            blur = effects.get('shadow_blur')
+            blur = shadow_offset if blur is None else int(blur)
+            result, origin = self._soft_shadow(shadow_mask, shadow_offset, blur, shadow_color)
+        
+        else:
+            return img
+        
+        # Finally add the original image on top
+        result.paste(img, origin, img if img.mode == 'RGBA' else None)
+        return result
+    
+    def _tile_image(self, img, effects):
+        """Tile effect: the tiling is kept lazy, the output stage reads it
+        a band at a time (applied last, as it enlarges the image)"""
+        tile_count = max(1, int(effects.get('tile_count', '3')))
+        if img.mode not in ('RGBA', 'L'):
+            img = img.convert('RGBA')
+        return TiledImage(img, tile_count, mirror=effects['tile'] == 'mirror')
+    
+    
+    def save_image(self, img, output_file, format='PNG'):
+        """Save the image to a file
+        
+        Args:
+            img: PIL Image
+            output_file: Output filename
+            format: Image format (PNG, JPEG, etc.)
+            
+        Returns:
+            Path to the saved file
+        """
+        try:
+            img.save(output_file, format=format)
+            return output_file
+        except Exception as e:
+            print(f"Error: Failed to save image: {e}", file=sys.stderr)
+            sys.exit(1)
+    
+    def _png_bytes(self, img):
+        """Encode an image as PNG in memory"""
+        buf = io.BytesIO()
+        img.save(buf, format='PNG', compress_level=1)
+        return buf.getvalue()
+    
+    def img_to_sixel(self, img, bg_color):
+        """Convert PIL image to Sixel and output to stdout
+        
+        Uses the in-process SixelEncoder when possible, otherwise the image
+        is piped to img2sixel (no temporary file is used either way).
+        
+        Args:
+            img: PIL Image
+            bg_color: Background color for Sixel
+        """
+        if self.native_sixel:
+            SixelEncoder().write(img, self._get_rgb_color(bg_color))
+            return
+        
+        # Check if img2sixel exists
+        if not shutil.which("img2sixel"):
+            print("Error: img2sixel command not found", file=sys.stderr)
+            sys.exit(1)
+        
+        # Run img2sixel, reading the image from stdin
+        try:
+            png = self._png_bytes(img)
+            span = self.tracer.begin('img2sixel', subprocess=True)
+            subprocess.run(["img2sixel", "-I", "-B", bg_color], input=png, check=True)
+            self.tracer.end(span)
+        except Exception as e:
+            print(f"Error: Failed to convert to Sixel: {e}", file=sys.stderr)
+            sys.exit(1)
+    
+    def img_to_ansi(self, img, bg_color):
+        """Convert PIL image to ANSI and output to stdout
+        
+        Uses the in-process AnsiRenderer when possible, otherwise the image
+        is piped to img2ans (no temporary file is used either way).
+        
+        Args:
+            img: PIL Image
+            bg_color: Background color for ANSI
+        """
+        if self.native_ansi:
+            max_cols = shutil.get_terminal_size().columns
+            AnsiRenderer(self.ansi_colors).write(img, self._get_rgb_color(bg_color), max_cols)
+            return
+        
+        # Check if img2ans exists
+        if not shutil.which("img2ans"):
+            print("Error: img2ans command not found", file=sys.stderr)
+            sys.exit(1)
+        
+        # Run img2ans - it hands the path to ImageMagick, which reads png:- from stdin
+        try:
+            png = self._png_bytes(img)
+            span = self.tracer.begin('img2ans', subprocess=True)
+            subprocess.run(["img2ans", "-b", bg_color, "png:-"], input=png, check=True)
+            self.tracer.end(span)
+        except Exception as e:
+            print(f"Error: Failed to convert to ANSI: {e}", file=sys.stderr)
+            sys.exit(1)
+    
+    def encode_image(self, img, bg_color, fmt, max_cols=None, ansi_colors=None):
+        """Encode an image for output without writing it anywhere
+        
+        Args:
+            img: PIL Image
+            bg_color: Background color
+            fmt: 'sixel', 'ansi' or 'png'
+            max_cols: Maximum width of ANSI output in columns
+            ansi_colors: ANSI colour mode (default: the one of this processor)
+        
+        Returns:
+            bytes
+        """
+        if fmt == 'png':
+            return self._png_bytes(img)
+        
+        if fmt == 'sixel':
+            if self.native_sixel:
+                return SixelEncoder().encode(img, self._get_rgb_color(bg_color))
+            return subprocess.run(["img2sixel", "-I", "-B", bg_color], input=self._png_bytes(img),
+                                  stdout=subprocess.PIPE, check=True).stdout
+        
+        if fmt == 'ansi':
+            if self.native_ansi:
+                out = io.StringIO()
+                AnsiRenderer(ansi_colors or self.ansi_colors).write(img, self._get_rgb_color(bg_color),
+                                                                    max_cols, out=out)
+                return out.getvalue().encode('utf-8')
+            return subprocess.run(["img2ans", "-b", bg_color, "png:-"], input=self._png_bytes(img),
+                                  stdout=subprocess.PIPE, check=True).stdout
+        
+        raise ValueError(f"unknown output format: {fmt}")
+
+
+EffectsProcessor.register_effect('flip', 10, EffectsProcessor._flip_image,
+                                 EffectsProcessor._flip_array, coverage=True)
+EffectsProcessor.register_effect('colorspill', 20, EffectsProcessor._colorspill_image,
+                                 EffectsProcessor._colorspill_array)
+EffectsProcessor.register_effect('fade', 30, EffectsProcessor._fade_image,
+                                 EffectsProcessor._fade_array)
+EffectsProcessor.register_effect('pattern', 40, EffectsProcessor._pattern_image)
+EffectsProcessor.register_effect('shadow', 50, EffectsProcessor._shadow_image)
+EffectsProcessor.register_effect('tile', 60, EffectsProcessor._tile_image, coverage=True)
+
+
+class EffectPlan:
+    """The requested effects compiled into an ordered list of steps
+    
+    A run of effects with array steps becomes one fused step when one of
+    them has no image step: the image is read into a single uint8 buffer,
+    every effect works on it in place and one image is made from the
+    result. Otherwise the effects run as image steps, which Pillow does
+    faster than NumPy. Each run records the number of images and buffers
+    it allocated and the peak size of the image data alive at once.
+    """
+    
+    def __init__(self, processor, effects):
+        self.processor = processor
+        self.effects = effects
+        self.stats = {}
+        
+        try:
+            import numpy
+            fuse = True
+        except ImportError:
+            fuse = False
+        
+        # Steps are (names, kind, functions) with kind 'image' or 'array'
+        self.steps = []
+        active = sorted((order, name, image, array)
+                        for name, (order, image, array) in processor.effect_registry.items()
+                        if effects.get(name))
+        run = []
+        for order, name, image, array in active + [(None, None, None, None)]:
+            if fuse and array is not None:
+                run.append((name, image, array))
+                continue
+            if any(image is None for _, image, _ in run):
+                self.steps.append(([n for n, _, _ in run], 'array', [a for _, _, a in run]))
             else:
-                new_data.append(item)
+                self.steps.extend(([n], 'image', [i]) for n, i, _ in run)
+            run = []
+            if name is not None:
+                if image is None:
+                    raise RuntimeError(f'effect "{name}" needs NumPy')
+                self.steps.append(([name], 'image', [image]))
+    
+    def describe(self):
+        """Return the plan as text, fused steps in brackets"""
+        return " -> ".join(
+            "[" + "+".join(names) + "]" if kind == 'array' else names[0]
+            for names, kind, _ in self.steps) or "(nothing)"
+    
+    @staticmethod
+    def _nbytes(img):
+        """Size of the pixel data of an image"""
+        if isinstance(img, TiledImage):
+            img = img.tile
+        if isinstance(img, CoverageImage):
+            img = img.mask
+        return img.width * img.height * len(img.getbands())
+    
+    def run(self, img):
+        """Apply the plan to an image
+        
+        Returns:
+            The resulting image (the input if the plan is empty)
+        """
+        tracer = self.processor.tracer
+        core_stats = getattr(Image.core, 'get_stats', None)
+        images_before = core_stats()['new_count'] if core_stats else 0
+        buffers = 0
+        allocated = 0
+        peak = live = self._nbytes(img)
+        
+        for names, kind, funcs in self.steps:
+            if isinstance(img, TiledImage):
+                # An effect ordered after tile gets the full frame
+                img = img.image()
+                live = self._nbytes(img)
+                allocated += live
+                peak = max(peak, live)
+            span = tracer.begin("+".join(names), **({'fused': True} if kind == 'array' else {}))
+            if kind == 'image':
+                result = funcs[0](self.processor, img, self.effects)
+                size = self._nbytes(result) if result is not img else 0
+                peak = max(peak, live + size)
+            else:
+                import numpy as np
                 
-        img.putdata(new_data)
+                if img.mode != 'RGBA':
+                    img = img.convert('RGBA')
+                data = np.array(img)
+                for func in funcs:
+                    data = func(self.processor, data, self.effects)
+                buffers += 1
+                if not data.flags.c_contiguous:
+                    # Copy a flipped view a pixel at a time, not a byte at a time
+                    data = np.ascontiguousarray(data.view(np.uint32)).view(np.uint8)
+                    buffers += 1
+                result = Image.fromarray(data, 'RGBA')
+                size = self._nbytes(result)
+                peak = max(peak, live + data.nbytes + size)
+            allocated += size
+            live = self._nbytes(result)
+            img = result
+            tracer.end(span, img)
+        
+        images = (core_stats()['new_count'] - images_before) if core_stats else 0
+        self.stats = {'images': images, 'buffers': buffers,
+                      'allocated_bytes': allocated, 'peak_bytes': peak}
+        return img
+    
+    def report(self):
+        """Describe the plan and the allocations of its last run"""
+        stats = self.stats
+        if not stats:
+            return self.describe()
+        return (f"{self.describe()}: {stats['images']} images and {stats['buffers']} buffers allocated "
+                f"({stats['allocated_bytes'] / 1048576:.1f} MB of results), "
+                f"peak {stats['peak_bytes'] / 1048576:.1f} MB of image data")
+
+
+class TiledImage:
+    """A tile repeated count x count times, without building the full frame
+    
+    Stands in for the PIL Image of a tiled banner: the native encoders read
+    it a band of rows at a time, so memory grows with the tile and not with
+    the tile count. Anything else gets a real image from image(), built by
+    replicating a row strip. In mirror mode every other tile is flipped
+    horizontally and every other row of tiles vertically. The mode is that
+    of the tile.
+    """
+    
+    def __init__(self, tile, count, mirror=False):
+        self.tile = tile
+        self.count = count
+        self.mirror = mirror
+        self.mode = tile.mode
+    
+    @property
+    def size(self):
+        return (self.tile.width * self.count, self.tile.height * self.count)
+    
+    @property
+    def width(self):
+        return self.tile.width * self.count
+    
+    @property
+    def height(self):
+        return self.tile.height * self.count
+    
+    def rows(self, data, top, bottom):
+        """Rows top:bottom of the tiling of a per-tile NumPy array
+        
+        Args:
+            data: Array with the tile's rows and columns as its first two axes,
+                e.g. its pixels or its palette indices
+            top, bottom: Row range of the tiled image
+            
+        Returns:
+            Array of bottom - top full-width rows
+        """
+        import numpy as np
+        
+        height, width = data.shape[:2]
+        ys = np.arange(top, min(bottom, self.height))
+        index = ys % height
+        if self.mirror:
+            index = np.where((ys // height) % 2 == 1, height - 1 - index, index)
+        block = data[index]
+        repeats = self.count
+        if self.mirror:
+            block = np.concatenate([block, block[:, ::-1]], axis=1)
+            repeats = (self.count + 1) // 2
+        block = np.tile(block, (1, repeats) + (1,) * (block.ndim - 2))
+        return block[:, :width * self.count]
+    
+    def resize(self, size, resample=None):
+        """Scale the tile so the tiling gets about the given size"""
+        tile_size = (max(1, round(size[0] / self.count)), max(1, round(size[1] / self.count)))
+        return TiledImage(self.tile.resize(tile_size, resample), self.count, self.mirror)
+    
+    def image(self):
+        """Build the full frame: one strip per kind of tile row, pasted per row
+        (the frame of a coverage tile is a coverage image)"""
+        if isinstance(self.tile, CoverageImage):
+            return CoverageImage(TiledImage(self.tile.mask, self.count, self.mirror).image(),
+                                 self.tile.colour)
+        
+        tiles = [self.tile, ImageOps.mirror(self.tile)] if self.mirror else [self.tile]
+        strips = []
+        for flip in ([False, True] if self.mirror else [False]):
+            strip = Image.new(self.tile.mode, (self.width, self.tile.height))
+            for x in range(self.count):
+                tile = tiles[x % len(tiles)]
+                strip.paste(ImageOps.flip(tile) if flip else tile, (x * self.tile.width, 0))
+            strips.append(strip)
+        
+        img = Image.new(self.tile.mode, self.size)
+        for y in range(self.count):
+            img.paste(strips[y % len(strips)], (0, y * self.tile.height))
+        return img
+    
+    def convert(self, mode):
+        return self.image().convert(mode)
+    
+    def save(self, fp, format=None, **params):
+        self.image().save(fp, format=format, **params)
+
+
+class CoverageImage:
+    """Monochrome text kept as 8-bit coverage plus one colour
+    
+    Stands in for the RGBA image of a banner without effects that need
+    colour: every stage from the render to the output works on the 'L'
+    mask, a quarter of the RGBA data. The native encoders map the coverage
+    levels straight to colours, anything else gets a real RGBA image from
+    image(). The mode is that of the mask.
+    """
+    
+    def __init__(self, mask, colour):
+        self.mask = mask
+        self.colour = tuple(colour)
+        self.mode = mask.mode
+    
+    @classmethod
+    def wrap(cls, img, colour):
+        """Colour a coverage mask, or the tile of a tiled mask"""
+        if isinstance(img, TiledImage):
+            return TiledImage(cls(img.tile, colour), img.count, img.mirror)
+        return cls(img, colour)
+    
+    @property
+    def size(self):
+        return self.mask.size
+    
+    @property
+    def width(self):
+        return self.mask.width
+    
+    @property
+    def height(self):
+        return self.mask.height
+    
+    def levels(self, bg=None, threshold=1):
+        """Map the coverage levels of the mask to colours
+        
+        Args:
+            bg: Optional RGB tuple that partially covered pixels are
+                blended onto
+            threshold: Lowest coverage that is painted
+            
+        Returns:
+            (palette as an (n, 3) uint8 array, 256 entry int16 lookup table
+            from coverage to palette index, -1 below the threshold)
+        """
+        import numpy as np
+        
+        used = np.flatnonzero(np.bincount(np.asarray(self.mask).reshape(-1), minlength=256))
+        used = used[used >= threshold]
+        colour = np.array(self.colour, dtype=np.uint32)
+        if bg is None:
+            colours = np.tile(colour, (len(used), 1))
+        else:
+            a = used.astype(np.uint32)[:, None]
+            colours = (colour * a + np.array(bg, dtype=np.uint32) * (255 - a) + 127) // 255
+        
+        # Levels that end up the same colour share a palette entry
+        palette, inverse = np.unique(colours.astype(np.uint8), axis=0, return_inverse=True)
+        lut = np.full(256, -1, dtype=np.int16)
+        lut[used] = inverse.reshape(-1)
+        return palette, lut
+    
+    def resize(self, size, resample=None):
+        return CoverageImage(self.mask.resize(size, resample), self.colour)
+    
+    def image(self):
+        """Build the RGBA image: the colour everywhere, the coverage as alpha"""
+        img = Image.new('RGB', self.size, self.colour)
+        img.putalpha(self.mask)
+        return img
+    
+    def convert(self, mode):
+        return self.image().convert(mode)
+    
+    def save(self, fp, format=None, **params):
+        self.image().save(fp, format=format, **params)
+
+
+class SixelEncoder:
+    """In-process Sixel encoder working directly on an RGBA image
+    
+    Colours are quantised with NumPy, every six-pixel band is run-length
+    encoded per colour and transparent pixels are left unpainted (P2=1), so
+    no PNG encode, img2sixel process or PNG decode is needed. Like
+    img2sixel -B, every pixel with some alpha is blended onto the
+    background, only fully transparent ones are skipped.
+    """
+    
+    def __init__(self, max_colors=256, alpha_threshold=1):
+        self.max_colors = max_colors
+        self.alpha_threshold = alpha_threshold  # lowest alpha that is painted
+    
+    @staticmethod
+    def available():
+        """True if NumPy is installed"""
+        try:
+            import numpy
+            return True
+        except ImportError:
+            return False
+    
+    def quantize(self, data, bg=None):
+        """Map the painted pixels (alpha >= alpha_threshold) of an RGBA array
+        onto a palette
+        
+        Exact colours are used when there are few enough of them (the usual
+        case for text), otherwise low bits are dropped until the colours fit
+        and each palette entry is the mean of the pixels mapped to it.
+        
+        Args:
+            data: (height, width, 4) uint8 array
+            bg: Optional RGB tuple that partially transparent pixels are
+                blended onto
+            
+        Returns:
+            (palette as an (n, 3) uint8 array, (height, width) index array
+            with -1 for transparent pixels)
+        """
+        import numpy as np
+        
+        alpha = data[:, :, 3]
+        painted = alpha >= self.alpha_threshold
+        rgb = data[:, :, :3][painted].astype(np.uint32)
+        
+        if bg is not None:
+            a = alpha[painted].astype(np.uint32)[:, None]
+            rgb = (rgb * a + np.array(bg, dtype=np.uint32) * (255 - a) + 127) // 255
+        
+        packed = (rgb[:, 0] << 16) | (rgb[:, 1] << 8) | rgb[:, 2]
+        for shift in range(8):
+            mask = ((0xFF << shift) & 0xFF) * 0x010101
+            colours, inverse = np.unique(packed & mask, return_inverse=True)
+            if len(colours) <= self.max_colors:
+                break
+        inverse = inverse.reshape(-1)
+        
+        counts = np.bincount(inverse, minlength=len(colours))
+        palette = np.empty((len(colours), 3), dtype=np.uint8)
+        for ch in range(3):
+            sums = np.bincount(inverse, weights=rgb[:, ch], minlength=len(colours))
+            palette[:, ch] = np.rint(sums / np.maximum(counts, 1))
+        
+        index = np.full(alpha.shape, -1, dtype=np.int16)
+        index[painted] = inverse
+        return palette, index
+    
+    def palette_index(self, img, bg=None):
+        """quantize() an image; the coverage levels of a CoverageImage are
+        looked up instead, it never becomes RGBA
+        
+        Returns:
+            (palette, index array) like quantize()
+        """
+        import numpy as np
+        
+        if isinstance(img, CoverageImage):
+            palette, lut = img.levels(bg, self.alpha_threshold)
+            return palette, lut[np.asarray(img.mask)]
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        return self.quantize(np.asarray(img), bg)
+    
+    @staticmethod
+    def _rle(chars):
+        """Run-length encode a row of sixel values (uint8 array, already +63)"""
+        import numpy as np
+        
+        starts = np.concatenate(([0], np.flatnonzero(chars[1:] != chars[:-1]) + 1))
+        lengths = np.diff(np.concatenate((starts, [len(chars)])))
+        pieces = []
+        for value, count in zip(chars[starts].tolist(), lengths.tolist()):
+            ch = chr(value)
+            pieces.append(f"!{count}{ch}" if count > 3 else ch * count)
+        return "".join(pieces)
+    
+    def encode_bands(self, img, bg=None):
+        """Generate the Sixel stream for an image piece by piece
+        
+        Args:
+            img: PIL Image
+            bg: Optional RGB tuple for blending partially transparent pixels
+            
+        Yields:
+            str chunks: the header and palette, then one per six-pixel band
+        """
+        import numpy as np
+        
+        if isinstance(img, TiledImage):
+            # Quantise the tile only, the bands are assembled from its indices
+            palette, tile_index = self.palette_index(img.tile, bg)
+            width, height = img.size
+            band_rows = lambda top: img.rows(tile_index, top, top + 6)
+        else:
+            palette, index = self.palette_index(img, bg)
+            height, width = index.shape
+            band_rows = lambda top: index[top:top + 6]
+        
+        # DCS P1=0 P2=1 (unpainted pixels stay transparent), 1:1 aspect ratio
+        header = [f'\x1bP0;1;0q"1;1;{width};{height}']
+        for i, (r, g, b) in enumerate(palette.tolist()):
+            header.append(f"#{i};2;{round(r * 100 / 255)};{round(g * 100 / 255)};{round(b * 100 / 255)}")
+        yield "".join(header)
+        
+        weights = np.array([1, 2, 4, 8, 16, 32], dtype=np.uint8)[:, None]
+        for top in range(0, height, 6):
+            band = band_rows(top)
+            if band.shape[0] < 6:
+                band = np.vstack([band, np.full((6 - band.shape[0], width), -1, dtype=np.int16)])
+            
+            rows = []
+            for colour in np.unique(band).tolist():
+                if colour < 0:
+                    continue
+                bits = ((band == colour) * weights).sum(axis=0, dtype=np.uint8)
+                last = np.flatnonzero(bits)[-1] + 1  # trailing blanks are implied
+                rows.append(f"#{colour}" + self._rle(bits[:last] + 63))
+            yield "$".join(rows) + "-"
+        
+        yield "\x1b\\"
+    
+    def encode(self, img, bg=None):
+        """Encode an image as Sixel
+        
+        Returns:
+            bytes
+        """
+        return "".join(self.encode_bands(img, bg)).encode('ascii')
+    
+    def write(self, img, bg=None, out=None):
+        """Encode an image and write it band by band to a binary stream"""
+        out = out or sys.stdout.buffer
+        for chunk in self.encode_bands(img, bg):
+            out.write(chunk.encode('ascii'))
+        out.flush()
+
+
+class AnsiRenderer:
+    """In-process ANSI renderer using upper/lower half-block characters
+    
+    Every character cell shows two vertically stacked pixels. Colours are
+    mapped with NumPy to 16, 256 or 24-bit colour. The escape codes are
+    built with NumPy as well, per run of cells with the same colours: SGR
+    codes are only sent when the colour changes and transparent runs are
+    skipped with cursor forward, so the terminal background shows through. Pixels with some
+    alpha are blended onto the background like in the Sixel encoder.
+    """
+    
+    modes = ['16', '256', 'truecolor']
+    
+    # Standard xterm colours for the 16-colour mode
+    ansi16 = [
+        (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+        (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+        (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+        (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255),
+    ]
+    
+    # Channel levels of the 6x6x6 colour cube in the 256-colour mode
+    cube_levels = [0, 95, 135, 175, 215, 255]
+    
+    def __init__(self, colors='truecolor', alpha_threshold=1):
+        if colors == 'auto':
+            colors = self.detect_colors()
+        self.colors = colors
+        self.alpha_threshold = alpha_threshold  # lowest alpha that is painted
+    
+    @staticmethod
+    def available():
+        """True if NumPy is installed"""
+        return SixelEncoder.available()
+    
+    @staticmethod
+    def detect_colors():
+        """Guess the colour mode from the environment"""
+        if os.environ.get('COLORTERM', '').lower() in ('truecolor', '24bit'):
+            return 'truecolor'
+        if '256' in os.environ.get('TERM', ''):
+            return '256'
+        return '16'
+    
+    def _codes(self, rgb):
+        """Map an (..., 3) uint8 array to colour codes for the current mode"""
+        import numpy as np
+        
+        rgb = rgb.astype(np.int32)
+        if self.colors == 'truecolor':
+            return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+        
+        if self.colors == '256':
+            # Nearest point of the colour cube...
+            levels = np.array(self.cube_levels)
+            idx = np.abs(rgb[..., None] - levels).argmin(axis=-1)
+            cube = levels[idx]
+            cube_code = 16 + idx[..., 0] * 36 + idx[..., 1] * 6 + idx[..., 2]
+            # ...or of the grey ramp, whichever is closer
+            grey_idx = np.clip((rgb.mean(axis=-1) - 8) / 10, 0, 23).round().astype(np.int32)
+            grey = (8 + grey_idx * 10)[..., None]
+            use_grey = ((rgb - grey) ** 2).sum(axis=-1) < ((rgb - cube) ** 2).sum(axis=-1)
+            return np.where(use_grey, 232 + grey_idx, cube_code)
+        
+        palette = np.array(self.ansi16)
+        dist = ((rgb[..., None, :] - palette) ** 2).sum(axis=-1)
+        return dist.argmin(axis=-1)
+    
+    def _sgr(self, code, background):
+        """SGR parameters selecting a colour code as foreground or background"""
+        if self.colors == 'truecolor':
+            return f"{48 if background else 38};2;{code >> 16};{(code >> 8) & 255};{code & 255}"
+        if self.colors == '256':
+            return f"{48 if background else 38};5;{code}"
+        base = 40 if background else 30
+        return str(base + code if code < 8 else base + 60 + code - 8)
+    
+    def render_rows(self, img, bg=None, max_cols=None):
+        """Render an image as lines of ANSI text
+        
+        Args:
+            img: PIL Image
+            bg: Optional RGB tuple that partially transparent pixels are
+                blended onto
+            max_cols: Scale the image down to at most this many columns
+            
+        Yields:
+            str, one line per two pixel rows (each ends with a reset and newline)
+        """
+        import numpy as np
+        
+        if img.mode != 'RGBA' and not isinstance(img, (TiledImage, CoverageImage)):
+            img = img.convert('RGBA')
+        if max_cols and img.width > max_cols:
+            height = max(1, round(img.height * max_cols / img.width))
+            img = img.resize((max_cols, height), Image.LANCZOS)
+        if isinstance(img, TiledImage):
+            img = img.image()  # small once scaled to the terminal
+        if isinstance(img, CoverageImage):
+            img = img.image()
+        
+        data = np.asarray(img)
+        if data.shape[0] % 2:
+            data = np.vstack([data, np.zeros((1,) + data.shape[1:], dtype=np.uint8)])
+        
+        alpha = data[..., 3]
+        rgb = data[..., :3].astype(np.uint32)
+        if bg is not None:
+            a = alpha.astype(np.uint32)[..., None]
+            rgb = (rgb * a + np.array(bg, dtype=np.uint32) * (255 - a) + 127) // 255
+        codes = np.where(alpha >= self.alpha_threshold, self._codes(rgb), -1)
+        
+        # Work out every painted cell of the image at once. Cells are in line
+        # order; a cell starts a run when it is the first of its line, follows
+        # skipped cells or changes a colour.
+        upper, lower = codes[0::2], codes[1::2]
+        lines, cols = np.nonzero((upper >= 0) | (lower >= 0))
+        u = upper[lines, cols]
+        l = lower[lines, cols]
+        count = len(cols)
+        first = np.diff(lines, prepend=-1) != 0
+        
+        # Lower half alone, full block (which keeps whatever background is
+        # set), or upper half over the default background or the lower colour
+        full = u == l
+        glyphs = np.where(u < 0, ord("▄"), np.where(full, ord("█"), ord("▀")))
+        fg = np.where(u < 0, l, u)
+        want_bg = np.where((u < 0) | (l < 0) | full, -1, l)
+        
+        # A line starts with the default colours; full blocks carry the
+        # background of the last cell of their line that set one
+        setter = np.maximum.accumulate(np.where(full & ~first, -1, np.arange(count)))
+        bg = want_bg[setter]
+        
+        fg_change = first | (fg != np.roll(fg, 1))
+        bg_change = bg != np.where(first, -1, np.roll(bg, 1))
+        skips = np.where(first, cols, cols - np.roll(cols, 1) - 1)
+        starts = np.flatnonzero(first | fg_change | bg_change | (skips > 0))
+        line_runs = np.searchsorted(lines[starts], np.arange(upper.shape[0] + 1)).tolist()
+        
+        # Each run is its cursor skip, its SGR sequence and its glyphs
+        fg_change, bg_change, skips = fg_change[starts], bg_change[starts], skips[starts]
+        prefix = np.full(len(starts), "", dtype=object)
+        prefix[skips > 0] = [f"\x1b[{n}C" for n in skips[skips > 0].tolist()]
+        both = fg_change & bg_change
+        only_fg = fg_change & ~bg_change
+        only_bg = bg_change & ~fg_change
+        fg_params = self._sgr_params(fg[starts], False)
+        bg_params = self._sgr_params(bg[starts], True)
+        prefix[both] += "\x1b[" + fg_params[both] + ";" + bg_params[both] + "m"
+        prefix[only_fg] += "\x1b[" + fg_params[only_fg] + "m"
+        prefix[only_bg] += "\x1b[" + bg_params[only_bg] + "m"
+        
+        text = glyphs.astype('<u4').tobytes().decode('utf-32-le')
+        ends = np.append(starts[1:], count)
+        runs = [head + text[start:end] for head, start, end in zip(prefix.tolist(), starts.tolist(), ends.tolist())]
+        
+        for line in range(upper.shape[0]):
+            yield "".join(runs[line_runs[line]:line_runs[line + 1]]) + "\x1b[0m\n"
+    
+    def _sgr_params(self, codes, background):
+        """SGR parameters for an array of colour codes (-1 for the default
+        background), as an object array of str"""
+        import numpy as np
+        
+        if self.colors == 'truecolor':
+            decimal = np.array([str(i) for i in range(256)], dtype=object)
+            params = (("48;2;" if background else "38;2;") + decimal[(codes >> 16) & 255] + ";"
+                      + decimal[(codes >> 8) & 255] + ";" + decimal[codes & 255])
+        else:
+            size = 256 if self.colors == '256' else 16
+            table = np.array([self._sgr(code, background) for code in range(size)], dtype=object)
+            params = table[np.maximum(codes, 0)]
+        params[codes == -1] = "49"
+        return params
+    
+    def write(self, img, bg=None, max_cols=None, out=None):
+        """Render an image and write it to a text stream line by line"""
+        out = out or sys.stdout
+        for line in self.render_rows(img, bg, max_cols):
+            out.write(line)
+            out.flush()
+
+
+class RenderCache:
+    """On-disk cache of rendered banners, keyed by a hash of the render inputs
+    
+    Entries are PNG files named after their key. Writes go to a temporary
+    file in the cache directory and are renamed into place, so concurrent
+    writers never expose a partial entry. The cache is kept under max_bytes
+    by evicting the least recently used entries (a hit refreshes the mtime).
+    Only files named like entries or their temporary files are counted or
+    removed, anything else in the directory is left alone. If the directory
+    cannot be created the cache is turned off: every lookup misses and
+    nothing is stored.
+    """
+    
+    # Bump when the rendering output changes so old entries are not reused
+    version = 2
+    
+    # Names of entries (<sha256 key>.png) and of put()'s temporary files
+    entry_name = re.compile(r'[0-9a-f]{64}\.png')
+    temp_name = re.compile(r'\.[A-Za-z0-9_]+\.tmp')
+    
+    def __init__(self, cache_dir=None, max_bytes=64 * 1024 * 1024, debug=False):
+        self.cache_dir = cache_dir or self.default_dir()
+        self.max_bytes = max_bytes
+        self.debug = debug
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.enabled = True
+        except OSError as e:
+            self.enabled = False
+            if debug:
+                print(f"Warning: Render cache disabled: {e}", file=sys.stderr)
+    
+    @staticmethod
+    def default_dir():
+        """Return the default cache directory"""
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'bidet')
+    
+    def key(self, **params):
+        """Compute the cache key for a set of render parameters"""
+        params['cache_version'] = self.version
+        blob = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.png")
+    
+    def get(self, key):
+        """Look up a rendered image
+        
+        Returns:
+            PIL Image, or None on a miss
+        """
+        if not self.enabled:
+            self.misses += 1
+            return None
+        path = self._path(key)
+        try:
+            img = Image.open(path)
+            img.load()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # Unreadable entry - drop it and render again
+            self.misses += 1
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+        
+        # Mark as recently used for LRU eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        
+        self.hits += 1
         return img
     
-    def render_ps_to_image(self, ps_file):
-        """Render PostScript to PNG using Ghostscript - optimized for speed
+    def put(self, key, img):
+        """Store a rendered image and trim the cache if it is too large"""
+        if not self.enabled:
+            return
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                img.save(f, format='PNG', compress_level=1)
+            os.replace(temp_path, self._path(key))
+        except Exception as e:
+            if self.debug:
+                print(f"Warning: Failed to write cache entry: {e}", file=sys.stderr)
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return
+        
+        self.stores += 1
+        self._evict()
+    
+    def _evict(self):
+        """Remove least recently used entries until under max_bytes"""
+        entries = []
+        total = 0
+        now = time.time()
+        
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                if self.temp_name.fullmatch(entry.name):
+                    # Left behind by a writer that died - clean up after an hour
+                    if now - st.st_mtime > 3600:
+                        try:
+                            os.unlink(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                if self.entry_name.fullmatch(entry.name):
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+                    total += st.st_size
+        
+        if total <= self.max_bytes:
+            return
+        
+        # Oldest first
+        entries.sort()
+        for _, size, path in entries:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # Another process evicted it already
+                pass
+            except OSError:
+                continue
+            self.evictions += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+    
+    def stats(self):
+        """Return the hit/miss counters as a string"""
+        return (f"hits={self.hits} misses={self.misses} stores={self.stores} "
+                f"evictions={self.evictions}")
+
+
+class TerminalInfo:
+    """Terminal capabilities, detected with test-sixel and cached on disk
+    
+    Detection spawns test-sixel and waits for the terminal to answer, so the
+    result is kept in a small JSON file keyed by TERM, the tty device and the
+    session, and reused until it is older than ttl seconds. The cell size in
+    pixels is read from the tty on every run, it changes with the font size.
+    """
+    
+    defaults = {'sixel': False, 'foreground': "black", 'background': "white", 'colors': None}
+    
+    # Environment variables that identify the terminal window or session
+    session_vars = ('TERM', 'COLORTERM', 'TERM_PROGRAM', 'TERM_SESSION_ID', 'WINDOWID',
+                    'KITTY_WINDOW_ID', 'WT_SESSION', 'TMUX', 'TMUX_PANE', 'STY', 'SSH_TTY')
+    
+    def __init__(self, cache_dir=None, ttl=3600, debug=False):
+        self.cache_dir = os.path.join(cache_dir or RenderCache.default_dir(), 'terminal')
+        self.ttl = ttl
+        self.debug = debug
+    
+    @staticmethod
+    def tty_name():
+        """Name of the controlling terminal device, or None"""
+        for fd in (1, 2, 0):
+            try:
+                return os.ttyname(fd)
+            except (OSError, AttributeError):
+                continue
+        return None
+    
+    def key(self):
+        """Cache key for the current terminal and session"""
+        ident = {var: os.environ.get(var) for var in self.session_vars}
+        ident['tty'] = self.tty_name()
+        ident['sid'] = os.getsid(0) if hasattr(os, 'getsid') else None
+        blob = json.dumps(ident, sort_keys=True)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()[:32]
+    
+    @staticmethod
+    def cell_size():
+        """Size of a character cell in pixels as (width, height), or None"""
+        try:
+            import fcntl
+            import struct
+            import termios
+            with open('/dev/tty', 'rb') as tty:
+                rows, cols, xpixel, ypixel = struct.unpack(
+                    'HHHH', fcntl.ioctl(tty, termios.TIOCGWINSZ, b'\0' * 8))
+        except (ImportError, OSError):
+            return None
+        if not (rows and cols and xpixel and ypixel):
+            return None
+        return xpixel / cols, ypixel / rows
+    
+    def detect(self):
+        """Ask the terminal with test-sixel (slow)"""
+        info = dict(self.defaults)
+        if not shutil.which("test-sixel"):
+            return info
+        try:
+            result = subprocess.run(["test-sixel"], capture_output=True, text=True)
+        except OSError:
+            return info
+        match = re.search(r'Sixel support found. fg=(\S+) bg=(\S+) nc=(\S+)', result.stdout)
+        if match:
+            info['sixel'] = True
+            info['foreground'], info['background'] = match.group(1), match.group(2)
+            info['colors'] = int(match.group(3)) if match.group(3).isdigit() else None
+        return info
+    
+    def get(self, refresh=False):
+        """Return the terminal capabilities, detecting them if not cached
         
         Args:
-            ps_file: PostScript file
+            refresh: Ignore the cached entry and detect again
             
         Returns:
-            PIL Image
+            Dictionary with sixel, foreground, background, colors and cell_size
         """
-        # Create a temporary file for the output
-        temp_png = f"{ps_file}.png"
+        path = os.path.join(self.cache_dir, f"{self.key()}.json")
+        info = None
+        if not refresh:
+            try:
+                if time.time() - os.stat(path).st_mtime < self.ttl:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        info = json.load(f)
+            except (OSError, ValueError):
+                info = None
         
-        # Use Ghostscript to render the PS to PNG with optimized settings
-        gs_cmd = [
-            "gs", 
-            "-dSAFER",
-            "-dBATCH", 
-            "-dNOPAUSE", 
-            "-dGraphicsAlphaBits=4",  # Reduce antialiasing for speed
-            "-dTextAlphaBits=4",      # Reduce antialiasing for speed
-            "-sDEVICE=pngalpha", 
-            "-r150",                  # Lower resolution for faster processing
-            f"-sOutputFile={temp_png}",
-            ps_file
-        ]
+        if info is None:
+            info = self.detect()
+            self._store(path, info)
+        elif self.debug:
+            print(f"Terminal capabilities from cache: {path}", file=sys.stderr)
         
-        if self.debug:
-            print(f"Running: {' '.join(gs_cmd)}", file=sys.stderr)
+        info['cell_size'] = self.cell_size()
+        return info
+    
+    def _store(self, path, info):
+        """Write an entry atomically"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.', suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(info, f)
+            os.replace(temp_path, path)
+        except OSError as e:
+            if self.debug:
+                print(f"Warning: Failed to cache terminal capabilities: {e}", file=sys.stderr)
+
+
+class _ThreadStderr:
+    """sys.stderr replacement that lets a thread capture its own messages
+    
+    Used by the render server so the error printed by a failed request can
+    be sent back to its client instead of ending up in the server log.
+    """
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+    
+    def capture(self, buffer):
+        """Send this thread's writes to buffer (None to stop capturing)"""
+        self.local.buffer = buffer
+    
+    def write(self, s):
+        return (getattr(self.local, 'buffer', None) or self.stream).write(s)
+    
+    def flush(self):
+        (getattr(self.local, 'buffer', None) or self.stream).flush()
+    
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class RenderServer:
+    """Resident renderer answering requests over a Unix socket or localhost HTTP
+    
+    One EffectsProcessor and Ghostscript pool serve every request, so the
+    font metrics, colour table and pattern tile caches stay warm and a
+    banner costs a render instead of a Python start and interpreter startup.
+    
+    A request is a JSON object with the same keys as a batch job, plus
+    "format" (sixel, ansi or png), "columns" for ANSI output and "terminal"
+    (the foreground and background colours of the client's terminal). On
+    the Unix socket the client sends it as one line and gets back a JSON
+    header line ({"ok": true, "length": N} or {"ok": false, "error": ...})
+    followed by N bytes of output. Over HTTP it is POSTed with an
+    "Authorization: Bearer TOKEN" header, where TOKEN is read from the file
+    token_file() (only the owner can read it, and browsers cannot send the
+    header cross-origin without a preflight the server never allows). The
+    output is the response body.
+    
+    Requests only set rendering options (BIDeT.job_options). The cache
+    settings are the server's own.
+    """
+    
+    formats = ['sixel', 'ansi', 'png']
+    content_types = {'sixel': 'image/x-sixel', 'ansi': 'text/plain; charset=utf-8', 'png': 'image/png'}
+    
+    # Longest request line accepted on the socket
+    max_request = 16 * 1024 * 1024
+    
+    def __init__(self, workers=2, debug=False, settings=None):
+        self.debug = debug
+        self.settings = settings
+        self.token = None
+        self.bidet = BIDeT()
+        self.bidet.debug = debug
+        self.gs_pool = GhostscriptPool(size=max(1, workers), debug=debug) if shutil.which("gs") else None
+        self.effects_processor = EffectsProcessor(debug=debug, gs_pool=self.gs_pool)
+        self.stderr = None
+        self.requests = 0
+        self.failures = 0
+    
+    @staticmethod
+    def default_socket():
+        """Return the default socket path"""
+        base = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp'
+        return os.path.join(base, f"bidet-{os.environ.get('USER', 'bidet')}.sock")
+    
+    @staticmethod
+    def token_file():
+        """Return the path of the file with the HTTP access token"""
+        base = os.environ.get('XDG_RUNTIME_DIR') or os.environ.get('TMPDIR') or '/tmp'
+        return os.path.join(base, f"bidet-{os.environ.get('USER', 'bidet')}.token")
+    
+    def _write_token(self):
+        """Create a new HTTP access token in a file only the owner can read"""
+        import secrets
         
-        proc = subprocess.run(gs_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.token = secrets.token_urlsafe(32)
+        path = self.token_file()
+        if os.path.lexists(path):
+            os.unlink(path)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.token + "\n")
+        return path
+    
+    def authorized(self, header):
+        """Check the Authorization header of an HTTP request"""
+        import hmac
         
-        if proc.returncode != 0:
-            print(f"Error: Failed to render PostScript: {proc.stderr.decode()}", file=sys.stderr)
-            sys.exit(1)
-            
-        # Load the PNG data into PIL
-        try:
-            img = Image.open(temp_png)
-            
-            # Make white background transparent
-            img = self._make_transparent_background(img)
-            
-            # Auto-crop the image - simplified for speed
-            if img.mode == 'RGBA':
-                # Get the alpha channel
-                alpha = img.split()[3]
-                # Get the bounding box of non-transparent pixels
-                bbox = alpha.getbbox()
-                if bbox:
-                    # Crop to bounding box
-                    img = img.crop(bbox)
-            
-            # Add a small padding
-            padding = 10
-            padded_size = (img.width + padding*2, img.height + padding*2)
-            padded_img = Image.new('RGBA', padded_size, (255, 255, 255, 0))
-            padded_img.paste(img, (padding, padding), img if img.mode == 'RGBA' else None)
-            
-            # Clean up the temporary PNG file unless in debug mode
-            if not self.debug and os.path.exists(temp_png):
-                os.unlink(temp_png)
-                
-            return padded_img
-            
-        except Exception as e:
-            print(f"Error: Failed to process image: {e}", file=sys.stderr)
-            sys.exit(1)
+        if not self.token or not header:
+            return False
+        return hmac.compare_digest(header.encode('utf-8'), f"Bearer {self.token}".encode('utf-8'))
     
-    def apply_effects(self, img, effects):
-        """Apply various effects to the image - optimized for speed
+    def render(self, job):
+        """Render one request
         
         Args:
-            img: PIL Image
-            effects: Dictionary of effects to apply
+            job: Dictionary of options, text and output format
             
         Returns:
-            PIL Image with effects applied
+            (format, bytes)
         """
-        # Make a copy to work with
-        result = img.copy()
-        
-        # Apply essential effects first (those that modify the base image)
-        
-        # Apply flip if requested
-        if effects.get('flip'):
-            flip_type = effects['flip']
-            if flip_type == 'horizontal':
-                result = ImageOps.mirror(result)
-            elif flip_type == 'vertical':
-                result = ImageOps.flip(result)
-            elif flip_type == 'both':
-                result = ImageOps.flip(ImageOps.mirror(result))
-        
-        # Apply color spill (gradient) if requested
-        if effects.get('colorspill'):
-            spill_colors = effects['colorspill'].split(',')
-            if len(spill_colors) == 2:
-                color1 = self._get_rgb_color(spill_colors[0])
-                color2 = self._get_rgb_color(spill_colors[1])
-                
-                # Create a gradient overlay image - simplified
-                gradient_img = Image.new('RGBA', result.size)
-                for y in range(0, result.height, 2):  # Step by 2 for speed
-                    # Calculate interpolation factor (0.0-1.0)
-                    t = y / result.height
-                    # Linear interpolation between colors
-                    r = int(color1[0] * (1-t) + color2[0] * t)
-                    g = int(color1[1] * (1-t) + color2[1] * t)
-                    b = int(color1[2] * (1-t) + color2[2] * t)
-                    # Draw a line of this color - use rectangle for speed
-                    ImageDraw.Draw(gradient_img).rectangle(
-                        [(0, y), (result.width, y+1)], fill=(r, g, b, 128))
-                
-                # Apply gradient overlay where the original image has content
-                if result.mode == 'RGBA':
-                    result = Image.alpha_composite(result, gradient_img)
-        
-        # Apply fade if requested (simple fades are fast)
-        if effects.get('fade'):
-            fade_type = effects['fade']
-            fade_amount = float(effects.get('fade_amount', '0.5'))
-            
-            if fade_type == 'transparent' and result.mode == 'RGBA':
-                # Simple alpha adjustment
-                r, g, b, a = result.split()
-                a = ImageEnhance.Brightness(a).enhance(1.0 - fade_amount)
-                result = Image.merge('RGBA', (r, g, b, a))
-            
-            elif fade_type == 'white':
-                # Simple brightness/contrast adjustment
-                result = ImageEnhance.Contrast(result).enhance(1.0 - fade_amount)
-                if result.mode == 'RGBA':
-                    result = ImageEnhance.Brightness(result).enhance(1.0 + fade_amount)
-            
-            elif fade_type == 'black':
-                # Simple brightness adjustment
-                result = ImageEnhance.Brightness(result).enhance(1.0 - fade_amount)
-        
-        # Now apply additive effects (patterns, shadows, etc.)
-        
-        # Apply pattern to background if requested
-        if effects.get('pattern'):
-            pattern_name = effects['pattern']
-            if pattern_name in self.patterns:
-                # Get pattern colors
-                pattern_colors = effects.get('pattern_colors', 'white,black').split(',')
-                color1 = self._get_rgb_color(pattern_colors[0])
-                color2 = self._get_rgb_color(pattern_colors[1] if len(pattern_colors) > 1 else 'black')
-                
-                # Use a smaller scale factor for speed with larger images
-                pattern_scale = int(effects.get('pattern_scale', '20'))
-                if result.width * result.height > 1000000:  # Large image
-                    pattern_scale = max(pattern_scale, 30)  # Use larger pattern elements
-                
-                pattern_img = self._create_pattern_image(
-                    pattern_name, result.size, color1 + (255,), color2 + (255,), pattern_scale)
-                
-                # Create a composite with the pattern as background
-                if result.mode == 'RGBA':
-                    new_img = pattern_img.copy()
-                    new_img.alpha_composite(result)
-                    result = new_img
+        fmt = job.get('format', 'sixel')
+        if fmt not in self.formats:
+            raise ValueError(f'unknown format "{fmt}"')
         
-        # Apply shadow if requested (this is an expensive operation)
-        if effects.get('shadow'):
-            shadow_type = effects['shadow']
-            shadow_offset = int(effects.get('shadow_offset', '5'))
-            shadow_color = self._get_rgb_color(effects.get('shadow_color', 'black')) + (128,)  # Add alpha
-            
-            if shadow_type == 'drop':
-                # Create a shadow by offsetting a darkened copy - simplified
-                shadow_mask = result.split()[3] if result.mode == 'RGBA' else Image.new('L', result.size, 0)
-                
-                # Create a new canvas large enough for image and shadow
-                new_size = (result.width + shadow_offset, result.height + shadow_offset)
-                new_img = Image.new('RGBA', new_size, (0, 0, 0, 0))
-                
-                # Create the shadow
-                shadow = Image.new('RGBA', result.size, shadow_color)
-                
-                # Paste shadow first, then original image
-                new_img.paste(shadow, (shadow_offset, shadow_offset), shadow_mask)
-                new_img.paste(result, (0, 0), result if result.mode == 'RGBA' else None)
-                
-                result = new_img
-                
-            elif shadow_type == '3d':
-                # Simplified 3D effect with fewer layers for speed
-                layers = min(3, shadow_offset // 2)  # Reduced number of layers
-                step = max(1, shadow_offset // layers)
-                
-                # Create a new canvas large enough for all layers
-                new_size = (result.width + shadow_offset, result.height + shadow_offset)
-                new_img = Image.new('RGBA', new_size, (0, 0, 0, 0))
-                
-                # Get alpha mask
-                shadow_mask = result.split()[3] if result.mode == 'RGBA' else Image.new('L', result.size, 0)
-                
-                # Add shadow layers from back to front
-                for i in range(layers, 0, -1):
-                    offset = i * step
-                    shadow_color_with_alpha = shadow_color[0:3] + (int(128 * (i / layers)),)
-                    shadow = Image.new('RGBA', result.size, shadow_color_with_alpha)
-                    new_img.paste(shadow, (offset, offset), shadow_mask)
-                
-                # Finally add the original image on top
-                new_img.paste(result, (0, 0), result if result.mode == 'RGBA' else None)
-                
-                result = new_img
-        
-        # Apply tiling last (as it enlarges the image)
-        if effects.get('tile'):
-            tile_type = effects['tile']
-            # Reduce default tile count for speed
-            tile_count = min(2, int(effects.get('tile_count', '3')))
-            
-            # Create a larger canvas
-            if tile_type == 'grid':
-                # Simple grid tiling
-                tile_size = (result.width, result.height)
-                new_size = (tile_size[0] * tile_count, tile_size[1] * tile_count)
-                tiled_img = Image.new('RGBA', new_size, (0, 0, 0, 0))
-                
-                for y in range(0, new_size[1], tile_size[1]):
-                    for x in range(0, new_size[0], tile_size[0]):
-                        tiled_img.paste(result, (x, y), result if result.mode == 'RGBA' else None)
-                
-                result = tiled_img
-                
-            elif tile_type == 'mirror':
-                # Simple mirrored tiling - pre-compute flipped versions for speed
-                tile_size = (result.width, result.height)
-                new_size = (tile_size[0] * tile_count, tile_size[1] * tile_count)
-                tiled_img = Image.new('RGBA', new_size, (0, 0, 0, 0))
-                
-                # Pre-compute the four tile variants
-                tiles = [
-                    result,  # Normal
-                    ImageOps.mirror(result),  # Horizontal flip
-                    ImageOps.flip(result),  # Vertical flip
-                    ImageOps.flip(ImageOps.mirror(result))  # Both flips
-                ]
-                
-                for y in range(tile_count):
-                    for x in range(tile_count):
-                        # Determine which variant to use based on position
-                        tile_idx = (x % 2) + 2 * (y % 2)
-                        tiled_img.paste(tiles[tile_idx], 
-                                       (x * tile_size[0], y * tile_size[1]), 
-                                       tiles[tile_idx] if tiles[tile_idx].mode == 'RGBA' else None)
-                
-                result = tiled_img
+        args = self.bidet.job_to_args(job, self.settings)
+        args.pipe = True  # never use the shared scratch directory
+        if fmt == 'ansi' and args.max_width_px is None:
+            args.max_width_px = args.max_cols or job.get('columns')
+        text_lines = self.bidet.read_text(args, files=False)
         
-        return result
+        term_foreground, term_background = job.get('terminal') or ("black", "white")
+        img, background = self.bidet.prepare_image(args, text_lines, term_foreground, term_background,
+                                                   self.effects_processor)
+        return fmt, self.effects_processor.encode_image(img, background, fmt, job.get('columns'),
+                                                        args.ansi_colors)
     
-    def save_image(self, img, output_file, format='PNG'):
-        """Save the image to a file
+    def process(self, request):
+        """Run a request, turning any failure into an error message
         
         Args:
-            img: PIL Image
-            output_file: Output filename
-            format: Image format (PNG, JPEG, etc.)
+            request: JSON request as bytes or str
             
         Returns:
-            Path to the saved file
+            (header dictionary, output bytes)
         """
+        start_time = time.time()
+        messages = io.StringIO()
+        if self.stderr:
+            self.stderr.capture(messages)
         try:
-            img.save(output_file, format=format)
-            return output_file
+            fmt, data = self.render(json.loads(request))
+            header = {'ok': True, 'format': fmt, 'length': len(data)}
+        except SystemExit as e:
+            # Validation errors print a message and exit
+            lines = messages.getvalue().strip().splitlines()
+            error = lines[-1] if lines else f"exit status {e.code}"
+            if error.startswith("Error: "):
+                error = error[len("Error: "):]
+            header, data = {'ok': False, 'error': error}, b""
         except Exception as e:
-            print(f"Error: Failed to save image: {e}", file=sys.stderr)
-            sys.exit(1)
+            header, data = {'ok': False, 'error': f"{type(e).__name__}: {e}"}, b""
+        finally:
+            if self.stderr:
+                self.stderr.capture(None)
+        
+        self.requests += 1
+        if not header['ok']:
+            self.failures += 1
+        if self.debug:
+            sys.stderr.write(messages.getvalue())
+            status = 'ok' if header['ok'] else f"FAIL {header['error']}"
+            print(f"Request {self.requests}: {status} ({time.time() - start_time:.3f} seconds)", file=sys.stderr)
+        return header, data
     
-    def img_to_sixel(self, img, bg_color):
-        """Convert PIL image to Sixel and output to stdout
+    def _unix_server(self, path):
+        """Create the Unix socket server, replacing a stale socket file"""
+        import socket
+        import socketserver
         
-        Args:
-            img: PIL Image
-            bg_color: Background color for Sixel
-        """
-        # Save to a temporary PNG file
-        temp_file = tempfile.mktemp(suffix='.png')
-        self.save_image(img, temp_file)
+        server = self
         
-        # Check if img2sixel exists
-        if not shutil.which("img2sixel"):
-            print("Error: img2sixel command not found", file=sys.stderr)
-            sys.exit(1)
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = self.rfile.readline(server.max_request)
+                if not request.strip():
+                    return
+                header, data = server.process(request)
+                self.wfile.write(json.dumps(header).encode('utf-8') + b"\n" + data)
+        
+        if os.path.exists(path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.connect(path)
+                except OSError:
+                    os.unlink(path)  # left behind by a server that died
+                else:
+                    raise RuntimeError(f"a server is already listening on {path}")
         
-        # Run img2sixel
+        # Only the owner may connect
+        old_umask = os.umask(0o077)
         try:
-            subprocess.run(["img2sixel", "-I", "-B", bg_color, temp_file], check=True)
-        except Exception as e:
-            print(f"Error: Failed to convert to Sixel: {e}", file=sys.stderr)
-            sys.exit(1)
+            unix_server = socketserver.ThreadingUnixStreamServer(path, Handler)
         finally:
-            # Remove temporary file
-            if os.path.exists(temp_file):
-                os.unlink(temp_file)
+            os.umask(old_umask)
+        unix_server.daemon_threads = True
+        return unix_server
     
-    def img_to_ansi(self, img, bg_color):
-        """Convert PIL image to ANSI and output to stdout
+    def _http_server(self, port):
+        """Create the HTTP server on the loopback interface"""
+        import http.server
+        
+        server = self
+        
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                if not server.authorized(self.headers.get('Authorization')):
+                    self.send_error(401)
+                    return
+                length = int(self.headers.get('Content-Length', 0))
+                if length > server.max_request:
+                    self.send_error(413)
+                    return
+                header, data = server.process(self.rfile.read(length))
+                if header['ok']:
+                    self.send_response(200)
+                    self.send_header('Content-Type', server.content_types[header['format']])
+                else:
+                    data = (header['error'] + "\n").encode('utf-8')
+                    self.send_response(400)
+                    self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def log_message(self, format, *args):
+                if server.debug:
+                    super().log_message(format, *args)
+        
+        http_server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        http_server.daemon_threads = True
+        return http_server
+    
+    def serve(self, path, port=None):
+        """Serve requests until interrupted
         
         Args:
-            img: PIL Image
-            bg_color: Background color for ANSI
+            path: Unix socket path
+            port: Serve HTTP on this localhost port instead of the socket
+            
+        Returns:
+            Exit status
         """
-        # Save to a temporary PNG file
-        temp_file = tempfile.mktemp(suffix='.png')
-        self.save_image(img, temp_file)
+        import signal
         
-        # Check if img2ans exists
-        if not shutil.which("img2ans"):
-            print("Error: img2ans command not found", file=sys.stderr)
-            sys.exit(1)
+        try:
+            server = self._http_server(port) if port else self._unix_server(path)
+            if port:
+                token_path = self._write_token()
+        except (OSError, RuntimeError) as e:
+            print(f"Error: Failed to start the render server: {e}", file=sys.stderr)
+            return 1
         
-        # Run img2ans
+        # Warm up the font metrics so the first request does not pay for it
+        FontMetrics.extent("Helvetica", 1)
+        
+        def stop(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, stop)
+        
+        self.stderr = _ThreadStderr(sys.stderr)
+        sys.stderr = self.stderr
+        where = f"http://127.0.0.1:{port}/ (token in {token_path})" if port else path
+        print(f"BIDeT render server listening on {where}", file=sys.stderr)
         try:
-            subprocess.run(["img2ans", "-b", bg_color, temp_file], check=True)
-        except Exception as e:
-            print(f"Error: Failed to convert to ANSI: {e}", file=sys.stderr)
-            sys.exit(1)
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
         finally:
-            # Remove temporary file
-            if os.path.exists(temp_file):
-                os.unlink(temp_file)
+            server.server_close()
+            if not port and os.path.exists(path):
+                os.unlink(path)
+            if port and os.path.exists(token_path):
+                os.unlink(token_path)
+            if self.gs_pool:
+                self.gs_pool.close()
+            sys.stderr = self.stderr.stream
+        
+        print(f"Served {self.requests} requests ({self.failures} failed)", file=sys.stderr)
+        return 0
+    
+    @staticmethod
+    def request(path, job, timeout=30):
+        """Send a request to a running server (client side)
+        
+        Args:
+            path: Unix socket path
+            job: Request dictionary
+            timeout: Seconds to wait for the server
+            
+        Returns:
+            Output bytes
+            
+        Raises:
+            OSError if no server answered, RuntimeError if it could not render
+        """
+        import socket
+        
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps(job).encode('utf-8') + b"\n")
+            with sock.makefile('rb') as f:
+                line = f.readline()
+                if not line:
+                    raise ConnectionError("the server closed the connection")
+                header = json.loads(line)
+                if not header.get('ok'):
+                    raise RuntimeError(header.get('error', 'request failed'))
+                data = f.read(header['length'])
+        
+        if len(data) != header['length']:
+            raise ConnectionError("short reply from the server")
+        return data
 
 
 class BIDeT:
     """BIDeT - Use this after you're done with Toilet!"""
     
+    # Keys of batch jobs and server requests that are not command line options
+    job_keys = ('text', 'output', 'format', 'columns', 'terminal')
+    
+    # Options a batch job or server request may set: rendering only, nothing
+    # that touches files or the process (cache, profiling, debug output)
+    job_options = (
+        'ansi', 'background', 'colour', 'font', 'line', 'preserve', 'rotate', 'size', 'width',
+        'flip', 'colorspill', 'colorspill_direction', 'pattern', 'pattern_colors', 'pattern_scale',
+        'tile', 'tile_count', 'fade', 'fade_amount', 'shadow', 'shadow_offset', 'shadow_blur',
+        'shadow_color', 'ansi_colors', 'engine', 'vector', 'white_key', 'max_width_px', 'max_cols',
+        'no_cache',
+    )
+    
+    # Options of the batch run or server that apply to all of its jobs (a
+    # job can still turn the cache off for itself)
+    job_settings = ('no_cache', 'cache_dir', 'cache_size')
+    
     def __init__(self):
         self.debug = False
         self.temp_dir = None
         self.temp_prefix = None
+        self.terminal = None
+        self.tracer = Tracer()
     
-    def test_sixel(self):
-        """Test if the terminal supports Sixel"""
+    def test_sixel(self, args=None):
+        """Test if the terminal supports Sixel
+        
+        The answer is cached per terminal (see TerminalInfo).
+        
+        Returns:
+            (foreground, background) colours of the terminal
+        """
         try:
-            # Mock response for testing if command not available
-            if not shutil.which("test-sixel"):
-                return "black", "white"
-                
-            result = subprocess.run(["test-sixel"], capture_output=True, text=True)
-            output = result.stdout.strip()
-            
-            match = re.search(r'Sixel support found. fg=(\S+) bg=(\S+) nc=(\S+)', output)
-            if match:
-                return match.group(1), match.group(2)
-            else:
-                return "black", "white"
-        except:
+            info = self.terminal_info(args)
+            return info['foreground'], info['background']
+        except Exception:
             return "black", "white"
     
-    def collapse_or_find_font(self, mode, font, available_fonts):
-        """Collapse font names or find a matching font"""
-        try:
-            with open('/usr/local/share/BIDeT/fontsuffixlist.txt', 'r') as f:
-                types = [line.strip() for line in f]
-        except FileNotFoundError:
-            types = []
-            
-        # Sort by length
-        types.sort(key=len, reverse=True)
-        
-        if mode == "collapse":
-            # Collapse fonts mode
-            seen = set()
-            collapsed_fonts = []
-            
-            for font_name in available_fonts:
-                # Remove specified suffixes
-                for suffix in types:
-                    if font_name.endswith(suffix) or font_name.endswith('-' + suffix):
-                        font_name = font_name[:-len(suffix)]
-                        if font_name.endswith('-'):
-                            font_name = font_name[:-1]
-                        break
-                
-                # Add base font to collapsed list if not seen
-                if font_name not in seen:
-                    collapsed_fonts.append(font_name)
-                    seen.add(font_name)
-                    
-            return collapsed_fonts
-            
-        elif mode == "search":
-            # Find closest font mode
-            for suffix in reversed(types):
-                # Try without dash
-                candidate = font + suffix
-                if candidate in available_fonts:
-                    if self.debug:
-                        print(f"Debug: font={candidate}", file=sys.stderr)
-                    return candidate
-                
-                # Try with dash
-                candidate = font + '-' + suffix
-                if candidate in available_fonts:
-                    if self.debug:
-                        print(f"Debug: font={candidate}", file=sys.stderr)
-                    return candidate
-                    
-            return None
+    def terminal_info(self, args=None):
+        """Return the (cached) capabilities of the terminal"""
+        if self.terminal is None:
+            cache_dir = args.cache_dir if args else None
+            ttl = args.terminal_ttl if args else 3600
+            refresh = args.refresh_terminal if args else False
+            self.terminal = TerminalInfo(cache_dir, ttl, debug=self.debug).get(refresh)
+        return self.terminal
     
     def test_font(self, font, iso):
         """Test if font is valid and potentially list available fonts"""
-        isofonts = PostScriptSimple.isofonts
-        fonts = PostScriptSimple.extfonts
+        index = FontIndex.load(self.debug)
         
         # List fonts
         if font == "list":
             print("--- Regular ---")
-            collapsed = self.collapse_or_find_font("collapse", "", fonts)
-            for f in sorted(collapsed):
+            for f in sorted(index.bases):
                 print(f)
                 
             print("--- Latin1 compatible ---")
-            iso_collapsed = self.collapse_or_find_font("collapse", "", isofonts)
-            for f in sorted(iso_collapsed):
+            for f in sorted(index.iso_bases):
                 print(f)
             sys.exit(0)
         
         # Random font
         if font == "random":
-            if iso:
-                font = random.choice(isofonts)
-            else:
-                font = random.choice(fonts)
+            font = index.random(iso)
+        
+        # Check if font is valid (exact, another case or a base name)
+        closest_font = index.find(font, iso)
+        if not closest_font:
+            kind = "ISO font" if iso else "font"
+            suggestion = index.nearest(font, iso)
+            hint = f" (did you mean {suggestion}?)" if suggestion else ""
+            print(f"Error: Invalid {kind}: {font}{hint}", file=sys.stderr)
+            sys.exit(1)
+        if closest_font != font and self.debug:
+            print(f"Debug: font={closest_font}", file=sys.stderr)
+        font = closest_font
         
-        # Check if font is valid
         if iso:
-            if font not in isofonts:
-                closest_font = self.collapse_or_find_font("search", font, isofonts)
-                if closest_font:
-                    font = closest_font
-                else:
-                    print(f"Error: Invalid ISO font: {font}", file=sys.stderr)
-                    sys.exit(1)
             font += "-iso"
-        else:
-            if font not in fonts and font not in isofonts:
-                closest_font = self.collapse_or_find_font("search", font, fonts + isofonts)
-                if closest_font:
-                    font = closest_font
-                else:
-                    print(f"Error: Invalid font: {font}", file=sys.stderr)
-                    sys.exit(1)
-        
         return font
     
     def test_colours(self, colour, background):
@@ -1046,16 +3795,16 @@ class BIDeT:
             print(f"  - {p}")
         sys.exit(0)
     
-    def check_required_tools(self):
+    def check_required_tools(self, engine='ps'):
         """Check if required tools are available"""
         missing_tools = []
         
         # Check for Ghostscript
-        if not shutil.which("gs"):
+        if engine == 'ps' and not shutil.which("gs"):
             missing_tools.append("gs (Ghostscript)")
         
-        # Check for image conversion tools
-        if not shutil.which("img2sixel") and not shutil.which("img2ans"):
+        # Check for image conversion tools (Sixel can be encoded in-process)
+        if not shutil.which("img2sixel") and not shutil.which("img2ans") and not SixelEncoder.available():
             missing_tools.append("img2sixel or img2ans")
         
         if missing_tools:
@@ -1063,8 +3812,301 @@ class BIDeT:
             print("Please install the necessary packages", file=sys.stderr)
             sys.exit(1)
     
-    def main(self):
-        """Main function - optimized for speed"""
+    def render_banner(self, text_lines, font, colour, args, effects, effects_processor, resolution=None,
+                      vector=None, coverage=False):
+        """Render the text to an image and apply rotation and effects
+        
+        Args:
+            text_lines: Wrapped lines of text
+            font: Validated font name
+            colour: Text colour name or 48-bit hex value
+            args: Parsed command line options
+            effects: Dictionary of effects to apply
+            effects_processor: EffectsProcessor to render with
+            resolution: Resolution in dots per inch (default: EffectsProcessor.resolution)
+            vector: Effects drawn in PostScript, from vector_effects() (the
+                rotation is then part of the page)
+            coverage: Render and process an 'L' coverage mask, coloured
+                at output (see use_coverage())
+            
+        Returns:
+            PIL Image, a CoverageImage in coverage mode
+        """
+        # A coverage render draws the text in black, the colour comes later
+        text_colour = 'black' if coverage else colour
+        
+        span = self.tracer.begin('render', engine=args.engine, lines=len(text_lines),
+                                 resolution=resolution)
+        
+        if args.engine == 'pillow':
+            # Lay the text out with FreeType, no PostScript or Ghostscript
+            img = effects_processor.render_text_pillow(text_lines, font, args.size, args.line, colour,
+                                                       resolution, coverage)
+        else:
+            if effects_processor.gs_pool:
+                # Reuse a running interpreter
+                ps_span = self.tracer.begin('ps_generate')
+                ps = self.build_document(text_lines, font, text_colour, args, vector=vector)
+                self.tracer.end(ps_span)
+                img = effects_processor.render_ps_document(ps, resolution, coverage)
+            elif args.pipe:
+                # Stream the PostScript through gs without touching the disk
+                img = effects_processor.render_ps_stream(
+                    lambda out: self.build_document(text_lines, font, text_colour, args, out=out,
+                                                    vector=vector),
+                    resolution, coverage)
+            else:
+                # Create output filenames
+                ps_file = f"{self.temp_prefix}.ps"
+            
+                # Write PostScript to file as it is generated
+                ps_span = self.tracer.begin('ps_generate')
+                with open(ps_file, 'wb') as out:
+                    self.build_document(text_lines, font, text_colour, args, out=out, vector=vector)
+                self.tracer.end(ps_span)
+            
+                # Debug: print PS file if requested
+                if self.debug:
+                    print(f"PostScript file generated at: {ps_file}", file=sys.stderr)
+            
+                # Render PostScript to image
+                img = effects_processor.render_ps_to_image(ps_file, resolution, coverage)
+        
+        self.tracer.end(span, img)
+        
+        # Handle rotation before effects
+        if args.rotate and not vector:
+            span = self.tracer.begin('rotate')
+            img = img.rotate(270, expand=True)
+            self.tracer.end(span, img)
+        
+        # Apply effects if any - only if needed
+        if effects:
+            span = self.tracer.begin('effects')
+            img = effects_processor.apply_effects(img, effects)
+            self.tracer.end(span, img)
+        
+        if coverage:
+            img = CoverageImage.wrap(img, effects_processor._get_rgb_color(colour))
+        return img
+    
+    def use_coverage(self, args, effects, vector=None):
+        """Whether the banner can stay an 8-bit coverage mask until output
+        
+        True when it is one colour of text: every raster effect only moves
+        pixels around, the PostScript stage adds no second colour and no
+        white-keying is needed.
+        
+        Args:
+            args: Parsed command line options
+            effects: Raster effects to apply
+            vector: Effects drawn in PostScript, from vector_effects()
+            
+        Returns:
+            bool
+        """
+        if args.white_key:
+            return False
+        if vector and (vector.get('spill') or vector.get('shadow_offset')):
+            return False
+        return all(name in EffectsProcessor.coverage_effects
+                   for name in EffectsProcessor.effect_registry if effects.get(name))
+    
+    def build_document(self, text_lines, font, colour, args, out=None, vector=None):
+        """Build the PostScript document for the text
+        
+        Args:
+            text_lines: Wrapped lines of text
+            font: Validated font name
+            colour: Text colour name or 48-bit hex value
+            args: Parsed command line options
+            out: Binary stream to write the finished document to as it is
+                built, instead of keeping it in memory
+            vector: Effects to draw in PostScript, from vector_effects()
+            
+        Returns:
+            PostScriptSimple document
+        """
+        vector = vector or {}
+        
+        # Size the page to the text so the raster scales with the banner
+        line_spacing = args.size * args.line
+        margin = 10
+        ascent, descent = FontMetrics.extent(font, args.size)
+        text_width = max((FontMetrics.string_width(font, line, args.size) for line in text_lines),
+                         default=0)
+        page_width = math.ceil(margin + text_width + ascent / 4 + margin)  # allow for italic overhang
+        page_height = math.ceil((len(text_lines) - 1) * line_spacing + ascent + descent + margin * 2)
+        
+        # The banner as it ends up on the page: turned right, flipped, and
+        # moved up by the shadow offset (the shadow is drawn down and right)
+        matrices = []
+        final_width, final_height = page_width, page_height
+        if vector.get('rotate'):
+            final_width, final_height = page_height, page_width
+        flip = vector.get('flip')
+        if flip in ('horizontal', 'both'):
+            matrices.append([-1, 0, 0, 1, final_width, 0])
+        if flip in ('vertical', 'both'):
+            matrices.append([1, 0, 0, -1, 0, final_height])
+        if vector.get('rotate'):
+            matrices.append([0, -1, 1, 0, 0, page_width])
+        offset = vector.get('shadow_offset', 0)
+        
+        # Create PostScript file
+        spill = vector.get('spill')
+        ps = PostScriptSimple(
+            colour=True,
+            eps=False,
+            units="in",
+            reencode="ISOLatin1Encoding",
+            xsize=final_width + offset,
+            ysize=final_height + offset,
+            out=out,
+            languagelevel=3 if spill else 1
+        )
+        
+        ps.newpage()
+        
+        # Calculate the starting y position based on the number of text lines
+        y_position = page_height - margin - ascent
+        
+        # Shadow first, then the text over it
+        passes = [(0, offset, colour, bool(spill))]
+        if offset:
+            passes.insert(0, (offset, 0, vector['shadow_colour'], False))
+        for dx, dy, pass_colour, shade in passes:
+            ps.gsave()
+            if dx or dy:
+                ps.translate(dx, dy)
+            if shade:
+                ps.pushmatrix()
+            for matrix in matrices:
+                ps.concat(matrix)
+            
+            # Set color
+            if isinstance(pass_colour, tuple):
+                ps.setcolour(*pass_colour)
+            elif pass_colour.startswith('#') and len(pass_colour) == 13:
+                # Hex color format
+                r, g, b = self.hex48_to_rgb(pass_colour)
+                ps.setcolour(r, g, b)
+            else:
+                # Named color
+                ps.setcolour(pass_colour)
+            
+            # Set font
+            ps.setfont(font, args.size)
+            
+            if shade:
+                # Paint the gradient through the outlines of the text, in
+                # the coordinates of the final banner
+                ps.text_block(margin, y_position, text_lines, line_spacing, path=True)
+                ps.clip()
+                ps.popmatrix()
+                ps.axial_shade(*self._gradient_line(vector['spill_direction'], final_width, final_height),
+                               spill)
+            else:
+                # Add text lines, many per procedure call
+                ps.text_block(margin, y_position, text_lines, line_spacing)
+            ps.grestore()
+        
+        if out is not None:
+            ps.finish()
+        return ps
+    
+    @staticmethod
+    def _gradient_line(direction, width, height):
+        """Start and end of a gradient over a width x height box, like the
+        colorspill effect (first colour at the top, the left or the top left)
+        
+        Returns:
+            (x0, y0, x1, y1) tuple
+        """
+        if direction == 'horizontal':
+            return 0, height, width, height
+        if direction == 'diagonal':
+            # Reaches the end where x / width + depth / height is 2, so
+            # each stop runs along the same diagonal as in the raster
+            scale = 2 / (1 / width ** 2 + 1 / height ** 2)
+            return 0, height, scale / width, height - scale / height
+        return 0, height, 0, 0
+    
+    def vector_effects(self, args, effects, colour, background, resolution, effects_processor):
+        """Split the effects into those drawn in PostScript (--vector) and
+        those applied to the rendered image
+        
+        Rotation, flips, colour gradients and drop shadows become part of
+        the page, so Ghostscript rasterises the final banner in one go. An
+        effect is only moved when every raster effect before it moves too.
+        
+        Args:
+            args: Parsed command line options
+            effects: Dictionary of effects to apply
+            colour: Text colour, for the translucent gradient
+            background: Output background colour, for the translucent shadow
+            resolution: Resolution in dots per inch
+            effects_processor: EffectsProcessor, for the colours
+            
+        Returns:
+            (vector effects for build_document, remaining effects)
+        """
+        if not args.vector or args.engine != 'ps':
+            return None, effects
+        
+        remaining = dict(effects)
+        vector = {'rotate': args.rotate, 'flip': remaining.pop('flip', None)}
+        
+        # The colorspill gradient is drawn at half opacity, mixed with the text
+        if 'colorspill' in remaining:
+            stops = effects_processor._spill_colors(remaining)
+            if stops:
+                text = effects_processor._get_rgb_color(colour)
+                vector['spill'] = [tuple((c * 128 + t * 127) // 255 for c, t in zip(stop, text))
+                                   for stop in stops]
+                vector['spill_direction'] = remaining.get('colorspill_direction', 'vertical')
+            remaining.pop('colorspill')
+            remaining.pop('colorspill_direction', None)
+        
+        # A drop shadow is the text again, offset and mixed with the background
+        if remaining.get('shadow') == 'drop' and not ('fade' in remaining or 'pattern' in remaining):
+            offset = int(remaining.pop('shadow_offset', '5'))
+            shadow = effects_processor._get_rgb_color(remaining.pop('shadow_color', 'black'))
+            back = effects_processor._get_rgb_color(background)
+            vector['shadow_offset'] = offset * 72 / resolution
+            vector['shadow_colour'] = tuple((s * 128 + b * 127) // 255 for s, b in zip(shadow, back))
+            remaining.pop('shadow')
+        
+        return vector, remaining
+    
+    def collect_effects(self, args):
+        """Build the effects dictionary from the command line options"""
+        effects = {}
+        if args.flip:
+            effects['flip'] = args.flip
+        if args.colorspill:
+            effects['colorspill'] = args.colorspill
+            effects['colorspill_direction'] = args.colorspill_direction
+        if args.pattern:
+            effects['pattern'] = args.pattern
+            effects['pattern_colors'] = args.pattern_colors
+            effects['pattern_scale'] = args.pattern_scale
+        if args.tile:
+            effects['tile'] = args.tile
+            effects['tile_count'] = args.tile_count
+        if args.fade:
+            effects['fade'] = args.fade
+            effects['fade_amount'] = args.fade_amount
+        if args.shadow:
+            effects['shadow'] = args.shadow
+            effects['shadow_offset'] = args.shadow_offset
+            effects['shadow_color'] = args.shadow_color
+            if args.shadow == 'soft':
+                effects['shadow_blur'] = args.shadow_blur
+        return effects
+    
+    def build_parser(self):
+        """Build the command line parser (also used for batch jobs)"""
         parser = argparse.ArgumentParser(description='BIDeT - Use this after you\'re done with Toilet!')
         
         # Basic options
@@ -1083,8 +4125,10 @@ class BIDeT:
         # New effects options
         parser.add_argument('--flip', choices=['horizontal', 'vertical', 'both'], 
                           help='Flip the image')
-        parser.add_argument('--colorspill', metavar='COLOR1,COLOR2',
-                          help='Apply a color gradient (e.g., red,blue)')
+        parser.add_argument('--colorspill', metavar='COLOR1,COLOR2[,...]',
+                          help='Apply a color gradient (e.g., red,blue or red,yellow,blue)')
+        parser.add_argument('--colorspill-direction', choices=['vertical', 'horizontal', 'diagonal'],
+                          default='vertical', help='Direction of the color gradient (default: vertical)')
         parser.add_argument('--pattern', metavar='PATTERN',
                           help='Add pattern to background')
         parser.add_argument('--pattern-colors', metavar='COLOR1,COLOR2', default='white,black',
@@ -1101,58 +4145,106 @@ class BIDeT:
                           help='Apply a fade effect')
         parser.add_argument('--fade-amount', type=float, default=0.5,
                           help='Amount of fading (0.0-1.0, default: 0.5)')
-        parser.add_argument('--shadow', choices=['drop', '3d'],
-                          help='Add a shadow or 3D effect')
+        parser.add_argument('--shadow', choices=['drop', '3d', 'soft'],
+                          help='Add a shadow, 3D effect or blurred shadow')
         parser.add_argument('--shadow-offset', type=int, default=5,
                           help='Shadow offset in pixels (default: 5)')
+        parser.add_argument('--shadow-blur', type=int,
+                          help='Blur radius of the soft shadow in pixels (default: the shadow offset)')
         parser.add_argument('--shadow-color', default='black',
                           help='Shadow color (default: black)')
         
-        parser.add_argument('text', nargs='*', help='Text to display or filename')
-        
-        args = parser.parse_args()
-        
-        # Set up debug mode
-        self.debug = args.debug
-        
-        # Show version
-        if args.version:
-            print("Version: 2.0")
-            sys.exit(0)
+        parser.add_argument('--sixel-encoder', choices=['native', 'img2sixel'], default='native',
+                          help='Sixel encoder to use (default: native, needs NumPy)')
+        parser.add_argument('--ansi-encoder', choices=['native', 'img2ans'], default='native',
+                          help='ANSI renderer to use (default: native, needs NumPy)')
+        parser.add_argument('--ansi-colors', choices=['auto'] + AnsiRenderer.modes, default='auto',
+                          help='ANSI colour mode (default: auto)')
+        parser.add_argument('--engine', choices=['ps', 'pillow'], default='ps',
+                          help='Rendering engine: PostScript/Ghostscript or Pillow/FreeType (default: ps)')
+        parser.add_argument('--vector', action='store_true',
+                          help='Draw the rotation, flips, gradient and drop shadow in PostScript '
+                               'instead of on the rendered image (ps engine only)')
+        parser.add_argument('--white-key', action='store_true',
+                          help='Make near-white pixels transparent instead of trusting the alpha channel')
+        parser.add_argument('--pipe', action='store_true',
+                          help='Use pipes only, no temporary files')
+        parser.add_argument('--stream', action='store_true',
+                          help='Render and print the input a chunk of lines at a time as it is read '
+                               '(for long files, gradients and patterns restart in every chunk)')
+        parser.add_argument('--chunk-lines', type=int, default=20,
+                          help='Lines per chunk for --stream (default: 20)')
+        parser.add_argument('--max-width-px', type=int, metavar='PX',
+                          help='Render no wider than needed for PX output pixels '
+                               '(default: the terminal width when printing to a terminal, 0: no limit)')
+        parser.add_argument('--max-cols', type=int, metavar='COLS',
+                          help='Render no wider than needed for COLS terminal columns '
+                               '(the output width in cells; -w/--width is the wrap width in characters)')
         
-        # List patterns if requested
-        if args.list_patterns:
-            self.list_patterns()
+        # Instrumentation options
+        parser.add_argument('--profile', choices=['json', 'text'],
+                          help='Report the time, image size and peak memory of every stage '
+                               '(json: one record per run)')
+        parser.add_argument('--profile-file', metavar='FILE',
+                          help='Append --profile records to FILE instead of printing them on stderr')
+        parser.add_argument('--cprofile', metavar='FILE',
+                          help='Save cProfile statistics of the run to FILE')
         
-        # Check for required tools
-        self.check_required_tools()
+        # Terminal detection options
+        parser.add_argument('--refresh-terminal', action='store_true',
+                          help='Detect the terminal capabilities again instead of using the cached ones')
+        parser.add_argument('--terminal-ttl', type=int, default=3600,
+                          help='Seconds to reuse detected terminal capabilities (default: 3600)')
         
-        # Create temp directory for files
-        if os.path.exists("/dev/shm"):
-            # Use /dev/shm for better performance on Linux
-            shm_path = f"/dev/shm/{os.environ.get('USER', 'bidet')}"
-            os.makedirs(shm_path, exist_ok=True)
-            self.temp_prefix = os.path.join(shm_path, f"bidet_tmp_{int(time.time())}")
-        else:
-            # Fallback to regular temp directory
-            self.temp_dir = tempfile.mkdtemp(prefix="bidet_")
-            self.temp_prefix = os.path.join(self.temp_dir, "bidet_tmp")
+        # Render cache options
+        parser.add_argument('--no-cache', action='store_true',
+                          help='Do not use the render cache')
+        parser.add_argument('--cache-dir', metavar='DIR',
+                          help='Render cache directory (default: ~/.cache/bidet)')
+        parser.add_argument('--cache-size', type=int, default=64,
+                          help='Maximum render cache size in MB (default: 64)')
         
-        # Check for terminal Sixel support
-        term_foreground, term_background = self.test_sixel()
+        # Batch options
+        parser.add_argument('--batch', metavar='FILE',
+                          help='Render the jobs of a JSONL manifest (one object of options and "output" per line)')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                          help='Worker processes for --batch, Ghostscript interpreters for --serve '
+                               '(default: number of CPUs)')
         
-        # Font testing
-        if args.font == "list":
-            self.test_font(args.font, False)
+        # Render server options
+        parser.add_argument('--serve', action='store_true',
+                          help='Run a resident render server')
+        parser.add_argument('--client', action='store_true', default=bool(os.environ.get('BIDET_SOCKET')),
+                          help='Render through a running server, locally if none answers '
+                               '(default when BIDET_SOCKET is set)')
+        parser.add_argument('--socket', metavar='PATH',
+                          default=os.environ.get('BIDET_SOCKET') or RenderServer.default_socket(),
+                          help='Render server socket (default: $BIDET_SOCKET or $XDG_RUNTIME_DIR/bidet-$USER.sock)')
+        parser.add_argument('--http', type=int, metavar='PORT',
+                          help='Make --serve listen for HTTP POSTs on 127.0.0.1:PORT instead of the socket '
+                               '(requests need "Authorization: Bearer TOKEN", TOKEN is in '
+                               '$XDG_RUNTIME_DIR/bidet-$USER.token)')
         
-        # Color testing
-        if args.colour == "list" or args.background == "list":
-            self.test_colours(args.colour, args.background)
+        parser.add_argument('text', nargs='*', help='Text to display or filename')
+        return parser
+    
+    def read_text(self, args, files=True):
+        """Read the input text and wrap it unless newlines are preserved
         
+        Args:
+            args: Parsed command line options
+            files: Allow reading the text from stdin or a file
+            
+        Returns:
+            List of text lines
+        """
         # Get input text
         text_lines = []
         
-        if not args.text:
+        if not files:
+            # Text given directly (render server requests)
+            text_lines = args.text
+        elif not args.text:
             # No arguments, read from stdin
             text_lines = sys.stdin.readlines()
         elif args.text[0] == '-':
@@ -1173,6 +4265,76 @@ class BIDeT:
             wrapped_text = textwrap.fill(text, args.width)
             text_lines = wrapped_text.split('\n')
         
+        return text_lines
+    
+    def iter_text(self, args):
+        """Read the input text lazily, wrapping it as it arrives
+        
+        Gives the same lines as read_text, but stdin and files are consumed
+        one line at a time so that memory does not grow with the input.
+        
+        Args:
+            args: Parsed command line options
+            
+        Yields:
+            Lines of text
+        """
+        if not args.text or args.text[0] == '-':
+            source = sys.stdin
+        elif len(args.text) == 1 and os.path.isfile(args.text[0]):
+            source = open(args.text[0], 'r', encoding='utf-8')
+        else:
+            source = args.text
+        
+        try:
+            if args.preserve:
+                for line in source:
+                    yield line.rstrip('\n')
+                return
+            
+            # Greedy wrapping only ever extends the last line, so all lines
+            # before it are final once the next input line has been added.
+            # The unfinished line is kept with its trailing spaces, which
+            # wrap() would drop, so the result matches read_text.
+            # Each input line is normalised like wrap() does the whole text
+            # in read_text: tabs are expanded against the column in the
+            # joined text and other whitespace becomes spaces.
+            pending = None
+            column = 0
+            for line in source:
+                line = line.strip() if pending is None else f" {line.strip()}"
+                line = (' ' * column + line).expandtabs()[column:]
+                newline = max(line.rfind('\n'), line.rfind('\r'))
+                column = (column + len(line) if newline < 0 else len(line) - newline - 1) % 8
+                line = line.translate(textwrap.TextWrapper.unicode_whitespace_trans)
+                pending = line if pending is None else pending + line
+                wrapped = textwrap.wrap(pending, args.width)
+                if not wrapped:
+                    continue
+                yield from wrapped[:-1]
+                start = len(pending.rstrip()) - len(wrapped[-1])
+                pending = pending[start:] if pending.startswith(wrapped[-1], start) else wrapped[-1]
+            if pending is None:
+                return
+            yield from textwrap.wrap(pending, args.width) or ['']
+        finally:
+            if source is not sys.stdin and hasattr(source, 'close'):
+                source.close()
+    
+    def prepare_image(self, args, text_lines, term_foreground, term_background, effects_processor,
+                      resolution=None):
+        """Validate the options and render the banner, using the render cache
+        
+        Args:
+            args: Parsed command line options
+            text_lines: Lines of text to render
+            term_foreground, term_background: Terminal colours for the defaults
+            effects_processor: EffectsProcessor to render with
+            resolution: Resolution in dots per inch (default: picked for args.max_width_px)
+            
+        Returns:
+            (PIL Image, background colour for the output converter)
+        """
         # Check if text contains Latin1 characters
         iso = any(ord(c) > 127 for line in text_lines for c in line)
         
@@ -1186,116 +4348,525 @@ class BIDeT:
         if background == 'transparent':
             background = term_background
         
-        # Create PostScript file
-        ps = PostScriptSimple(
-            papersize="A0",
-            colour=True,
-            eps=False,
-            units="in",
-            reencode="ISOLatin1Encoding"
-        )
-        
-        ps.newpage()
-        
         # Handle color setting
-        if colour.lower() == 'white':
+        if colour.lower() == 'white' and args.white_key:
             # Can't use true white due to masking
             colour = "snow"
             if background.lower() == 'snow':
                 background = 'white'
         
-        # Set color
-        if colour.startswith('#') and len(colour) == 13:
-            # Hex color format
-            r, g, b = self.hex48_to_rgb(colour)
-            ps.setcolour(r, g, b)
+        # Collect effects to apply
+        effects = self.collect_effects(args)
+        
+        # Rasterise no more pixels than the output can show
+        if resolution is None:
+            resolution = self.output_resolution(args, text_lines, font, effects)
+        
+        # Draw what the PostScript stage can draw (--vector)
+        vector, raster_effects = self.vector_effects(args, effects, colour, background, resolution,
+                                                     effects_processor)
+        
+        # Look up the finished image in the render cache
+        cache = None
+        img = None
+        if not args.no_cache:
+            cache = RenderCache(args.cache_dir, args.cache_size * 1024 * 1024, debug=self.debug)
+            cache_key = cache.key(
+                text=text_lines, font=font, size=args.size, colour=colour,
+                line=args.line, rotate=args.rotate, effects=effects, engine=args.engine,
+                white_key=args.white_key, gs_options=EffectsProcessor.gs_options,
+                resolution=resolution, vector=vector
+            )
+            span = self.tracer.begin('cache_lookup')
+            img = cache.get(cache_key)
+            if img is not None and effects.get('tile'):
+                # Only the tile is cached
+                img = TiledImage(img if img.mode == 'L' else img.convert('RGBA'),
+                                 max(1, int(effects.get('tile_count', 3))),
+                                 mirror=effects['tile'] == 'mirror')
+            if img is not None and img.mode == 'L':
+                # A coverage mask, coloured at output
+                img = CoverageImage.wrap(img, effects_processor._get_rgb_color(colour))
+            self.tracer.end(span, img, hit=img is not None)
+        
+        if img is None:
+            img = self.render_banner(text_lines, font, colour, args, raster_effects, effects_processor,
+                                     resolution, vector, self.use_coverage(args, raster_effects, vector))
+            if cache:
+                span = self.tracer.begin('cache_store')
+                stored = img.tile if isinstance(img, TiledImage) else img
+                cache.put(cache_key, stored.mask if isinstance(stored, CoverageImage) else stored)
+                self.tracer.end(span)
+        
+        if cache and self.debug:
+            print(f"Render cache: {cache.stats()} ({cache.cache_dir})", file=sys.stderr)
+        
+        return img, background
+    
+    def output_resolution(self, args, text_lines, font, effects):
+        """Pick the lowest resolution that still fills the output width
+        
+        The banner width is estimated from the font metrics and the effects
+        that widen it, and the resolution is lowered until it fits into
+        args.max_width_px. It is never raised above the default.
+        
+        Args:
+            args: Parsed command line options
+            text_lines: Lines of text to render
+            font: Validated font name
+            effects: Dictionary of effects to apply
+            
+        Returns:
+            Resolution in dots per inch
+        """
+        resolution = EffectsProcessor.resolution
+        if not args.max_width_px:
+            return resolution
+        
+        # Banner width in points, the text height when rotated
+        ascent, descent = FontMetrics.extent(font, args.size)
+        if args.rotate:
+            width = (len(text_lines) - 1) * args.size * args.line + ascent + descent
         else:
-            # Named color
-            ps.setcolour(colour)
+            width = max((FontMetrics.string_width(font, line, args.size) for line in text_lines),
+                        default=0) + ascent / 4
         
-        # Set font
-        ps.setfont(font, args.size)
+        # The padding and shadow are in pixels and do not scale, tiles repeat
+        fixed = 2 * 10
+        if effects.get('shadow'):
+            fixed += int(effects.get('shadow_offset', 5))
+            if effects['shadow'] == 'soft':
+                blur = effects.get('shadow_blur')
+                fixed += 2 * int(effects.get('shadow_offset', 5) if blur is None else blur)
+        tiles = max(1, int(effects.get('tile_count', 3))) if effects.get('tile') else 1
         
-        # Calculate the starting y position based on the number of text lines
-        line_spacing = args.size * args.line
-        y_position = len(text_lines) * line_spacing
+        available = args.max_width_px / tiles - fixed
+        if width > 0 and available * 72 / width < resolution:
+            resolution = max(EffectsProcessor.min_resolution, int(available * 72 / width))
+        if self.debug:
+            print(f"Resolution: {resolution} dpi for {args.max_width_px} px", file=sys.stderr)
+        return resolution
+    
+    def set_output_width(self, args):
+        """Fill in args.max_width_px from --max-cols or the terminal
         
-        # Add text lines
-        for line in text_lines:
-            ps.text(10, y_position, line)
-            y_position -= line_spacing
+        ANSI output has one pixel per column. Sixel output needs the size
+        of a character cell, which is only known for a real terminal.
+        """
+        if args.max_width_px is not None:
+            return
+        columns = args.max_cols
+        if columns is None and sys.stdout.isatty():
+            columns = shutil.get_terminal_size().columns
+        if not columns:
+            return
+        if args.ansi:
+            if args.ansi_encoder == 'native':
+                args.max_width_px = columns
+            return
+        cell = TerminalInfo.cell_size()
+        if cell:
+            args.max_width_px = int(columns * cell[0])
+    
+    def job_to_args(self, job, settings=None):
+        """Turn a batch job into parsed options
+        
+        Keys are long option names (dashes or underscores), "text" is a
+        string or list of strings. The keys in job_keys are not options,
+        any other key must be one of job_options.
+        
+        Args:
+            job: Dictionary from the manifest
+            settings: Dictionary with the job_settings of the batch run or
+                server (default: the option defaults)
+            
+        Returns:
+            argparse.Namespace
+            
+        Raises:
+            ValueError for a missing text or a key that is not allowed
+        """
+        argv = []
+        for key, value in job.items():
+            if key in self.job_keys:
+                continue
+            if key.replace('-', '_') not in self.job_options:
+                raise ValueError(f'option "{key}" is not allowed in a job')
+            option = '--' + key.replace('_', '-')
+            if value is True:
+                argv.append(option)
+            elif value is not False and value is not None:
+                argv.extend([option, str(value)])
+        
+        text = job.get('text')
+        if not text:
+            raise ValueError('job has no "text"')
+        argv.append('--')
+        argv.extend([text] if isinstance(text, str) else [str(t) for t in text])
+        
+        # Reject stdin input explicitly, workers have no terminal to read from
+        if argv[-1] == '-' and len(argv) == argv.index('--') + 2:
+            raise ValueError('stdin input is not supported in batch mode')
+        args = self.build_parser().parse_args(argv)
+        for key in self.job_settings:
+            if settings and key in settings:
+                setattr(args, key, settings[key] or (key == 'no_cache' and args.no_cache))
+        return args
+    
+    def job_settings_of(self, args):
+        """The job_settings of the current run, for its batch jobs or requests"""
+        return {key: getattr(args, key) for key in self.job_settings}
+    
+    def args_to_job(self, args):
+        """Turn parsed options into a job dictionary (the reverse of job_to_args)
+        
+        Only rendering options (job_options) that differ from their defaults
+        are included; max_cols is left to the server, which gets the columns.
+        """
+        defaults = vars(self.build_parser().parse_args([]))
+        return {key: value for key, value in vars(args).items()
+                if key in self.job_options and key != 'max_cols' and value != defaults.get(key)}
+    
+    def render_remote(self, args, text_lines, term_foreground, term_background):
+        """Have a running render server render the banner and print it
         
-        # Create output filenames
-        ps_file = f"{self.temp_prefix}.ps"
+        Args:
+            args: Parsed command line options
+            text_lines: Lines of text to render
+            term_foreground, term_background: Terminal colours for the defaults
+            
+        Returns:
+            True if the server answered, False to render locally instead
+        """
+        job = self.args_to_job(args)
+        job['text'] = text_lines
+        job['preserve'] = True  # already wrapped
+        job['format'] = 'ansi' if args.ansi else 'sixel'
+        job['columns'] = shutil.get_terminal_size().columns
+        job['terminal'] = [term_foreground, term_background]
+        if args.ansi_colors == 'auto':
+            # The colour mode depends on our terminal, not the server's
+            job['ansi_colors'] = AnsiRenderer.detect_colors()
         
-        # Write PostScript to file
-        ps.output(ps_file)
+        start_time = time.time()
+        try:
+            data = RenderServer.request(args.socket, job)
+        except OSError as e:
+            if self.debug:
+                print(f"Render server not available ({e}), rendering locally", file=sys.stderr)
+            return False
+        except RuntimeError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
         
-        # Debug: print PS file if requested
+        sys.stdout.buffer.write(data)
+        sys.stdout.flush()
         if self.debug:
-            print(f"PostScript file generated at: {ps_file}", file=sys.stderr)
+            print(f"Render server time: {time.time() - start_time:.2f} seconds", file=sys.stderr)
+        return True
+    
+    def render_job(self, job, effects_processor, settings=None):
+        """Render one batch job and write it to its output file
         
-        # Create effects processor
-        effects_processor = EffectsProcessor(debug=self.debug)
+        Args:
+            job: Dictionary from the manifest
+            effects_processor: EffectsProcessor to render with
+            settings: job_settings of the batch run
+        """
+        output = job.get('output')
+        if not output:
+            raise ValueError('job has no "output"')
+        
+        args = self.job_to_args(job, settings)
+        args.pipe = True  # never use the shared scratch directory
+        text_lines = self.read_text(args)
+        
+        ext = os.path.splitext(output)[1].lower()
+        if ext in ('.ans', '.ansi', '.txt') and args.max_width_px is None:
+            args.max_width_px = args.max_cols or job.get('columns', 80)
+        
+        # No terminal: use the same defaults as when test-sixel is missing
+        img, background = self.prepare_image(args, text_lines, "black", "white", effects_processor)
+        
+        if ext in ('.six', '.sixel'):
+            data = effects_processor.encode_image(img, background, 'sixel')
+        elif ext in ('.ans', '.ansi', '.txt'):
+            ansi_colors = args.ansi_colors if args.ansi_colors != 'auto' else 'truecolor'
+            data = effects_processor.encode_image(img, background, 'ansi', job.get('columns', 80), ansi_colors)
+        else:
+            img.save(output, format='PNG')
+            return
+        
+        with open(output, 'wb') as f:
+            f.write(data)
+    
+    def run_batch(self, manifest, workers, settings=None):
+        """Render every job of a JSONL manifest with a pool of processes
+        
+        Failed jobs are reported and do not stop the batch.
+        
+        Args:
+            manifest: Path of the manifest ("-" for stdin)
+            workers: Number of worker processes
+            settings: job_settings for every job (the cache options)
+            
+        Returns:
+            Exit status: 0 if every job succeeded, 1 otherwise
+        """
+        import concurrent.futures
+        
+        f = sys.stdin if manifest == '-' else open(manifest, 'r', encoding='utf-8')
+        with f:
+            lines = [(n, line) for n, line in enumerate(f, 1)
+                     if line.strip() and not line.lstrip().startswith('#')]
         
-        # Get start time for performance measurement
         start_time = time.time()
+        failed = 0
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=max(1, workers), initializer=_batch_init,
+                initargs=(self.debug, settings)) as executor:
+            futures = {executor.submit(_batch_run, line): n for n, line in lines}
+            for future in concurrent.futures.as_completed(futures):
+                n = futures[future]
+                try:
+                    ok, output, elapsed, error = future.result()
+                except Exception as e:
+                    ok, output, elapsed, error = False, '?', 0.0, f"worker failed: {e}"
+                if ok:
+                    print(f"ok   line {n}: {output} ({elapsed:.2f}s)")
+                else:
+                    failed += 1
+                    print(f"FAIL line {n}: {output} ({elapsed:.2f}s): {error}")
+                sys.stdout.flush()
         
-        # Render PostScript to image
-        img = effects_processor.render_ps_to_image(ps_file)
+        total = time.time() - start_time
+        done = len(lines)
+        rate = done / total if total else 0
+        print(f"{done - failed} ok, {failed} failed, {total:.2f}s ({rate:.1f} jobs/sec, {workers} workers)")
+        return 1 if failed else 0
+    
+    def main(self):
+        """Main function - optimized for speed"""
+        parser = self.build_parser()
+        args = parser.parse_args()
         
-        # Print time information in debug mode
-        if self.debug:
-            print(f"PS rendering time: {time.time() - start_time:.2f} seconds", file=sys.stderr)
-            render_time = time.time()
+        # Set up debug mode
+        self.debug = args.debug
         
-        # Handle rotation before effects
-        if args.rotate:
-            img = img.rotate(270, expand=True)
+        # Set up instrumentation (debug mode prints the span table)
+        self.tracer = Tracer(enabled=bool(args.profile or args.debug))
+        profiler = None
+        if args.cprofile:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
         
-        # Collect effects to apply
-        effects = {}
-        if args.flip:
-            effects['flip'] = args.flip
-        if args.colorspill:
-            effects['colorspill'] = args.colorspill
-        if args.pattern:
-            effects['pattern'] = args.pattern
-            effects['pattern_colors'] = args.pattern_colors
-            effects['pattern_scale'] = args.pattern_scale
-        if args.tile:
-            effects['tile'] = args.tile
-            effects['tile_count'] = args.tile_count
-        if args.fade:
-            effects['fade'] = args.fade
-            effects['fade_amount'] = args.fade_amount
-        if args.shadow:
-            effects['shadow'] = args.shadow
-            effects['shadow_offset'] = args.shadow_offset
-            effects['shadow_color'] = args.shadow_color
+        try:
+            self.run(args)
+        finally:
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(args.cprofile)
+            self.report_profile(args)
+    
+    def report_profile(self, args):
+        """Write the spans of this run as requested by --profile/--debug"""
+        if not self.tracer.enabled:
+            return
         
-        # Apply effects if any - only if needed
-        if effects:
-            effects_start = time.time()
-            img = effects_processor.apply_effects(img, effects)
-            if self.debug:
-                print(f"Effects processing time: {time.time() - effects_start:.2f} seconds", file=sys.stderr)
+        if args.profile == 'json':
+            line = json.dumps(self.tracer.record(argv=sys.argv[1:]))
+            if args.profile_file:
+                with open(args.profile_file, 'a', encoding='utf-8') as f:
+                    f.write(line + "\n")
+            else:
+                print(line, file=sys.stderr)
+        else:
+            print(self.tracer.summary(), file=sys.stderr)
+    
+    def run(self, args):
+        """Render the banner for the parsed options and print it"""
+        # Show version
+        if args.version:
+            print("Version: 2.0")
+            sys.exit(0)
+        
+        # List patterns if requested
+        if args.list_patterns:
+            self.list_patterns()
+        
+        # Font listing
+        if args.font == "list":
+            self.test_font(args.font, False)
+        
+        # Color listing
+        if args.colour == "list" or args.background == "list":
+            self.test_colours(args.colour, args.background)
+        
+        if args.vector and args.engine != 'ps':
+            print("Error: --vector needs the ps engine", file=sys.stderr)
+            sys.exit(1)
+        
+        # Streaming renders locally, a chunk at a time
+        if args.stream:
+            if args.rotate:
+                print("Error: --rotate cannot be combined with --stream", file=sys.stderr)
+                sys.exit(1)
+            if args.chunk_lines < 1:
+                print("Error: --chunk-lines must be at least 1", file=sys.stderr)
+                sys.exit(1)
+            args.client = False
+        
+        # Check for required tools (a client may not need them)
+        if not args.client or args.serve:
+            self.check_required_tools(args.engine)
+        
+        # Batch mode renders to files, no terminal involved
+        if args.batch:
+            sys.exit(self.run_batch(args.batch, args.workers, self.job_settings_of(args)))
+        
+        # Server mode renders for clients until stopped
+        if args.serve:
+            sys.exit(RenderServer(args.workers, self.debug, self.job_settings_of(args)).serve(
+                args.socket, args.http))
+        
+        # Create temp directory for files (pipe and client modes use none)
+        if args.pipe or args.client:
+            pass
+        elif os.path.exists("/dev/shm"):
+            # Use /dev/shm for better performance on Linux
+            shm_path = f"/dev/shm/{os.environ.get('USER', 'bidet')}"
+            os.makedirs(shm_path, exist_ok=True)
+            self.temp_prefix = os.path.join(shm_path, f"bidet_tmp_{int(time.time())}")
+        else:
+            # Fallback to regular temp directory
+            self.temp_dir = tempfile.mkdtemp(prefix="bidet_")
+            self.temp_prefix = os.path.join(self.temp_dir, "bidet_tmp")
+        
+        # Size the render for the terminal
+        self.set_output_width(args)
+        
+        # Ask the terminal for its colours, only needed for the defaults
+        term_foreground, term_background = "black", "white"
+        if args.colour.lower() == 'default' or args.background.lower() == 'transparent':
+            span = self.tracer.begin('terminal')
+            term_foreground, term_background = self.test_sixel(args)
+            self.tracer.end(span)
+        
+        if args.stream:
+            self.run_stream(args, term_foreground, term_background)
+            self.cleanup()
+            return
+        
+        # Get input text
+        span = self.tracer.begin('read_text')
+        text_lines = self.read_text(args)
+        self.tracer.end(span, lines=len(text_lines))
+        
+        # Let a running render server do the work if there is one
+        if args.client:
+            span = self.tracer.begin('remote')
+            done = self.render_remote(args, text_lines, term_foreground, term_background)
+            self.tracer.end(span, answered=done)
+            if done:
+                return
+            self.check_required_tools(args.engine)
+            args.pipe = True  # no scratch directory was created
+        
+        # Create effects processor
+        effects_processor = EffectsProcessor(debug=self.debug, sixel_encoder=args.sixel_encoder,
+                                             ansi_encoder=args.ansi_encoder, ansi_colors=args.ansi_colors,
+                                             white_key=args.white_key, tracer=self.tracer)
+        
+        span = self.tracer.begin('prepare')
+        img, background = self.prepare_image(args, text_lines, term_foreground, term_background,
+                                             effects_processor)
+        self.tracer.end(span, img)
         
         # Save debug image if requested
-        if self.debug:
+        if self.debug and not args.pipe:
             debug_file = f"{self.temp_prefix}_final.png"
             effects_processor.save_image(img, debug_file)
             print(f"Final image saved to: {debug_file}", file=sys.stderr)
-            print(f"Image preparation time: {time.time() - start_time:.2f} seconds", file=sys.stderr)
         
+        self.output_image(args, img, background, effects_processor)
+        
+        self.cleanup()
+    
+    def run_stream(self, args, term_foreground, term_background):
+        """Render and print the text a chunk of lines at a time
+        
+        Each chunk is written to the terminal as soon as its lines have been
+        read and rendered, so memory stays bounded and the first lines show
+        up before the rest of the input has even arrived.
+        
+        Args:
+            args: Parsed command line options
+            term_foreground, term_background: Terminal colours for the defaults
+        """
+        effects_processor = EffectsProcessor(debug=self.debug, sixel_encoder=args.sixel_encoder,
+                                             ansi_encoder=args.ansi_encoder, ansi_colors=args.ansi_colors,
+                                             white_key=args.white_key, tracer=self.tracer)
+        
+        # The chunks of a long log would only push banners out of the cache
+        args.no_cache = True
+        
+        lines = self.iter_text(args)
+        resolution = None
+        index = 0
+        while True:
+            span = self.tracer.begin('read_text')
+            chunk = list(itertools.islice(lines, args.chunk_lines))
+            self.tracer.end(span, lines=len(chunk))
+            if not chunk:
+                break
+            
+            # Keep the text size of the first chunk for all of them
+            if resolution is None:
+                iso = any(ord(c) > 127 for line in chunk for c in line)
+                resolution = self.output_resolution(args, chunk, self.test_font(args.font, iso),
+                                                    self.collect_effects(args))
+            
+            span = self.tracer.begin('chunk', index=index)
+            img, background = self.prepare_image(args, chunk, term_foreground, term_background,
+                                                 effects_processor, resolution)
+            try:
+                self.output_image(args, img, background, effects_processor)
+                sys.stdout.flush()
+            except BrokenPipeError:
+                # The reader is gone (e.g. head), stop instead of reading on;
+                # stdout goes to /dev/null so the exit flush stays quiet
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                self.tracer.end(span, img)
+                break
+            self.tracer.end(span, img)
+            index += 1
+    
+    def output_image(self, args, img, background, effects_processor):
+        """Print the image as Sixel or ANSI
+        
+        Args:
+            args: Parsed command line options
+            img: PIL Image
+            background: Background colour for the output converter
+            effects_processor: EffectsProcessor to encode with
+        """
         # Output image - use direct subprocess calls for speed
-        output_start = time.time()
-        if args.ansi:
+        span = self.tracer.begin('output', format='ansi' if args.ansi else 'sixel')
+        if args.ansi and (args.pipe or effects_processor.native_ansi):
+            # Render in-process or pipe the image straight into img2ans
+            effects_processor.img_to_ansi(img, background)
+        elif not args.ansi and (args.pipe or effects_processor.native_sixel):
+            # Encode in-process or pipe the image straight into img2sixel
+            effects_processor.img_to_sixel(img, background)
+        elif args.ansi:
             # Create a temp file for the image
             temp_png = f"{self.temp_prefix}_output.png"
             img.save(temp_png)
             # Call img2ans directly
+            sub_span = self.tracer.begin('img2ans', subprocess=True)
             subprocess.run(["img2ans", "-b", background, temp_png])
+            self.tracer.end(sub_span)
             # Clean up temp file
             if not self.debug:
                 os.unlink(temp_png)
@@ -1304,17 +4875,18 @@ class BIDeT:
             temp_png = f"{self.temp_prefix}_output.png"
             img.save(temp_png)
             # Call img2sixel directly
+            sub_span = self.tracer.begin('img2sixel', subprocess=True)
             subprocess.run(["img2sixel", "-I", "-B", background, temp_png])
+            self.tracer.end(sub_span)
             # Clean up temp file
             if not self.debug:
                 os.unlink(temp_png)
         
-        if self.debug:
-            print(f"Output conversion time: {time.time() - output_start:.2f} seconds", file=sys.stderr)
-            print(f"Total processing time: {time.time() - start_time:.2f} seconds", file=sys.stderr)
-        
-        # Clean up
-        if not self.debug:
+        self.tracer.end(span)
+    
+    def cleanup(self):
+        """Remove the temporary files of the run"""
+        if not self.debug and self.temp_prefix:
             # Clean up temp files
             for ext in ['.ps', '.png', '.log', '.ppm', '.ans', '.six']:
                 if os.path.exists(f"{self.temp_prefix}{ext}"):
@@ -1331,6 +4903,45 @@ class BIDeT:
                     pass
 
 
+# Per-process state of the batch workers
+_batch_state = {}
+
+
+def _batch_init(debug, settings=None):
+    """Set up a batch worker: one BIDeT, one Ghostscript interpreter"""
+    _batch_state['settings'] = settings
+    bidet = BIDeT()
+    bidet.debug = debug
+    gs_pool = GhostscriptPool(size=1, debug=debug) if shutil.which("gs") else None
+    _batch_state['bidet'] = bidet
+    _batch_state['effects_processor'] = EffectsProcessor(debug=debug, gs_pool=gs_pool)
+
+
+def _batch_run(line):
+    """Run one manifest line in a batch worker
+    
+    Returns:
+        (ok, output path, seconds, error message)
+    """
+    start = time.time()
+    output = '?'
+    messages = io.StringIO()
+    try:
+        job = json.loads(line)
+        output = job.get('output', '?')
+        with contextlib.redirect_stderr(messages), contextlib.redirect_stdout(messages):
+            _batch_state['bidet'].render_job(job, _batch_state['effects_processor'],
+                                             _batch_state['settings'])
+        return True, output, time.time() - start, None
+    except SystemExit as e:
+        # Validation errors print a message and exit
+        lines = messages.getvalue().strip().splitlines()
+        error = lines[-1] if lines else f"exit status {e.code}"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return False, output, time.time() - start, error
+
+
 if __name__ == "__main__":
     bidet = BIDeT()
     bidet.main()
\ No newline at end of file
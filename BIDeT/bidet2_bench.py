@@ -0,0 +1,587 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for bidet2.py
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bidet2
+
+
+def make_document(text, font="Helvetica", size=65):
+    """Build the same PostScript document BIDeT.main would for one line"""
+    ps = bidet2.PostScriptSimple(papersize="A0")
+    ps.newpage()
+    ps.setcolour("black")
+    ps.setfont(font, size)
+    ps.text(10, size, text)
+    return ps
+
+
+def bench_pool(args):
+    """Compare renders/sec of one gs process per render against the gs pool"""
+    ps = make_document(args.text)
+    temp_dir = tempfile.mkdtemp(prefix="bidet_bench_")
+    ps_file = os.path.join(temp_dir, "bench.ps")
+    ps.output(ps_file)
+
+    # One gs process per render
+    effects_processor = bidet2.EffectsProcessor()
+    start = time.time()
+    for _ in range(args.renders):
+        effects_processor.render_ps_to_image(ps_file)
+    spawn_rate = args.renders / (time.time() - start)
+    os.unlink(ps_file)
+    os.rmdir(temp_dir)
+
+    # Pooled interpreters (startup is included in the measurement)
+    with bidet2.GhostscriptPool(size=1, max_jobs=args.max_jobs) as pool:
+        effects_processor = bidet2.EffectsProcessor(gs_pool=pool)
+        start = time.time()
+        for _ in range(args.renders):
+            effects_processor.render_ps_document(ps)
+        pool_rate = args.renders / (time.time() - start)
+
+    print(f"spawn: {spawn_rate:8.2f} renders/sec")
+    print(f"pool:  {pool_rate:8.2f} renders/sec ({pool_rate / spawn_rate:.1f}x)")
+
+
+def sample_image(text, scale=4):
+    """Draw an anti-aliased banner without Ghostscript (PIL's built-in font)"""
+    from PIL import Image, ImageDraw, ImageFont
+
+    font = ImageFont.load_default(size=16 * scale)
+    bbox = font.getbbox(text)
+    img = Image.new('RGBA', (bbox[2] + 20, bbox[3] + 20), (255, 255, 255, 0))
+    ImageDraw.Draw(img).text((10, 10), text, font=font, fill=(100, 149, 237, 255))
+    return img
+
+
+def decode_sixel(data, size):
+    """Decode a Sixel stream into an RGBA image (unpainted pixels transparent)"""
+    import numpy as np
+    from PIL import Image
+
+    width, height = size
+    out = np.zeros((height, width, 4), dtype=np.uint8)
+    text = data.decode('latin1')
+    pos = text.index('q') + 1
+    palette = {}
+    colour = (0, 0, 0)
+    x = band = 0
+    while pos < len(text):
+        ch = text[pos]
+        if ch == '\x1b':
+            break
+        if ch in '"#!':
+            end = pos + 1
+            while end < len(text) and (text[end].isdigit() or text[end] == ';'):
+                end += 1
+            params = [int(p) for p in text[pos + 1:end].split(';') if p]
+            pos = end
+            if ch == '#':
+                if len(params) == 5:
+                    palette[params[0]] = tuple(round(v * 255 / 100) for v in params[2:])
+                colour = palette.get(params[0], (0, 0, 0))
+            elif ch == '!':
+                repeat, ch = params[0], text[pos]
+                pos += 1
+                for _ in range(repeat):
+                    x = _paint(out, x, band, ord(ch) - 63, colour)
+            continue
+        if ch == '$':
+            x = 0
+        elif ch == '-':
+            x = 0
+            band += 6
+        elif '?' <= ch <= '~':
+            x = _paint(out, x, band, ord(ch) - 63, colour)
+        pos += 1
+    return Image.fromarray(out, 'RGBA')
+
+
+def _paint(out, x, top, bits, colour):
+    for row in range(6):
+        if bits & (1 << row) and top + row < out.shape[0] and x < out.shape[1]:
+            out[top + row, x, :3] = colour
+            out[top + row, x, 3] = 255
+    return x + 1
+
+
+def img2sixel(img, bg):
+    """Encode with the external img2sixel, as EffectsProcessor does"""
+    import io
+    import subprocess
+
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return subprocess.run(["img2sixel", "-I", "-B", bg], input=buf.getvalue(),
+                          stdout=subprocess.PIPE, check=True).stdout
+
+
+def flatten(img, bg):
+    """Composite an RGBA image onto a background colour, as an int16 RGB array"""
+    import numpy as np
+    from PIL import Image
+
+    flat = Image.new('RGBA', img.size, bg + (255,))
+    flat.alpha_composite(img)
+    return np.asarray(flat.convert('RGB'), dtype=np.int16)
+
+
+def sixel_cases(img):
+    """The images the Sixel encoders are compared on: the banner as is and
+    semi-transparent like --fade transparent (alpha 127) or a faint shadow"""
+    faded = img.copy()
+    faded.putalpha(img.getchannel('A').point(lambda a: a // 2))
+    return [('opaque', img), ('semi-transparent', faded)]
+
+
+def bench_sixel(args):
+    """Compare the native Sixel encoder with the blended image and img2sixel
+
+    Exits with status 1 when the native output differs visibly from the
+    image flattened onto the background.
+    """
+    import numpy as np
+    from PIL import Image
+
+    img = Image.open(args.image).convert('RGBA') if args.image else sample_image(args.text, args.scale)
+    bg = bidet2.EffectsProcessor()._get_rgb_color(args.background)
+    encoder = bidet2.SixelEncoder()
+    external_tool = shutil.which("img2sixel")
+    print(f"image: {img.width}x{img.height}")
+    if not external_tool:
+        print("img2sixel: not installed, comparing with the blended image only")
+
+    failed = False
+    for name, case in sixel_cases(img):
+        print(f"{name}:")
+        native = encoder.encode(case, bg)
+        start = time.time()
+        for _ in range(args.repeat):
+            encoder.encode(case, bg)
+        native_time = (time.time() - start) / args.repeat
+        print(f"  native:    {len(native):8d} bytes {1 / native_time:8.1f} images/sec")
+
+        # Visual comparison: flatten the decode and the image onto the background
+        expected = flatten(case, bg)
+        decoded = flatten(decode_sixel(native, case.size), bg)
+        diff = np.abs(decoded - expected).max(axis=2)
+        bad = (diff > args.tolerance).mean() * 100
+        print(f"  vs blended image: mean abs diff {diff.mean():.2f}, max {diff.max()}, "
+              f"{bad:.2f}% pixels differ by more than {args.tolerance}")
+        if bad:
+            print(f"  FAIL: native Sixel output does not match the {name} image")
+            failed = True
+
+        if not external_tool:
+            continue
+        external = img2sixel(case, args.background)
+        start = time.time()
+        for _ in range(args.repeat):
+            img2sixel(case, args.background)
+        external_time = (time.time() - start) / args.repeat
+        print(f"  img2sixel: {len(external):8d} bytes {1 / external_time:8.1f} images/sec "
+              f"(native is {external_time / native_time:.1f}x faster)")
+        print(f"  byte-for-byte identical: {native == external}")
+        diff = np.abs(decoded - flatten(decode_sixel(external, case.size), bg)).max(axis=2)
+        print(f"  vs img2sixel: mean abs diff {diff.mean():.2f}, max {diff.max()}, "
+              f"{(diff > args.tolerance).mean() * 100:.2f}% pixels differ by more than {args.tolerance}")
+
+    if failed:
+        sys.exit(1)
+
+
+def gs_like_image(width, height):
+    """A pngalpha-style render: transparent page with an opaque text block"""
+    from PIL import Image
+
+    img = Image.new('RGBA', (width, height), (255, 255, 255, 0))
+    img.paste((0, 0, 0, 255), (width // 10, height // 3, width * 9 // 10, height * 2 // 3))
+    return img
+
+
+def bench_postrender(args):
+    """Time crop/pad after gs, and count Python calls to prove no per-pixel loop"""
+    import cProfile
+    import pstats
+
+    if args.no_numpy:
+        # Make "import numpy" fail so the pure-PIL fallbacks are measured
+        sys.modules['numpy'] = None
+
+    sizes = [(200, 100), (500, 300), (1000, 600), (2000, 1200), (5000, 7000)]
+    print(f"{'size':>10} {'mode':>9} {'ms':>8} {'python calls':>13}")
+    for white_key in (False, True):
+        effects_processor = bidet2.EffectsProcessor(white_key=white_key)
+        effects_processor._finish_render(gs_like_image(10, 10))  # warm up imports
+        for width, height in sizes:
+            img = gs_like_image(width, height)
+            profile = cProfile.Profile()
+            start = time.time()
+            profile.runcall(effects_processor._finish_render, img)
+            elapsed = (time.time() - start) * 1000
+            calls = pstats.Stats(profile).total_calls
+            mode = 'white-key' if white_key else 'alpha'
+            print(f"{width:>5}x{height:<5} {mode:>9} {elapsed:8.1f} {calls:13d}")
+
+
+# Stand-in for gs: draws a text-like block on a transparent page of the
+# requested size and resolution, so the Python stages can be timed anywhere
+FAKE_GS = """#!{python}
+import re
+import sys
+from PIL import Image, ImageDraw
+
+args = sys.argv[1:]
+output = next(a[len('-sOutputFile='):] for a in args if a.startswith('-sOutputFile='))
+dpi = next((float(a[2:]) for a in args if a.startswith('-r')), 72.0)
+ps = sys.stdin.buffer.read() if args[-1] == '-' else open(args[-1], 'rb').read()
+match = re.search(rb'/PageSize \\[([0-9.]+) ([0-9.]+)\\]', ps)
+width, height = (float(v) for v in match.groups()) if match else (595, 842)
+size = (max(1, round(width * dpi / 72)), max(1, round(height * dpi / 72)))
+img = Image.new('RGBA', size, (255, 255, 255, 0))
+draw = ImageDraw.Draw(img)
+step = max(4, size[1] // 12)
+for x in range(size[0] // 20, size[0] * 19 // 20, step * 2):
+    draw.rectangle([x, size[1] // 4, x + step, size[1] * 3 // 4], fill=(0, 0, 0, 255))
+if output == '%stdout':
+    img.save(sys.stdout.buffer, format='PNG')
+else:
+    img.save(output, format='PNG')
+"""
+
+
+def install_fake_gs(directory):
+    """Put a fake gs first on PATH"""
+    path = os.path.join(directory, 'gs')
+    with open(path, 'w') as f:
+        f.write(FAKE_GS.format(python=sys.executable))
+    os.chmod(path, 0o755)
+    os.environ['PATH'] = directory + os.pathsep + os.environ.get('PATH', '')
+
+
+def time_stage(func, repeat):
+    """Median wall time of func() in seconds, and its last result"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], result
+
+
+# Each effects branch of EffectsProcessor.apply_effects on its own
+STAGE_EFFECTS = {
+    'flip': {'flip': 'both'},
+    'colorspill': {'colorspill': 'red,yellow,blue', 'colorspill_direction': 'diagonal'},
+    'fade_transparent': {'fade': 'transparent', 'fade_amount': 0.5},
+    'fade_white': {'fade': 'white', 'fade_amount': 0.5},
+    'fade_black': {'fade': 'black', 'fade_amount': 0.5},
+    'pattern': {'pattern': 'dots', 'pattern_colors': 'white,black', 'pattern_scale': 20},
+    'shadow_drop': {'shadow': 'drop', 'shadow_offset': 5, 'shadow_color': 'black'},
+    'shadow_3d': {'shadow': '3d', 'shadow_offset': 5, 'shadow_color': 'black'},
+    'tile_grid': {'tile': 'grid', 'tile_count': 3},
+    'tile_mirror': {'tile': 'mirror', 'tile_count': 3},
+}
+
+STAGE_TEXTS = {
+    'short': 'Hi',
+    'medium': 'Hello, World!',
+    'long': 'The quick brown fox jumps over the lazy dog. ' * 4,
+}
+
+
+def run_stages(args):
+    """Time every pipeline stage across the text length / font size matrix"""
+    from argparse import Namespace
+    import io
+
+    bidet = bidet2.BIDeT()
+    effects_processor = bidet2.EffectsProcessor()
+    texts = {k: v for k, v in STAGE_TEXTS.items() if k in args.texts}
+    results = {}
+    temp_dir = tempfile.mkdtemp(prefix="bidet_bench_")
+    try:
+        for text_name, text in texts.items():
+            bidet.debug = False
+            text_lines = bidet.read_text(Namespace(text=[text], preserve=False, width=20))
+            for size in args.sizes:
+                case = f"{text_name}/{size}pt"
+                options = Namespace(size=size, line=1)
+
+                def generate():
+                    ps = bidet.build_document(text_lines, 'Helvetica', 'black', options)
+                    ps.output(io.BytesIO())
+                    return ps
+                results[f"{case}/ps_generate"], _ = time_stage(generate, args.repeat)
+
+                ps = bidet.build_document(text_lines, 'Helvetica', 'black', options)
+                ps_file = os.path.join(temp_dir, 'bench.ps')
+                ps.output(ps_file)
+                results[f"{case}/gs_render"], img = time_stage(
+                    lambda: effects_processor.render_ps_to_image(ps_file), args.repeat)
+                results[f"{case}/white_key"], _ = time_stage(
+                    lambda: effects_processor._make_transparent_background(img), args.repeat)
+
+                for name, effects in STAGE_EFFECTS.items():
+                    results[f"{case}/effect_{name}"], _ = time_stage(
+                        lambda: effects_processor.apply_effects(img, effects), args.repeat)
+
+                for pattern in bidet2.EffectsProcessor.patterns:
+                    def create():
+                        # Cold: the tile has to be drawn as well
+                        bidet2.EffectsProcessor._tile_cache.clear()
+                        return effects_processor._create_pattern_image(
+                            pattern, img.size, (255, 255, 255, 255), (0, 0, 0, 255), 20)
+                    results[f"{case}/pattern_{pattern}"], _ = time_stage(create, args.repeat)
+
+                for fmt in ('sixel', 'ansi'):
+                    results[f"{case}/output_{fmt}"], _ = time_stage(
+                        lambda: effects_processor.encode_image(img, 'white', fmt, 80, 'truecolor'),
+                        args.repeat)
+                print(f"{case}: {img.width}x{img.height}", file=sys.stderr)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, threshold, floor):
+    """Return (key, old, new) for stages slower than the baseline"""
+    regressions = []
+    for key, new in results.items():
+        old = baseline.get(key)
+        if old is not None and new > old * (1 + threshold) and new - old > floor:
+            regressions.append((key, old, new))
+    return regressions
+
+
+def bench_stages(args):
+    """Stage-level timings, saved as JSON and checked against a baseline"""
+    import json
+    import platform
+
+    if args.fake_gs or not shutil.which("gs"):
+        fake_dir = tempfile.mkdtemp(prefix="bidet_fake_gs_")
+        install_fake_gs(fake_dir)
+        print("using the fake gs: gs_render times are not representative", file=sys.stderr)
+    else:
+        fake_dir = None
+
+    try:
+        results = run_stages(args)
+    finally:
+        if fake_dir:
+            shutil.rmtree(fake_dir, ignore_errors=True)
+
+    print(f"{'stage':<40} {'ms':>9}")
+    for key, seconds in results.items():
+        print(f"{key:<40} {seconds * 1000:9.2f}")
+
+    record = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'fake_gs': bool(fake_dir),
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+
+    if not args.baseline:
+        return 0
+    if not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as f:
+            json.dump(record, f, indent=1, sort_keys=True)
+        print(f"no baseline yet, saved this run as {args.baseline}")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline['meta'].get('fake_gs') != bool(fake_dir):
+        print("warning: baseline and this run differ in the use of the fake gs", file=sys.stderr)
+    regressions = compare(results, baseline['results'], args.threshold, args.floor / 1000)
+    for key, old, new in regressions:
+        print(f"REGRESSION {key}: {old * 1000:.2f} ms -> {new * 1000:.2f} ms (+{(new / old - 1) * 100:.0f}%)")
+    print(f"{len(regressions)} regressions against {args.baseline}")
+    return 1 if regressions else 0
+
+
+def bench_resolution(args):
+    """Pixels and time at the fixed resolution against the one picked for
+    the output width (--max-cols, as output_resolution does for a terminal)"""
+    from argparse import Namespace
+
+    if args.fake_gs or not shutil.which("gs"):
+        fake_dir = tempfile.mkdtemp(prefix="bidet_fake_gs_")
+        install_fake_gs(fake_dir)
+        print("using the fake gs: render times are not representative", file=sys.stderr)
+    else:
+        fake_dir = None
+
+    bidet = bidet2.BIDeT()
+    effects_processor = bidet2.EffectsProcessor()
+    fixed = bidet2.EffectsProcessor.resolution
+    temp_dir = tempfile.mkdtemp(prefix="bidet_bench_")
+    print(f"{'case':<14} {'fixed dpi':>9} {'pixels':>9} {'ms':>7}   {'output dpi':>10} {'pixels':>9} {'ms':>7}"
+          f"   {'saved':>6} {'saved':>6}")
+    try:
+        for text_name in args.texts:
+            text_lines = bidet.read_text(Namespace(text=[STAGE_TEXTS[text_name]], preserve=False, width=20))
+            options = Namespace(size=args.size, line=1, rotate=False, max_width_px=None)
+            ps_file = os.path.join(temp_dir, 'bench.ps')
+            bidet.build_document(text_lines, 'Helvetica', 'black', options).output(ps_file)
+            for cols in args.cols:
+                options.max_width_px = cols * args.cell_width
+                row = []
+                for resolution in (fixed, bidet.output_resolution(options, text_lines, 'Helvetica', {})):
+                    # gs and the Sixel encoder, which scales down to the columns
+                    def render():
+                        img = effects_processor.render_ps_to_image(ps_file, resolution)
+                        effects_processor.encode_image(img, 'white', 'sixel', cols, 'truecolor')
+                        return img
+                    seconds, img = time_stage(render, args.repeat)
+                    row.append((resolution, img.width * img.height, seconds * 1000))
+                (_, old_pixels, old_ms), (_, new_pixels, new_ms) = row
+                print(f"{text_name + '/' + str(cols) + 'col':<14} {row[0][0]:9d} {old_pixels:9d} {old_ms:7.1f}"
+                      f"   {row[1][0]:10d} {new_pixels:9d} {new_ms:7.1f}"
+                      f"   {(1 - new_pixels / old_pixels) * 100:5.0f}% {(1 - new_ms / old_ms) * 100:5.0f}%")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        if fake_dir:
+            shutil.rmtree(fake_dir, ignore_errors=True)
+    return 0
+
+
+# Commands that must start without PIL or NumPy
+METADATA_COMMANDS = [['--version'], ['--list-patterns'], ['-c', 'list'], ['-f', 'list']]
+
+
+def import_times(argv):
+    """Run python -X importtime and return {module: cumulative microseconds}"""
+    import subprocess
+
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)  # measure with cached bytecode
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + argv, env=env,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if cumulative.strip().isdigit():
+                times[name[1:].rstrip()] = int(cumulative)  # nested imports keep their indent
+    return times
+
+
+def bench_startup(args):
+    """Import time of bidet2 and the imports of metadata commands, against a budget"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bidet2.py')
+    here = os.path.dirname(script)
+    failures = []
+
+    import_times(['-c', 'import sys; sys.path.insert(0, %r); import bidet2' % here])  # write bytecode
+    samples = []
+    for _ in range(args.repeat):
+        times = import_times(['-c', 'import sys; sys.path.insert(0, %r); import bidet2' % here])
+        samples.append(times.get('bidet2', 0) / 1000)
+    samples.sort()
+    import_ms = samples[len(samples) // 2]
+    print(f"import bidet2: {import_ms:8.1f} ms (budget {args.budget:.0f} ms)")
+    if import_ms > args.budget:
+        failures.append(f"import bidet2 takes {import_ms:.1f} ms")
+
+    for command in METADATA_COMMANDS:
+        times = import_times([script] + command)
+        heavy = sorted({name.strip().split('.')[0] for name in times} & {'PIL', 'numpy'})
+        total = sum(ms for name, ms in times.items() if not name.startswith(' ')) / 1000
+        label = ' '.join(command)
+        print(f"{label:<16} imports {total:8.1f} ms {'(imports ' + ', '.join(heavy) + ')' if heavy else ''}")
+        if heavy:
+            failures.append(f"'{label}' imports {', '.join(heavy)}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for bidet2.py')
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    pool = sub.add_parser('pool', help='gs pool vs one gs process per render')
+    pool.add_argument('--renders', type=int, default=50, help='Number of renders (default: 50)')
+    pool.add_argument('--max-jobs', type=int, default=100,
+                      help='Renders before a worker is recycled (default: 100)')
+    pool.add_argument('--text', default='Hello, World!', help='Banner text')
+    pool.set_defaults(func=bench_pool)
+
+    sixel = sub.add_parser('sixel', help='native Sixel encoder vs img2sixel')
+    sixel.add_argument('--image', help='PNG to encode (default: a generated banner)')
+    sixel.add_argument('--text', default='Hello, World!', help='Banner text')
+    sixel.add_argument('--scale', type=int, default=4, help='Generated banner scale (default: 4)')
+    sixel.add_argument('--background', default='white', help='Background colour (default: white)')
+    sixel.add_argument('--repeat', type=int, default=20, help='Encodes to time (default: 20)')
+    sixel.add_argument('--tolerance', type=int, default=8,
+                       help='Per-channel difference counted as a visual change (default: 8)')
+    sixel.set_defaults(func=bench_sixel)
+
+    post = sub.add_parser('postrender', help='crop/white-key cost after gs at several sizes')
+    post.add_argument('--no-numpy', action='store_true', help='Measure the paths used without NumPy')
+    post.set_defaults(func=bench_postrender)
+
+    stages = sub.add_parser('stages', help='time every pipeline stage, save and compare results')
+    stages.add_argument('--texts', nargs='+', choices=list(STAGE_TEXTS), default=list(STAGE_TEXTS),
+                        help='Text lengths to run (default: all)')
+    stages.add_argument('--sizes', nargs='+', type=int, default=[24, 65, 120],
+                        help='Font sizes to run (default: 24 65 120)')
+    stages.add_argument('--repeat', type=int, default=5, help='Runs per stage, the median is kept (default: 5)')
+    stages.add_argument('--output', metavar='FILE', help='Save the results as JSON')
+    stages.add_argument('--baseline', metavar='FILE',
+                        help='Compare with a saved run (created from this run if missing)')
+    stages.add_argument('--threshold', type=float, default=0.25,
+                        help='Slowdown counted as a regression (default: 0.25 = 25%%)')
+    stages.add_argument('--floor', type=float, default=1.0,
+                        help='Ignore slowdowns smaller than this many ms (default: 1)')
+    stages.add_argument('--fake-gs', action='store_true',
+                        help='Use a fake gs even if Ghostscript is installed')
+    stages.set_defaults(func=bench_stages)
+
+    resolution = sub.add_parser('resolution', help='pixels and time at the fixed dpi vs the output width')
+    resolution.add_argument('--texts', nargs='+', choices=list(STAGE_TEXTS), default=list(STAGE_TEXTS),
+                            help='Text lengths to run (default: all)')
+    resolution.add_argument('--size', type=int, default=65, help='Font size (default: 65)')
+    resolution.add_argument('--cols', nargs='+', type=int, default=[80, 120, 200],
+                            help='Terminal widths in columns (default: 80 120 200)')
+    resolution.add_argument('--cell-width', type=int, default=10,
+                            help='Pixels per terminal column (default: 10)')
+    resolution.add_argument('--repeat', type=int, default=5, help='Runs per stage, the median is kept (default: 5)')
+    resolution.add_argument('--fake-gs', action='store_true',
+                            help='Use a fake gs even if Ghostscript is installed')
+    resolution.set_defaults(func=bench_resolution)
+
+    startup = sub.add_parser('startup', help='import time and lazy imports of metadata commands')
+    startup.add_argument('--budget', type=float, default=40,
+                         help='Maximum import time of bidet2 in ms (default: 40)')
+    startup.add_argument('--repeat', type=int, default=5, help='Imports to time, the median is kept (default: 5)')
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1078 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests for bidet2.py
+
+Run with: python3 bidet2_test.py (or make test)
+"""
+
+import io
+import json
+import math
+import os
+import random
+import re
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from argparse import Namespace
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bidet2
+import bidet2_bench
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from PIL import Image, ImageDraw
+
+
+def random_image(width, height, seed=0, binary_alpha=False):
+    """RGBA image of random pixels, optionally only fully opaque or clear"""
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    if binary_alpha:
+        pixels[..., 3] = rng.choice([0, 255], (height, width))
+    return Image.fromarray(pixels, 'RGBA')
+
+
+def unfused(processor, img, effects):
+    """Apply the image step of every enabled effect, in plan order"""
+    steps = sorted((order, name, image)
+                   for name, (order, image, _) in processor.effect_registry.items()
+                   if effects.get(name))
+    for _, _, image in steps:
+        img = image(processor, img, effects)
+    return img
+
+
+def png_bytes(img):
+    """Encode an image as PNG"""
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+# Stand-in for gs that speaks the GhostscriptWorker protocol: the prolog
+# ends with a READY marker, every job with a DONE status line on stderr and
+# (when OK) a PNG of the page size on stdout. A job containing
+# bidet_test_error fails like a PostScript error, one containing
+# bidet_test_crash exits while the file named in $BIDET_TEST_CRASH exists.
+PROTOCOL_GS = """#!{python}
+import io
+import os
+import re
+import sys
+from PIL import Image
+
+size = (1, 1)
+body = []
+for raw in sys.stdin.buffer:
+    line = raw.decode('latin1')
+    if 'BIDeT-READY' in line:
+        sys.stderr.write('\\nBIDeT-READY\\n')
+        sys.stderr.flush()
+        continue
+    match = re.search(r'/PageSize \\[(\\S+) (\\S+)\\] /HWResolution \\[(\\S+)', line)
+    if match:
+        width, height, dpi = (float(v) for v in match.groups())
+        size = (max(1, round(width * dpi / 72)), max(1, round(height * dpi / 72)))
+        body = []
+        continue
+    body.append(line)
+    crash = os.environ.get('BIDET_TEST_CRASH')
+    if 'bidet_test_crash' in line and crash and os.path.exists(crash):
+        os.unlink(crash)
+        sys.exit(1)
+    match = re.search(r'BIDeT-DONE (\\d+) OK', line)
+    if not match:
+        continue
+    if any('bidet_test_error' in l for l in body):
+        status = 'ERR undefined'
+    else:
+        buf = io.BytesIO()
+        Image.new('RGBA', size, (0, 0, 0, 255)).save(buf, format='PNG')
+        sys.stdout.buffer.write(buf.getvalue())
+        sys.stdout.buffer.flush()
+        status = 'OK'
+    sys.stderr.write('\\nBIDeT-DONE ' + match.group(1) + ' ' + status + '\\n')
+    sys.stderr.flush()
+"""
+
+
+class Page:
+    """The parts of a PostScriptSimple document GhostscriptPool.render uses"""
+
+    def __init__(self, width, height, body="0 0 moveto\n"):
+        self.width = width
+        self.height = height
+        self.body = body
+
+    def page_body(self):
+        return self.body
+
+
+def without_numpy(func, *args):
+    """Call func with "import numpy" failing, to reach the pure-PIL paths"""
+    saved = sys.modules.get('numpy')
+    sys.modules['numpy'] = None
+    try:
+        return func(*args)
+    finally:
+        sys.modules['numpy'] = saved
+
+
+@unittest.skipIf(np is None, "needs NumPy")
+class EffectPlanTest(unittest.TestCase):
+    """Fusing array steps must not change the output"""
+
+    # Fused with the array-only invert effect registered in setUp
+    CASES = [
+        {'flip': 'vertical', 'fade': 'transparent'},
+        {'flip': 'horizontal', 'fade': 'transparent', 'fade_amount': '0.3'},
+        {'flip': 'both', 'fade': 'white'},
+        {'flip': 'both', 'fade': 'white', 'fade_amount': '0.7'},
+        {'flip': 'vertical', 'fade': 'black', 'fade_amount': '0.25'},
+        {'colorspill': 'red,blue', 'flip': 'vertical'},
+        {'colorspill': 'red,blue', 'fade': 'transparent'},
+        {'colorspill': 'red,yellow,blue', 'colorspill_direction': 'diagonal',
+         'flip': 'horizontal', 'fade': 'black', 'fade_amount': '0.6'},
+        {'colorspill': 'navy,orange', 'colorspill_direction': 'horizontal', 'fade': 'white'},
+    ]
+
+    def setUp(self):
+        self.processor = bidet2.EffectsProcessor()
+        self.register('invert', 5, array=self.invert)
+
+    def register(self, name, order, **steps):
+        bidet2.EffectsProcessor.register_effect(name, order, **steps)
+        self.addCleanup(bidet2.EffectsProcessor.effect_registry.pop, name)
+
+    @staticmethod
+    def invert(processor, data, effects):
+        data[..., :3] = 255 - data[..., :3]
+        return data
+
+    def test_fused_equals_unfused(self):
+        for seed, (width, height) in enumerate([(1, 1), (7, 5), (64, 31), (200, 90)]):
+            for binary_alpha in (False, True):
+                img = random_image(width, height, seed, binary_alpha)
+                inverted = Image.fromarray(self.invert(None, np.array(img), None), 'RGBA')
+                for effects in self.CASES:
+                    with self.subTest(size=(width, height), binary_alpha=binary_alpha, **effects):
+                        plan = bidet2.EffectPlan(self.processor, dict(effects, invert=True))
+                        self.assertEqual([kind for _, kind, _ in plan.steps], ['array'])
+                        fused = np.asarray(plan.run(img))
+                        expected = np.asarray(unfused(self.processor, inverted, effects))
+                        np.testing.assert_array_equal(fused, expected)
+
+    def test_image_steps_are_not_fused(self):
+        plan = bidet2.EffectPlan(self.processor, {'fade': 'transparent', 'flip': 'both'})
+        self.assertEqual(plan.describe(), 'flip -> fade')
+        img = Image.new('RGBA', (4, 4), (0, 0, 0, 255))
+        self.assertEqual(plan.run(img).getpixel((0, 0)), (0, 0, 0, 127))
+
+    def test_transparent_fade_halves_alpha(self):
+        img = Image.new('RGBA', (4, 4), (0, 0, 0, 255))
+        plan = bidet2.EffectPlan(self.processor, {'fade': 'transparent', 'flip': 'both', 'invert': True})
+        self.assertEqual(plan.describe(), '[invert+flip+fade]')
+        self.assertEqual(plan.run(img).getpixel((0, 0)), (255, 255, 255, 127))
+
+    def test_effect_after_tile_gets_an_image(self):
+        seen = []
+
+        def record(processor, img, effects):
+            seen.append(img)
+            return img
+
+        self.register('record', 70, image=record)
+        plan = bidet2.EffectPlan(self.processor, {'tile': 'on', 'tile_count': '2', 'record': True})
+        result = plan.run(random_image(5, 3, 0))
+        self.assertIsInstance(seen[0], Image.Image)
+        self.assertEqual(seen[0].size, (10, 6))
+        self.assertIs(result, seen[0])
+
+
+class GhostscriptPoolTest(unittest.TestCase):
+    """The pipe protocol of the gs pool, against a gs that speaks it"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix="bidet_test_")
+        path = os.path.join(cls.dir, 'gs')
+        with open(path, 'w') as f:
+            f.write(PROTOCOL_GS.format(python=sys.executable))
+        os.chmod(path, 0o755)
+        cls.crash_file = os.path.join(cls.dir, 'crash')
+        cls.environ = mock.patch.dict(os.environ, {
+            'PATH': cls.dir + os.pathsep + os.environ.get('PATH', ''),
+            'BIDET_TEST_CRASH': cls.crash_file})
+        cls.environ.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environ.stop()
+        shutil.rmtree(cls.dir, ignore_errors=True)
+
+    def worker(self, max_jobs=100):
+        worker = bidet2.GhostscriptWorker("% prolog\n", max_jobs=max_jobs, timeout=10)
+        self.addCleanup(worker.close)
+        return worker
+
+    def test_png_length(self):
+        png = png_bytes(Image.new('RGBA', (30, 20), (1, 2, 3, 4)))
+        self.assertEqual(bidet2._png_length(png), len(png))
+        self.assertEqual(bidet2._png_length(png + b'more output'), len(png))
+        for cut in (0, 8, 20, len(png) - 1):
+            self.assertEqual(bidet2._png_length(png[:cut]), 0)
+
+    def test_render_and_recycle(self):
+        worker = self.worker(max_jobs=2)
+        for width, height, resolution in ((72, 36, 72), (100, 50, 144), (10, 10, None), (1, 1, 72)):
+            img = Image.open(io.BytesIO(worker.render(width, height, "0 0 moveto\n", resolution)))
+            resolution = resolution or bidet2.EffectsProcessor.resolution
+            self.assertEqual(img.size, (round(width * resolution / 72), round(height * resolution / 72)))
+        self.assertEqual(worker.restarts, 1)  # recycled after two jobs
+
+    def test_postscript_error_keeps_the_worker(self):
+        worker = self.worker()
+        with self.assertRaisesRegex(RuntimeError, "Ghostscript error: ERR undefined"):
+            worker.render(10, 10, "bidet_test_error\n", 72)
+        self.assertTrue(worker.alive)
+        self.assertEqual(Image.open(io.BytesIO(worker.render(10, 10, "", 72))).size, (10, 10))
+        self.assertEqual(worker.restarts, 0)
+
+    def test_crashed_worker_is_restarted(self):
+        worker = self.worker()
+        worker.render(10, 10, "", 72)
+        open(self.crash_file, 'w').close()
+        with self.assertRaisesRegex(RuntimeError, "died"):
+            worker.render(10, 10, "bidet_test_crash\n", 72)
+        self.assertFalse(worker.alive)
+        self.assertEqual(Image.open(io.BytesIO(worker.render(20, 10, "", 72))).size, (20, 10))
+        self.assertTrue(worker.alive)
+
+    def test_pool_retries_once_after_a_crash(self):
+        with bidet2.GhostscriptPool(size=1) as pool:
+            open(self.crash_file, 'w').close()
+            img = pool.render(Page(30, 15, "bidet_test_crash\n"), 72)
+            self.assertEqual(img.size, (30, 15))
+            self.assertFalse(os.path.exists(self.crash_file))
+
+    def test_pool_renders_concurrently(self):
+        results = {}
+
+        def render(n):
+            results[n] = pool.render(Page(10 + n, 10), 72).size
+
+        with bidet2.GhostscriptPool(size=2) as pool:
+            threads = [threading.Thread(target=render, args=(n,)) for n in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertLessEqual(len(pool.workers), 2)
+        self.assertEqual(results, {n: (10 + n, 10) for n in range(6)})
+
+
+class RenderCacheTest(unittest.TestCase):
+    """Hits, misses and LRU eviction that never touches other files"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="bidet_test_")
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+
+    def image(self, seed):
+        return Image.frombytes('RGBA', (16, 16), bytes((seed * 7 + i) % 256 for i in range(16 * 16 * 4)))
+
+    def test_put_and_get(self):
+        cache = bidet2.RenderCache(self.dir)
+        key = cache.key(text=['Hi'], size=65)
+        self.assertEqual(key, cache.key(size=65, text=['Hi']))
+        self.assertNotEqual(key, cache.key(text=['Hi'], size=66))
+        self.assertIsNone(cache.get(key))
+        cache.put(key, self.image(1))
+        self.assertEqual(cache.get(key).tobytes(), self.image(1).tobytes())
+        self.assertEqual((cache.hits, cache.misses, cache.stores), (1, 1, 1))
+        self.assertEqual(os.listdir(self.dir), [key + '.png'])
+
+    def test_unreadable_entry_is_dropped(self):
+        cache = bidet2.RenderCache(self.dir)
+        key = cache.key(text=['Hi'])
+        with open(os.path.join(self.dir, key + '.png'), 'wb') as f:
+            f.write(b'not a png')
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_evicts_least_recently_used(self):
+        cache = bidet2.RenderCache(self.dir)
+        keys = [cache.key(n=n) for n in range(4)]
+        for age, key in enumerate(keys[:3]):
+            cache.put(key, self.image(0))
+            os.utime(os.path.join(self.dir, key + '.png'), (1000 + age, 1000 + age))
+        cache.max_bytes = os.path.getsize(os.path.join(self.dir, keys[0] + '.png')) * 3
+        self.assertIsNotNone(cache.get(keys[0]))  # now the most recently used
+        cache.put(keys[3], self.image(0))
+        remaining = sorted(name[:-4] for name in os.listdir(self.dir))
+        self.assertEqual(remaining, sorted([keys[0], keys[2], keys[3]]))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_other_files_are_left_alone(self):
+        foreign = ['photo.png', 'notes.txt', 'A' * 64 + '.png', '0' * 63 + '.png', '.hidden.png']
+        for name in foreign:
+            with open(os.path.join(self.dir, name), 'wb') as f:
+                f.write(png_bytes(self.image(2)))
+        stale = os.path.join(self.dir, '.stale_writer.tmp')
+        fresh = os.path.join(self.dir, '.busy_writer.tmp')
+        for path in (stale, fresh):
+            open(path, 'wb').close()
+        os.utime(stale, (time.time() - 7200, time.time() - 7200))
+
+        cache = bidet2.RenderCache(self.dir, max_bytes=0)
+        cache.put(cache.key(text=['Hi']), self.image(1))
+        self.assertEqual(sorted(os.listdir(self.dir)), sorted(foreign + ['.busy_writer.tmp']))
+
+    def test_unusable_directory_turns_the_cache_off(self):
+        not_a_directory = os.path.join(self.dir, 'file')
+        open(not_a_directory, 'w').close()
+        cache = bidet2.RenderCache(os.path.join(not_a_directory, 'cache'))
+        self.assertFalse(cache.enabled)
+        key = cache.key(text=['Hi'])
+        cache.put(key, self.image(1))
+        self.assertIsNone(cache.get(key))
+        self.assertEqual((cache.hits, cache.misses, cache.stores), (0, 1, 0))
+
+
+class PageSizeTest(unittest.TestCase):
+    """The page is sized to the text from the font metrics"""
+
+    metrics = {'widths': {ord(c): 0.5 for c in 'Hello World'}, 'max_width': 1.0,
+               'ascent': 0.9, 'descent': 0.2}
+
+    def document(self, lines, size=40, line=1.5):
+        ps = bidet2.BIDeT().build_document(lines, 'Helvetica', 'black', Namespace(size=size, line=line))
+        out = io.BytesIO()
+        ps.output(out)
+        return ps, out.getvalue().decode('latin1')
+
+    def test_page_is_the_text_box(self):
+        with mock.patch.object(bidet2.FontMetrics, '_load', return_value=self.metrics):
+            ps, text = self.document(['Hello', 'Hello World'])
+        # 10pt margins, widest line, a quarter ascent of italic overhang
+        width = 10 + 11 * 0.5 * 40 + 0.9 * 40 / 4 + 10
+        # One line spacing per extra line, ascent and descent, margins
+        height = 1 * 60 + 0.9 * 40 + 0.2 * 40 + 10 * 2
+        self.assertEqual((ps.width, ps.height), (math.ceil(width), math.ceil(height)))
+        self.assertIn(f"%%BoundingBox: 0 0 {ps.width} {ps.height}\n", text)
+
+    def test_other_characters_get_the_widest_glyph(self):
+        with mock.patch.object(bidet2.FontMetrics, '_load', return_value=self.metrics):
+            narrow, _ = self.document(['Hello'])
+            wide, _ = self.document(['Hellö'])
+        self.assertEqual(wide.width - narrow.width, 0.5 * 40)
+
+    def test_unknown_font_is_never_clipped(self):
+        with mock.patch.object(bidet2.FontMetrics, '_load', return_value=None):
+            ps, _ = self.document(['WWWWWW'], size=50, line=1)
+        self.assertGreaterEqual(ps.width, 6 * 50 + 20)
+        self.assertGreaterEqual(ps.height, 50 + 20)
+
+    def test_page_scales_with_the_text(self):
+        with mock.patch.object(bidet2.FontMetrics, '_load', return_value=self.metrics):
+            small, _ = self.document(['Hello'] * 2, size=20)
+            large, _ = self.document(['Hello'] * 2, size=80)
+            longer, _ = self.document(['Hello'] * 4, size=20)
+        self.assertAlmostEqual((large.width - 20) / (small.width - 20), 4, delta=0.1)
+        self.assertAlmostEqual((large.height - 20) / (small.height - 20), 4, delta=0.1)
+        self.assertEqual(longer.height - small.height, 2 * 30)
+        self.assertLess(large.width * large.height, 2384 * 3370 / 50)  # far from A0
+
+
+class PipeTest(unittest.TestCase):
+    """--pipe renders through gs's stdin and stdout without scratch files"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix="bidet_test_")
+        path = os.path.join(cls.dir, 'gs')
+        with open(path, 'w') as f:
+            f.write(bidet2_bench.FAKE_GS.format(python=sys.executable))
+        os.chmod(path, 0o755)
+        cls.environ = mock.patch.dict(os.environ, {'PATH': cls.dir + os.pathsep + os.environ.get('PATH', '')})
+        cls.environ.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.environ.stop()
+        shutil.rmtree(cls.dir, ignore_errors=True)
+
+    def test_render_ps_stream(self):
+        written = []
+
+        def write(out):
+            ps = bidet2.BIDeT().build_document(['Hi'], 'Helvetica', 'black',
+                                               Namespace(size=65, line=1), out=out)
+            written.append(ps)
+
+        img = bidet2.EffectsProcessor().render_ps_stream(write, 72)
+        self.assertEqual(len(written), 1)
+        self.assertEqual(img.mode, 'RGBA')
+        self.assertEqual(img.getchannel('A').getextrema(), (0, 255))
+
+    def run_bidet(self, *options):
+        """Run bidet2.py in its own scratch, temp and cache locations"""
+        temp = tempfile.mkdtemp(prefix="bidet_test_", dir=self.dir)
+        user = f"bidet-test-{os.getpid()}"
+        env = dict(os.environ, USER=user, TMPDIR=os.path.join(temp, 'tmp'),
+                   XDG_CACHE_HOME=os.path.join(temp, 'cache'), XDG_RUNTIME_DIR=os.path.join(temp, 'run'))
+        os.mkdir(env['TMPDIR'])
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bidet2.py')
+        proc = subprocess.run([sys.executable, script, '--no-cache', '-c', 'black', '-b', 'white']
+                              + list(options) + ['Hi'], env=env, stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.assertEqual(proc.returncode, 0, proc.stderr.decode())
+        self.assertTrue(proc.stdout.startswith(b'\x1bP'))
+        scratch = os.path.join('/dev/shm', user)
+        used = os.path.isdir(scratch) or bool(os.listdir(env['TMPDIR']))
+        shutil.rmtree(scratch, ignore_errors=True)
+        return used
+
+    def test_pipe_mode_creates_no_files(self):
+        self.assertTrue(self.run_bidet())  # the check can see scratch files
+        self.assertFalse(self.run_bidet('--pipe'))
+
+
+@unittest.skipIf(np is None, "needs NumPy")
+class SixelEncoderTest(unittest.TestCase):
+    """Decoded Sixel output must look like the image on the background"""
+
+    bg = (255, 255, 255)
+
+    def decode(self, img, data):
+        return np.asarray(bidet2_bench.decode_sixel(data, img.size)).astype(np.int16)
+
+    def test_opaque_colours_are_exact(self):
+        img = Image.new('RGBA', (13, 9), (0, 0, 0, 0))
+        img.paste((255, 0, 0, 255), (0, 0, 5, 4))
+        img.paste((0, 0, 255, 255), (6, 3, 13, 9))
+        decoded = self.decode(img, bidet2.SixelEncoder().encode(img, self.bg))
+        np.testing.assert_array_equal(decoded, np.asarray(img))
+
+    def test_semi_transparent_pixels_are_blended(self):
+        for alpha in (1, 64, 127, 128, 254):
+            with self.subTest(alpha=alpha):
+                img = Image.new('RGBA', (8, 7), (0, 0, 0, alpha))
+                decoded = self.decode(img, bidet2.SixelEncoder().encode(img, self.bg))
+                self.assertTrue((decoded[..., 3] == 255).all(), "pixels were dropped")
+                # Palette entries are sent as percentages
+                expected = bidet2_bench.flatten(img, self.bg)
+                self.assertLessEqual(np.abs(decoded[..., :3] - expected).max(), 2)
+
+    def test_transparent_pixels_are_not_painted(self):
+        img = Image.new('RGBA', (10, 12), (0, 0, 0, 0))
+        img.putpixel((3, 4), (0, 128, 0, 255))
+        data = bidet2.SixelEncoder().encode(img, self.bg)
+        self.assertTrue(data.startswith(b'\x1bP0;1;0q"1;1;10;12'))
+        decoded = self.decode(img, data)
+        self.assertEqual(int((decoded[..., 3] > 0).sum()), 1)
+        self.assertEqual(tuple(decoded[4, 3]), (0, 128, 0, 255))
+
+    def test_many_colours_are_reduced(self):
+        img = random_image(40, 30, binary_alpha=True)
+        data = bidet2.SixelEncoder(max_colors=16).encode(img, self.bg)
+        self.assertNotIn(b'#16;', data)
+        decoded = self.decode(img, data)
+        np.testing.assert_array_equal(decoded[..., 3], np.asarray(img)[..., 3])
+
+    def test_tiled_image_matches_full_frame(self):
+        tile = random_image(7, 5, seed=3, binary_alpha=True)
+        encoder = bidet2.SixelEncoder()
+        for mirror in (False, True):
+            with self.subTest(mirror=mirror):
+                tiled = bidet2.TiledImage(tile, 3, mirror)
+                self.assertEqual(encoder.encode(tiled, self.bg), encoder.encode(tiled.image(), self.bg))
+
+
+@unittest.skipIf(np is None, "needs NumPy")
+class AnsiRendererTest(unittest.TestCase):
+    """Half-block output: colours, blending and skipped transparent cells"""
+
+    def render(self, img, colors='truecolor', bg=(255, 255, 255), max_cols=None):
+        return list(bidet2.AnsiRenderer(colors).render_rows(img, bg, max_cols))
+
+    def test_two_colours_per_cell(self):
+        img = Image.new('RGBA', (1, 2), (255, 0, 0, 255))
+        img.putpixel((0, 1), (0, 0, 255, 255))
+        self.assertEqual(self.render(img), ["\x1b[38;2;255;0;0;48;2;0;0;255m▀\x1b[0m\n"])
+
+    def test_semi_transparent_pixels_are_blended(self):
+        img = Image.new('RGBA', (1, 2), (0, 0, 0, 127))
+        self.assertEqual(self.render(img), ["\x1b[38;2;128;128;128m█\x1b[0m\n"])
+
+    def test_transparent_cells_are_skipped(self):
+        img = Image.new('RGBA', (4, 1), (0, 0, 0, 0))
+        img.putpixel((3, 0), (0, 0, 0, 255))
+        # The missing lower row of an odd height is transparent too
+        self.assertEqual(self.render(img), ["\x1b[3C\x1b[38;2;0;0;0m▀\x1b[0m\n"])
+
+    def test_colours_are_sent_once_per_run(self):
+        red, blue = (255, 0, 0, 255), (0, 0, 255, 255)
+        img = Image.new('RGBA', (5, 4), (0, 0, 0, 0))
+        for x in range(5):
+            img.putpixel((x, 0), red)
+            img.putpixel((x, 2), red)
+        for x, colour in enumerate([blue, blue, red, red]):
+            img.putpixel((x, 1), colour)
+        # Full blocks keep the blue background, every line starts afresh
+        # and a line without painted cells is only the reset
+        self.assertEqual(self.render(img), [
+            "\x1b[38;2;255;0;0;48;2;0;0;255m▀▀██\x1b[49m▀\x1b[0m\n",
+            "\x1b[38;2;255;0;0m▀▀▀▀▀\x1b[0m\n",
+        ])
+        self.assertEqual(self.render(Image.new('RGBA', (3, 2))), ["\x1b[0m\n"])
+
+    def test_palette_modes(self):
+        img = Image.new('RGBA', (1, 2), (255, 0, 0, 255))
+        self.assertEqual(self.render(img, '256'), ["\x1b[38;5;196m█\x1b[0m\n"])
+        self.assertEqual(self.render(img, '16'), ["\x1b[91m█\x1b[0m\n"])
+
+    def test_max_cols(self):
+        img = Image.new('RGBA', (100, 40), (0, 0, 0, 255))
+        lines = self.render(img, max_cols=10)
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0].count("█"), 10)
+
+
+@unittest.skipIf(np is None, "needs NumPy")
+class GradientTest(unittest.TestCase):
+    """The vectorised colour-spill gradient against the old per-line loop"""
+
+    red, green, blue = (255, 0, 0), (0, 255, 0), (0, 0, 255)
+
+    def gradient(self, size, colors, direction='vertical', alpha=128):
+        img = bidet2.EffectsProcessor()._gradient_image(size, colors, direction, alpha)
+        return np.asarray(img).astype(np.int16)
+
+    def line_loop(self, size, color1, color2):
+        # The colorspill overlay before the gradient was vectorised
+        img = Image.new('RGBA', size)
+        for y in range(0, size[1], 2):
+            t = y / size[1]
+            rgb = tuple(int(color1[i] * (1 - t) + color2[i] * t) for i in range(3))
+            ImageDraw.Draw(img).rectangle([(0, y), (size[0], y + 1)], fill=rgb + (128,))
+        return np.asarray(img).astype(np.int16)
+
+    def test_matches_the_line_loop(self):
+        for height in (50, 101, 300, 1000):
+            with self.subTest(height=height):
+                size = (13, height)
+                new = self.gradient(size, [self.red, self.blue])
+                old = self.line_loop(size, self.red, self.blue)
+                # The loop painted two rows per colour, so it lagged by up
+                # to two rows' worth of the ramp
+                self.assertLessEqual(np.abs(new - old).max(), 510 / height + 3)
+
+    def test_rows_are_smooth(self):
+        img = self.gradient((5, 300), [self.red, self.blue])
+        self.assertTrue((img == img[:, :1]).all())
+        self.assertTrue((img[..., 3] == 128).all())
+        steps = np.diff(img[:, 0, :3], axis=0)
+        self.assertTrue((steps[:, 0] <= 0).all() and (steps[:, 2] >= 0).all())
+        self.assertLessEqual(np.abs(steps).max(), 2)
+
+    def test_directions(self):
+        vertical = self.gradient((13, 101), [self.red, self.blue])
+        horizontal = self.gradient((101, 13), [self.red, self.blue], 'horizontal')
+        np.testing.assert_array_equal(horizontal, vertical.transpose(1, 0, 2))
+
+        diagonal = self.gradient((101, 101), [self.red, self.green, self.blue], 'diagonal', 255)
+        np.testing.assert_array_equal(diagonal, diagonal.transpose(1, 0, 2))
+        for (y, x), colour in (((0, 0), self.red), ((50, 50), self.green), ((-1, -1), self.blue)):
+            self.assertLessEqual(np.abs(diagonal[y, x, :3] - colour).max(), 5)
+
+
+class RenderServerTest(unittest.TestCase):
+    """Requests may only set rendering options, HTTP needs the token"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="bidet_test_")
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        settings = {'no_cache': False, 'cache_dir': self.cache_dir, 'cache_size': 64}
+        self.server = bidet2.RenderServer(workers=1, settings=settings)
+        if self.server.gs_pool:
+            self.addCleanup(self.server.gs_pool.close)
+
+    def test_rejects_settings_and_unknown_keys(self):
+        victim = os.path.join(self.dir, 'victim')
+        os.mkdir(victim)
+        with open(os.path.join(victim, 'photo.png'), 'wb') as f:
+            f.write(b'keep me')
+        for key, value in (('cache_dir', victim), ('cache_size', 0), ('profile', 'json'),
+                           ('cprofile', os.path.join(self.dir, 'out.prof')), ('debug', True),
+                           ('batch', 'jobs.jsonl'), ('serve', True), ('no_such_option', 1)):
+            with self.subTest(key=key):
+                request = {'text': 'hi', 'engine': 'pillow', 'format': 'png', key: value}
+                header, data = self.server.process(json.dumps(request))
+                self.assertFalse(header['ok'])
+                self.assertIn(f'option "{key}" is not allowed', header['error'])
+                self.assertEqual(data, b"")
+        self.assertEqual(os.listdir(victim), ['photo.png'])
+        self.assertFalse(os.path.exists(os.path.join(self.dir, 'out.prof')))
+
+    def test_renders_with_the_server_cache(self):
+        request = {'text': 'hi', 'engine': 'pillow', 'format': 'png', 'colour': 'red'}
+        header, data = self.server.process(json.dumps(request).encode('utf-8'))
+        self.assertTrue(header['ok'], header.get('error'))
+        self.assertEqual(header['length'], len(data))
+        img = Image.open(io.BytesIO(data))
+        self.assertEqual(img.format, 'PNG')
+        red = self.server.effects_processor._get_rgb_color('red')
+        colours = {colour[:3] for _, colour in img.convert('RGBA').getcolors(1 << 16) if colour[3] == 255}
+        self.assertEqual(colours, {red})
+        self.assertTrue(any(name.endswith('.png') for name in os.listdir(self.cache_dir)))
+
+    def test_bad_requests(self):
+        for request, error in (('{"text": "hi", "format": "gif"}', 'unknown format'),
+                               ('{"engine": "pillow"}', 'no "text"'),
+                               ('not json', 'JSONDecodeError')):
+            with self.subTest(request=request):
+                header, _ = self.server.process(request)
+                self.assertFalse(header['ok'])
+                self.assertIn(error, header['error'])
+        self.assertEqual((self.server.requests, self.server.failures), (3, 3))
+
+    def test_batch_jobs_are_checked_too(self):
+        bidet = bidet2.BIDeT()
+        with self.assertRaises(ValueError):
+            bidet.job_to_args({'text': 'hi', 'cache_dir': self.dir})
+        args = bidet.job_to_args({'text': 'hi', 'no-cache': True, 'fade': 'white'},
+                                 {'no_cache': False, 'cache_dir': self.cache_dir, 'cache_size': 5})
+        self.assertEqual((args.no_cache, args.cache_dir, args.cache_size, args.fade),
+                         (True, self.cache_dir, 5, 'white'))
+
+    def test_token(self):
+        self.assertFalse(self.server.authorized("Bearer "))
+        with mock.patch.dict(os.environ, {'XDG_RUNTIME_DIR': self.dir}):
+            path = self.server._write_token()
+        self.assertEqual(os.path.dirname(path), self.dir)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o600)
+        with open(path) as f:
+            token = f.read().strip()
+        self.assertEqual(token, self.server.token)
+        self.assertTrue(self.server.authorized(f"Bearer {token}"))
+        for header in (None, "", token, f"Bearer {token}x", f"bearer {token}", f"Bearer {token[:-1]}"):
+            self.assertFalse(self.server.authorized(header), header)
+
+
+class StartupTest(unittest.TestCase):
+    """Metadata commands must not import the image libraries"""
+
+    def test_metadata_commands_stay_light(self):
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bidet2.py')
+        for command in bidet2_bench.METADATA_COMMANDS:
+            with self.subTest(command=' '.join(command)):
+                times = bidet2_bench.import_times([script] + command)
+                self.assertIn('argparse', {name.strip() for name in times})  # the command ran
+                heavy = {name.strip().split('.')[0] for name in times} & {'PIL', 'numpy'}
+                self.assertEqual(heavy, set())
+
+
+class TerminalInfoTest(unittest.TestCase):
+    """Capabilities are detected once per terminal and cached for ttl seconds"""
+
+    detected = {'sixel': True, 'foreground': "white", 'background': "black", 'colors': 256}
+
+    # Stands in for test-sixel and counts its runs
+    test_sixel = """#!/bin/sh
+echo run >> "$BIDET_TEST_LOG"
+echo "Sixel support found. fg=white bg=black nc=256"
+"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix="bidet_test_")
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        detect = mock.patch.object(bidet2.TerminalInfo, 'detect', side_effect=lambda: dict(self.detected))
+        self.detect = detect.start()
+        self.addCleanup(detect.stop)
+
+    def get(self, refresh=False, ttl=3600):
+        info = bidet2.TerminalInfo(self.dir, ttl).get(refresh)
+        self.assertIn('cell_size', info)
+        del info['cell_size']
+        return info
+
+    def entries(self):
+        directory = os.path.join(self.dir, 'terminal')
+        return [os.path.join(directory, name) for name in os.listdir(directory)]
+
+    def test_hit_miss_and_refresh(self):
+        self.assertEqual(self.get(), self.detected)
+        self.assertEqual(self.get(), self.detected)
+        self.assertEqual(self.detect.call_count, 1)
+        self.get(refresh=True)
+        self.assertEqual(self.detect.call_count, 2)
+        self.assertEqual(len(self.entries()), 1)
+
+    def test_expired_and_broken_entries_are_detected_again(self):
+        self.get()
+        path, = self.entries()
+        old = time.time() - 120
+        os.utime(path, (old, old))
+        self.get(ttl=60)
+        self.assertEqual(self.detect.call_count, 2)
+        with open(path, 'w') as f:
+            f.write('{not json')
+        self.assertEqual(self.get(), self.detected)
+        self.assertEqual(self.detect.call_count, 3)
+
+    def test_each_terminal_has_its_own_entry(self):
+        self.get()
+        with mock.patch.dict(os.environ, {'TERM': 'bidet-test-term'}):
+            self.get()
+            self.get()
+        self.assertEqual(self.detect.call_count, 2)
+        self.assertEqual(len(self.entries()), 2)
+
+    def test_detection_only_for_default_colours(self):
+        bin_dir = os.path.join(self.dir, 'bin')
+        os.mkdir(bin_dir)
+        with open(os.path.join(bin_dir, 'test-sixel'), 'w') as f:
+            f.write(self.test_sixel)
+        os.chmod(os.path.join(bin_dir, 'test-sixel'), 0o755)
+        log = os.path.join(self.dir, 'test-sixel.log')
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''),
+                   XDG_CACHE_HOME=os.path.join(self.dir, 'cache'), BIDET_TEST_LOG=log)
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bidet2.py')
+
+        def runs(*options):
+            proc = subprocess.run([sys.executable, script, '--engine', 'pillow', '--ansi', '--no-cache']
+                                  + list(options) + ['Hi'], env=env, stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            self.assertEqual(proc.returncode, 0, proc.stderr.decode())
+            if not os.path.exists(log):
+                return 0
+            with open(log) as f:
+                return len(f.readlines())
+
+        self.assertEqual(runs('-c', 'black', '-b', 'white'), 0)
+        self.assertEqual(runs(), 1)
+        self.assertEqual(runs(), 1)
+        self.assertEqual(runs('--refresh-terminal'), 2)
+
+
+class FontIndexTest(unittest.TestCase):
+    """Lookup of exact names, other cases and base names"""
+
+    def setUp(self):
+        suffixes = sorted(['Bold', 'Italic', 'BoldItalic', 'Oblique'], key=len, reverse=True)
+        fonts = ['Courier-Bold', 'Courier-BoldItalic', 'Palatino-Roman', 'Palatino-Italic',
+                 'Optima-Bold', 'Optima']
+        isofonts = ['Helvetica', 'Helvetica-Bold', 'Times-Italic', 'Times-BoldItalic']
+        data = {'suffixes': suffixes, 'fonts': fonts, 'isofonts': isofonts,
+                'bases': {}, 'iso_bases': {}, 'lower': {}}
+        for key, names in (('bases', fonts), ('iso_bases', isofonts)):
+            for font in names:
+                data[key].setdefault(bidet2.FontIndex.base_name(font, suffixes), []).append(font)
+        for font in fonts + isofonts:
+            data['lower'].setdefault(font.lower(), font)
+        self.index = bidet2.FontIndex(data)
+
+    def test_find(self):
+        for name, iso, expected in (('Optima', False, 'Optima'),
+                                    ('helvetica-bold', False, 'Helvetica-Bold'),
+                                    ('Courier', False, 'Courier-Bold'),
+                                    ('Times', False, 'Times-Italic'),
+                                    ('Courier', True, None),
+                                    ('Times', True, 'Times-Italic'),
+                                    ('Optima-Bold', True, None),
+                                    ('Palatino', False, 'Palatino-Italic'),
+                                    ('Garamond', False, None)):
+            with self.subTest(name=name, iso=iso):
+                self.assertEqual(self.index.find(name, iso), expected)
+
+    def test_save_leaves_no_temporary_file(self):
+        directory = tempfile.mkdtemp(prefix="bidet_test_")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'fontindex.json')
+        with mock.patch.object(bidet2.FontIndex, 'index_files', lambda: [path]):
+            bidet2.FontIndex._save({'data': {}, 'sources': {}})
+            with open(path) as f:
+                self.assertEqual(json.load(f), {'data': {}, 'sources': {}})
+            with self.assertRaises(TypeError):
+                bidet2.FontIndex._save({'data': object()})  # not serialisable
+        self.assertEqual(os.listdir(directory), ['fontindex.json'])
+
+
+class PostScriptWriterTest(unittest.TestCase):
+    """text_block() and the streaming writer"""
+
+    def document(self, lines, out=None):
+        ps = bidet2.PostScriptSimple(xsize=300, ysize=200, out=out)
+        ps.newpage()
+        ps.setcolour('red')
+        ps.setfont('Helvetica', 20)
+        ps.text_block(10, 180, lines, 24, chunk=3)
+        return ps
+
+    def test_text_block_chunks_and_escapes(self):
+        ps = bidet2.PostScriptSimple()
+        lines = ['a(b)', 'back\\slash', 'c', 'd', 'e']
+        self.assertEqual(ps.text_block(10, 100, iter(lines), 20, chunk=2), 5)
+        self.assertEqual(ps.current_page, [
+            "[(a\\(b\\))\n(back\\\\slash)", "] 10 100 20 textlines",
+            "[(c)\n(d)", "] 10 60 20 textlines",
+            "[(e)", "] 10 20 20 textlines",
+        ])
+        ps = bidet2.PostScriptSimple()
+        ps.text_block(0, 50, ['x'], 10, path=True)
+        self.assertEqual(ps.current_page, ["newpath", "[(x)", "] 0 50 10 textpaths"])
+
+    def test_many_lines_make_a_small_program(self):
+        lines = [f"line {i}" for i in range(10000)]
+        ps = bidet2.PostScriptSimple()
+        ps.text_block(10, 100, lines, 12)
+        program = "\n".join(ps.current_page)
+        # One string per line plus one call per 200 lines
+        self.assertEqual(program.count("textlines"), 50)
+        self.assertLess(len(program), sum(len(line) + 3 for line in lines) + 50 * 40)
+
+    def test_streaming_matches_in_memory(self):
+        lines = [f"line {i}" for i in range(7)]
+        memory = io.BytesIO()
+        self.document(lines).output(memory)
+        streamed = io.BytesIO()
+        ps = self.document(iter(lines), out=streamed)
+        # Nothing is kept while streaming
+        self.assertEqual((ps.content, ps.current_page), ([], []))
+        ps.finish()
+        self.assertEqual(streamed.getvalue(), memory.getvalue())
+
+
+class IterTextTest(unittest.TestCase):
+    """iter_text must wrap exactly like read_text"""
+
+    def assertSameLines(self, text, width):
+        args = Namespace(text=text, preserve=False, width=width)
+        bidet = bidet2.BIDeT()
+        self.assertEqual(list(bidet.iter_text(args)), bidet.read_text(args), (text, width))
+
+    def test_tabs_and_runs_of_spaces(self):
+        self.assertSameLines(['Mr. supercalifragilisticexpialidocious \t\n', '\n', '   x-y-z end. \t a\n'], 21)
+        self.assertSameLines(['a\tb', 'cc\t\td', 'e  \x0c f\r g'], 12)
+
+    def test_random_input(self):
+        rng = random.Random(4)
+        pieces = ['a', 'bb', 'word', 'x-y-z', 'end.', 'supercalifragilistic', ' ', '  ', '\t', ' \t ', '\r', '\n']
+        for _ in range(2000):
+            text = [''.join(rng.choice(pieces) for _ in range(rng.randint(0, 10))) + rng.choice(['', '\n'])
+                    for _ in range(rng.randint(1, 5))]
+            self.assertSameLines(text, rng.randint(1, 30))
+
+    def test_file_input(self):
+        directory = tempfile.mkdtemp(prefix="bidet_test_")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, 'text.txt')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write("first\tline  with   spaces\n\tsecond line\n\nthird\n")
+        self.assertSameLines([path], 10)
+
+
+class OutputResolutionTest(unittest.TestCase):
+    """The rendering resolution follows the output width"""
+
+    metrics = PageSizeTest.metrics
+
+    def resolution(self, max_width_px, effects=None, **options):
+        args = Namespace(size=65, line=1, rotate=False, max_width_px=max_width_px)
+        vars(args).update(options)
+        with mock.patch.object(bidet2.FontMetrics, '_load', return_value=self.metrics):
+            return bidet2.BIDeT().output_resolution(args, ['Hello World'], 'Helvetica', effects or {})
+
+    def test_resolution_fits_the_width(self):
+        # 'Hello World' is 11 * 0.5 * 65pt wide plus a quarter ascent
+        width = 11 * 0.5 * 65 + 0.9 * 65 / 4
+        self.assertEqual(self.resolution(400), int((400 - 20) * 72 / width))
+        self.assertEqual(self.resolution(400, {'tile': 'grid', 'tile_count': 2}),
+                         int((200 - 20) * 72 / width))
+        # Never above the default, never below the minimum
+        self.assertEqual(self.resolution(5000), bidet2.EffectsProcessor.resolution)
+        self.assertEqual(self.resolution(60), bidet2.EffectsProcessor.min_resolution)
+        self.assertEqual(self.resolution(None), bidet2.EffectsProcessor.resolution)
+
+    def test_shadow_widens_the_banner(self):
+        drop = self.resolution(400, {'shadow': 'drop', 'shadow_offset': 5})
+        soft = self.resolution(400, {'shadow': 'soft', 'shadow_offset': 5, 'shadow_blur': None})
+        self.assertLess(soft, drop)
+        self.assertEqual(self.resolution(400, {'shadow': 'soft', 'shadow_offset': 5, 'shadow_blur': 0}), drop)
+
+    def test_output_width_from_max_cols(self):
+        def width(**options):
+            args = Namespace(max_width_px=None, max_cols=120, ansi=False, ansi_encoder='native')
+            vars(args).update(options)
+            with mock.patch.object(bidet2.TerminalInfo, 'cell_size', return_value=(8.0, 16.0)):
+                bidet2.BIDeT().set_output_width(args)
+            return args.max_width_px
+
+        self.assertEqual(width(ansi=True), 120)  # one pixel per column
+        self.assertIsNone(width(ansi=True, ansi_encoder='img2ans'))
+        self.assertEqual(width(), 960)  # cell width in pixels
+        self.assertEqual(width(max_width_px=300), 300)
+        with mock.patch.object(bidet2.TerminalInfo, 'cell_size', return_value=None):
+            args = Namespace(max_width_px=None, max_cols=120, ansi=False, ansi_encoder='native')
+            bidet2.BIDeT().set_output_width(args)
+        self.assertIsNone(args.max_width_px)
+
+    def test_banner_fits_max_cols(self):
+        directory = tempfile.mkdtemp(prefix="bidet_test_")
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        with open(os.path.join(directory, 'gs'), 'w') as f:
+            f.write(bidet2_bench.FAKE_GS.format(python=sys.executable))
+        os.chmod(os.path.join(directory, 'gs'), 0o755)
+        # A wide "terminal", so only the resolution limits the banner width
+        env = dict(os.environ, PATH=directory + os.pathsep + os.environ.get('PATH', ''),
+                   XDG_CACHE_HOME=os.path.join(directory, 'cache'), COLUMNS='2000')
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bidet2.py')
+        for cols in (600, 1000):
+            with self.subTest(cols=cols):
+                proc = subprocess.run([sys.executable, script, '--debug', '--ansi', '--no-cache',
+                                       '--max-cols', str(cols), '-c', 'black', '-b', 'white',
+                                       'Hello, World!'], env=env, stdin=subprocess.DEVNULL,
+                                      capture_output=True, text=True)
+                self.assertEqual(proc.returncode, 0, proc.stderr)
+                self.assertRegex(proc.stderr, rf"Resolution: \d+ dpi for {cols} px")
+                widths = [sum(int(skip or 1) for skip in re.findall(r'\x1b\[(\d+)C|[▀▄█]', line))
+                          for line in proc.stdout.splitlines()]
+                self.assertLessEqual(max(widths), cols)
+                self.assertGreater(max(widths), cols // 2)
+
+
+class ExtrudeTest(unittest.TestCase):
+    """The NumPy 3D extrusion must draw the same layers as the Pillow one"""
+
+    @unittest.skipIf(np is None, "needs NumPy")
+    def test_matches_layered_fallback(self):
+        processor = bidet2.EffectsProcessor()
+        rng = np.random.default_rng(1)
+        for trial in range(20):
+            width, height = (int(v) for v in rng.integers(1, 50, 2))
+            offset = int(rng.integers(1, 30))
+            density = float(rng.random()) * 0.3
+            mask = Image.fromarray(((rng.random((height, width)) < density) * 255).astype(np.uint8))
+            with self.subTest(size=(width, height), offset=offset):
+                shadow = processor._extrude(mask, offset, (10, 20, 30, 200))
+                layered = without_numpy(processor._extrude, mask, offset, (10, 20, 30, 200))
+                self.assertEqual(shadow.size, (width + offset, height + offset))
+                np.testing.assert_array_equal(np.asarray(shadow), np.asarray(layered))
+
+    def test_layer_alpha(self):
+        processor = bidet2.EffectsProcessor()
+        mask = Image.new('L', (1, 1), 255)
+        shadow = without_numpy(processor._extrude, mask, 4, (0, 0, 0, 200))
+        self.assertEqual([shadow.getpixel((i, i))[3] for i in range(5)], [0, 50, 100, 150, 200])
+
+
+class SoftShadowTest(unittest.TestCase):
+    """--shadow-blur 0 is a hard shadow, not the default blur"""
+
+    effects = {'shadow': 'soft', 'shadow_offset': 4, 'shadow_color': 'black'}
+
+    def shadow(self, **effects):
+        img = Image.new('RGBA', (20, 10), (0, 0, 0, 0))
+        img.paste((255, 0, 0, 255), (2, 2, 18, 8))
+        return bidet2.EffectsProcessor()._shadow_image(img, dict(self.effects, **effects))
+
+    def test_zero_blur(self):
+        hard = self.shadow(shadow_blur=0)
+        drop = self.shadow(shadow='drop')
+        self.assertEqual(hard.size, (24, 14))
+        self.assertEqual(hard.tobytes(), drop.tobytes())
+
+    def test_default_blur_is_the_offset(self):
+        self.assertEqual(self.shadow().size, self.shadow(shadow_blur=4).size)
+        self.assertEqual(self.shadow().size, (28, 18))
+
+
+class TiledImageTest(unittest.TestCase):
+    """TiledImage behaves like the full frame it stands in for"""
+
+    def test_mode_follows_the_tile(self):
+        for mode in ('RGBA', 'L'):
+            with self.subTest(mode=mode):
+                tiled = bidet2.TiledImage(Image.new(mode, (3, 2)), 2)
+                self.assertEqual(tiled.mode, mode)
+                self.assertEqual(tiled.image().mode, mode)
+                self.assertEqual(tiled.resize((12, 8)).mode, mode)
+        mask = Image.new('L', (4, 4), 255)
+        tiled = bidet2.EffectsProcessor()._tile_image(mask, {'tile': 'grid', 'tile_count': 3})
+        self.assertEqual((tiled.mode, tiled.size), ('L', (12, 12)))
+
+    def test_image_is_the_tile_grid(self):
+        tile = random_image(5, 4, seed=5)
+        for mirror in (False, True):
+            with self.subTest(mirror=mirror):
+                img = bidet2.TiledImage(tile, 3, mirror).image()
+                self.assertEqual(img.size, (15, 12))
+                for row in range(3):
+                    for col in range(3):
+                        expected = tile
+                        if mirror and col % 2:
+                            expected = expected.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+                        if mirror and row % 2:
+                            expected = expected.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+                        box = (col * 5, row * 4, col * 5 + 5, row * 4 + 4)
+                        self.assertEqual(img.crop(box).tobytes(), expected.tobytes(), (row, col))
+
+
+@unittest.skipIf(np is None, "needs NumPy")
+class CoverageImageTest(unittest.TestCase):
+    """CoverageImage behaves like the RGBA image it stands in for"""
+
+    colour = (200, 30, 90)
+
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        self.coverage = bidet2.CoverageImage(
+            Image.fromarray(rng.integers(0, 256, (20, 30), dtype=np.uint8)), self.colour)
+
+    def test_mode_is_that_of_the_mask(self):
+        self.assertEqual(self.coverage.mode, 'L')
+        self.assertEqual(self.coverage.resize((15, 10)).mode, 'L')
+        self.assertEqual(bidet2.CoverageImage.wrap(bidet2.TiledImage(self.coverage.mask, 2),
+                                                   self.colour).mode, 'L')
+
+    def test_image_is_the_colour_with_the_coverage_as_alpha(self):
+        img = self.coverage.image()
+        self.assertEqual((img.mode, img.size), ('RGBA', (30, 20)))
+        pixels = np.asarray(img)
+        np.testing.assert_array_equal(pixels[..., 3], np.asarray(self.coverage.mask))
+        self.assertTrue((pixels[..., :3] == self.colour).all())
+        self.assertEqual(self.coverage.convert('RGB').getpixel((0, 0)), self.colour)
+
+    def test_sixel_matches_rgba(self):
+        encoder = bidet2.SixelEncoder()
+        bg = (255, 255, 255)
+        self.assertEqual(encoder.encode(self.coverage, bg), encoder.encode(self.coverage.image(), bg))
+
+    def test_ansi_matches_rgba(self):
+        # Scaled down, the mask is resized before the RGBA image is built
+        scaled = self.coverage.resize((12, 8), Image.LANCZOS).image()
+        for colors in bidet2.AnsiRenderer.modes:
+            renderer = bidet2.AnsiRenderer(colors)
+            with self.subTest(colors=colors):
+                self.assertEqual(list(renderer.render_rows(self.coverage, (0, 0, 0))),
+                                 list(renderer.render_rows(self.coverage.image(), (0, 0, 0))))
+                self.assertEqual(list(renderer.render_rows(self.coverage, (0, 0, 0), 12)),
+                                 list(renderer.render_rows(scaled, (0, 0, 0))))
+
+
+if __name__ == '__main__':
+    unittest.main()